@@ -0,0 +1,288 @@
+"""
+Staleness alerts pushed to subscribers as contacts go quiet.
+
+Every (channel, sender) pair has a deadline: its last-seen time plus the
+channel's staleness window. Deadlines sit in a min-heap, and a scheduler
+thread sleeps until the earliest one passes, then publishes the same insight
+the analyze endpoints would report. Collected records move a sender's
+deadline forward; superseded heap entries are skipped when popped.
+
+Subscribers either long-poll for alerts newer than the last id they saw, or
+keep a server-sent events stream open. Alert ids are prefixed with the time
+the process started, so they keep increasing across restarts; an id from the
+future (e.g. from a server with its clock set ahead) replays the history.
+
+Each channel saves the time up to which its deadlines have been handled next
+to its data file ("sms_data.alerts"). A deadline that had already passed by
+then is not published again, so restarting the server or rebuilding the
+indexes does not fire every stale sender a second time, while senders that
+went stale while the server was down are still reported.
+"""
+from collections import deque
+from datetime import datetime
+import heapq
+import json
+import os
+import threading
+import time
+
+from flask import Response, jsonify
+
+from index import format_timestamp, to_epoch
+from query import QueryError
+
+# Alerts kept for subscribers that reconnect
+ALERT_HISTORY = 10000
+
+# Longest long-poll wait (seconds)
+MAX_POLL_TIMEOUT = 60
+
+# Interval between keep-alive comments on idle event streams (seconds)
+KEEPALIVE_INTERVAL = 15
+
+# Longest scheduler sleep, so wall-clock changes are picked up (seconds)
+MAX_SLEEP = 60
+
+# Alert ids per second of process start time, so ids of a later process are higher
+ID_EPOCH_SCALE = 1000000
+
+# Longest interval between saves of a channel's handled time (seconds)
+SAVE_INTERVAL = 60
+
+
+class AlertEngine:
+    """
+    Scheduler firing staleness alerts when sender deadlines pass.
+    """
+
+    def __init__(self, history=ALERT_HISTORY):
+        self._channels = {}
+        self._heap = []
+        self._deadlines = {}
+        self._alerts = deque(maxlen=history)
+        self._last_id = int(time.time()) * ID_EPOCH_SCALE
+        self._cond = threading.Condition()
+        self._thread = None
+
+        # Time up to which each channel's deadlines were handled, and where it is saved
+        self._handled = {}
+        self._state_paths = {}
+        self._loaded = set()
+        self._saved = 0.0
+
+    def register(self, channel, window, message, state_path=None):
+        """
+        Function to add a channel with its staleness window (seconds) and insight
+        message (formatted with the sender), and start the scheduler.
+        With state_path, the time up to which deadlines were handled is kept
+        in that file, so restarts do not fire the same deadlines again.
+        """
+        with self._cond:
+            self._channels[channel] = (window, message)
+            if state_path is not None:
+                self._state_paths[channel] = state_path
+                self._handled[channel] = _read_handled(state_path)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="alert-scheduler")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def update(self, channel, last_seen, reset=False):
+        """
+        Function to set the deadlines of senders from their last-seen times.
+        With reset, senders not in last_seen are dropped from the channel.
+        """
+        window = self._channels[channel][0]
+        with self._cond:
+            self._loaded.add(channel)
+            if reset:
+                for key in [key for key in self._deadlines if key[0] == channel and key[1] not in last_seen]:
+                    del self._deadlines[key]
+            for sender, last in last_seen.items():
+                key = (channel, sender)
+                deadline = last + window
+
+                # An unchanged deadline keeps its entry, so it does not fire twice
+                if self._deadlines.get(key) != deadline:
+                    self._deadlines[key] = deadline
+                    heapq.heappush(self._heap, (deadline, channel, sender))
+            self._cond.notify_all()
+
+    def _run(self):
+        """
+        Function run by the scheduler thread to fire alerts as deadlines pass.
+        """
+        with self._cond:
+            while True:
+                now = to_epoch(datetime.now())
+
+                # A sender is stale once its last contact is older than now minus the window
+                published = False
+                while self._heap and self._heap[0][0] < now:
+                    deadline, channel, sender = heapq.heappop(self._heap)
+                    handled = self._handled.get(channel)
+                    if self._deadlines.get((channel, sender)) == deadline and (handled is None or deadline > handled):
+                        self._publish(deadline, channel, sender)
+                        published = True
+
+                # Every deadline before now is handled once the channel's senders are known
+                for channel in self._loaded:
+                    self._handled[channel] = now
+                if published or time.monotonic() - self._saved >= SAVE_INTERVAL:
+                    self._save_handled()
+
+                # Drop superseded entries once they outnumber the live ones
+                if len(self._heap) > 2 * len(self._deadlines) + 1000:
+                    self._heap = [
+                        (deadline, channel, sender) for (channel, sender), deadline in self._deadlines.items()
+                        if deadline >= now
+                    ]
+                    heapq.heapify(self._heap)
+
+                timeout = MAX_SLEEP
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now + 1)
+                self._cond.wait(timeout)
+
+    def _save_handled(self):
+        """
+        Function to save the handled time of every channel with a state file.
+        """
+        self._saved = time.monotonic()
+        for channel, path in self._state_paths.items():
+            if channel not in self._loaded:
+                continue
+            try:
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"handled": self._handled[channel]}, f)
+                os.replace(tmp_path, path)
+            except OSError:
+                # Worst case, a restart fires this channel's recent deadlines again
+                continue
+
+    def _publish(self, deadline, channel, sender):
+        window, message = self._channels[channel]
+        self._last_id += 1
+        self._alerts.append({
+            "id": self._last_id,
+            "channel": channel,
+            "sender": sender,
+            "last_seen": format_timestamp(deadline - window),
+            "stale_since": format_timestamp(deadline),
+            "insight": message.format(sender=sender)
+        })
+        self._cond.notify_all()
+
+    def wait(self, after=0, timeout=0, channel=None):
+        """
+        Function to get the alerts with an id above after, waiting up to timeout
+        seconds for one to fire if there are none yet. An after beyond the last
+        id given out is from an unknown process, so the history is replayed.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if after > self._last_id:
+                after = 0
+            while True:
+                alerts = [
+                    alert for alert in self._alerts
+                    if alert["id"] > after and (channel is None or alert["channel"] == channel)
+                ]
+                remaining = deadline - time.monotonic()
+                if alerts or remaining <= 0:
+                    return alerts
+                self._cond.wait(remaining)
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+
+def _read_handled(path):
+    """
+    Function to read a channel's saved handled time, or None if it was never saved.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["handled"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+# Engine shared by every app in the process
+alert_engine = AlertEngine()
+
+
+class StalenessMonitor:
+    """
+    Store listener feeding a channel's last-seen times to the alert engine.
+    Subscribe it after the channel's SenderIndex, which it reads the times from.
+    With the channel's store, the handled time is saved next to its data file.
+    """
+
+    def __init__(self, channel, index, days, message, store=None, engine=alert_engine):
+        self.channel = channel
+        self.index = index
+        self.engine = engine
+        state_path = os.path.splitext(store.path)[0] + ".alerts" if store is not None else None
+        engine.register(channel, int(days * 86400), message, state_path)
+
+    def rebuild(self, records):
+        self.engine.update(self.channel, self.index.last_seen_times(), reset=True)
+
+    def rebuild_snapshot(self, snapshot):
+        self.rebuild(snapshot)
+
+    def add(self, records):
+        senders = {
+            record["sender"] for record in records
+            if isinstance(record, dict) and isinstance(record.get("sender"), str)
+        }
+        self.engine.update(self.channel, self.index.last_seen_times(senders))
+
+
+def parse_alert_args(args):
+    """
+    Function to read the after and timeout parameters of an alerts request.
+    """
+    try:
+        after = int(args.get("after", 0))
+        timeout = float(args.get("timeout", 0))
+    except ValueError:
+        raise QueryError("Invalid after or timeout. Must be numbers")
+    if after < 0 or timeout < 0:
+        raise QueryError("Invalid after or timeout. Must be numbers")
+    return after, min(timeout, MAX_POLL_TIMEOUT)
+
+
+def poll_alerts(channel, args, engine=alert_engine):
+    """
+    Function to build the long-poll response of an alerts endpoint.
+    """
+    after, timeout = parse_alert_args(args)
+    alerts = engine.wait(after, timeout, channel)
+    last_id = alerts[-1]["id"] if alerts else engine.last_id
+    return jsonify({"status": "success", "alerts": alerts, "last_id": last_id})
+
+
+def stream_alerts(channel, args, last_event_id=None, engine=alert_engine):
+    """
+    Function to build the server-sent events response of an alerts endpoint.
+    Reconnecting clients resume after the Last-Event-ID they send.
+    """
+    after, _ = parse_alert_args(args)
+    if last_event_id:
+        after, _ = parse_alert_args({"after": last_event_id})
+
+    def events(after):
+        while True:
+            alerts = engine.wait(after, KEEPALIVE_INTERVAL, channel)
+            if not alerts:
+                yield ": keep-alive\n\n"
+                continue
+            for alert in alerts:
+                yield f"id: {alert['id']}\nevent: stale\ndata: {json.dumps(alert)}\n\n"
+            after = alerts[-1]["id"]
+
+    return Response(events(after), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
@@ -0,0 +1,457 @@
+"""
+Time-partitioned cold storage for records older than the active window.
+
+Archiving is off unless ACTIVE_DAYS is set (COLLECTOR_ACTIVE_DAYS). Then
+every store keeps only the records of the last ACTIVE_DAYS (rounded down to
+a partition boundary), and a maintenance pass moves older records out of the
+store into one segment file per day or week under "<store>.segments/",
+compresses segments once they are COMPRESS_AFTER_DAYS old (zstd if the
+zstandard package is installed, gzip otherwise), and retires segments past
+RETENTION_DAYS, deleting them or moving them to "retired/".
+
+A manifest lists the segments with their time bounds and a per-sender
+summary (last seen and type counts). It is the single commit point of a
+maintenance pass: segments are written under new file names and only
+become visible with the manifest naming them, which also records the pass's
+cutoff as pending until the store has been trimmed. While a cutoff is
+pending (or if the process died before the trim), readers skip the store's
+copies of records older than it, so no record is seen twice, and the next
+pass finishes the trim. SenderIndex folds in the summaries, so
+the analyze handlers still see every sender without opening a segment, and
+DedupIndex hashes the archived records too, so a retried sync of an archived
+record is still a duplicate. Time-ranged reads open only the segments
+overlapping the range; archived records get negative record numbers in
+cursors, so they page in line with the stored ones.
+
+Search, threads, reply times, unanswered messages and the analytics rollups
+are built from the stored records only, so with archiving on they cover the
+active window and nothing older. Leave it off where they must cover the
+whole history.
+
+Run by hand with:
+    python archive.py call_log_data.json sms_data.json email_data.json
+"""
+from datetime import datetime
+import gzip
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from config import ACTIVE_DAYS, COMPRESS_AFTER_DAYS, PARTITION, RETENTION_DAYS, RETENTION_POLICY
+from index import format_timestamp, indexable, parse_timestamp, to_epoch
+from storage import encode_record
+
+# Length of each partition (seconds)
+PARTITION_SIZES = {
+    "day": 86400,
+    "week": 7 * 86400
+}
+
+# Interval between maintenance passes (seconds)
+MAINTENANCE_INTERVAL = 3600
+
+# Bits of an archived record number holding its position in the segment
+POSITION_BITS = 32
+
+# Record field holding the type/direction, keyed by data file
+TYPE_FIELDS = {
+    "call_log_data.json": "log_type",
+    "sms_data.json": "type",
+    "email_data.json": "type"
+}
+
+
+def partition_start(timestamp, partition):
+    """
+    Function to get the start (epoch seconds) of the day or week holding a timestamp.
+    """
+    day = timestamp // 86400
+    if partition == "week":
+        # 1970-01-01 was a Thursday; weeks start on Monday
+        day -= (day + 3) % 7
+    return day * 86400
+
+
+def record_time(record):
+    """
+    Function to get the time of a record in epoch seconds, or None if it has no valid datetime.
+    """
+    try:
+        return parse_timestamp(record["datetime"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _compress(data, compression):
+    if compression == "zst":
+        return zstandard.ZstdCompressor().compress(data)
+    if compression == "gz":
+        return gzip.compress(data)
+    return data
+
+
+def _decompress(data, compression):
+    if compression == "zst":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == "gz":
+        return gzip.decompress(data)
+    return data
+
+
+class SegmentArchive:
+    """
+    Day or week segments holding the records moved out of a store.
+    """
+
+    def __init__(self, store, type_field, partition=PARTITION, active_days=ACTIVE_DAYS,
+                 compress_after_days=COMPRESS_AFTER_DAYS, retention_days=RETENTION_DAYS,
+                 retention_policy=RETENTION_POLICY):
+        if partition not in PARTITION_SIZES:
+            raise ValueError(f"Unknown partition '{partition}'")
+        self.store = store
+        self.type_field = type_field
+        self.partition = partition
+        self.active_days = active_days
+        self.compress_after_days = compress_after_days
+        self.retention_days = retention_days
+        self.retention_policy = retention_policy
+        self.directory = os.path.splitext(store.path)[0] + ".segments"
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+        self._lock = threading.RLock()
+        self._segments = {}
+        self._next_id = 0
+        self._pending = None
+        self._manifest_id = None
+        self._thread = None
+
+    def _refresh(self):
+        """
+        Function to load the manifest if it changed, e.g. in another process.
+        """
+        try:
+            stat = os.stat(self.manifest_path)
+            manifest_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            manifest_id = None
+        if manifest_id == self._manifest_id:
+            return
+
+        manifest = {"next_id": 0, "segments": []}
+        if manifest_id is not None:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        self._segments = {entry["start"]: entry for entry in manifest["segments"]}
+        self._next_id = manifest["next_id"]
+        self._pending = manifest.get("pending")
+        self._manifest_id = manifest_id
+
+    def _write_manifest(self):
+        manifest = {
+            "partition": self.partition,
+            "next_id": self._next_id,
+            "pending": self._pending,
+            "segments": sorted(self._segments.values(), key=lambda entry: entry["start"])
+        }
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_id = None
+        self._refresh()
+
+    def _remove_unreferenced(self):
+        """
+        Function to delete the segment files the manifest no longer names, including
+        earlier versions of rewritten segments and files left by an interrupted pass.
+        """
+        keep = {entry["file"] for entry in self._segments.values()}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.split("-", 1)[0] in PARTITION_SIZES and name not in keep and os.path.isfile(path):
+                os.remove(path)
+
+    def _read_segment(self, entry):
+        """
+        Function to load the records of a segment, in the order they were archived.
+        """
+        with open(os.path.join(self.directory, entry["file"]), "rb") as f:
+            data = _decompress(f.read(), entry["compression"])
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    def _write_segment(self, entry, records, compression):
+        """
+        Function to write the records of a segment and update its manifest entry.
+        The segment gets a new file name, so readers keep the previous version until
+        the manifest is written.
+        """
+        version = entry.get("version", 0) + 1
+        name = f"{self.partition}-{format_timestamp(entry['start'])[:10]}.{version}.jsonl"
+        if compression:
+            name += "." + compression
+        data = _compress("".join(encode_record(record) for record in records).encode("utf-8"), compression)
+
+        tmp_path = os.path.join(self.directory, name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+        # Per-sender summary, so that SenderIndex never opens the segment
+        senders = {}
+        for record in records:
+            sender, record_type = record.get("sender"), record.get(self.type_field)
+            if not isinstance(sender, str) or not indexable(record_type):
+                # Left out of SenderIndex too
+                continue
+            summary = senders.setdefault(sender, [None, {}])
+            timestamp = record_time(record)
+            if summary[0] is None or timestamp > summary[0]:
+                summary[0] = timestamp
+            summary[1][record_type] = summary[1].get(record_type, 0) + 1
+        entry.update(file=name, version=version, compression=compression, count=len(records), bytes=len(data),
+                     senders=senders)
+
+    def _compression(self):
+        return "zst" if zstandard is not None else "gz"
+
+    def add(self, records, cutoff=None):
+        """
+        Function to archive records, all with a valid datetime, into their segments.
+        Records already in their segment are skipped, so an interrupted pass can be run again.
+        With a cutoff, the store still holds the records older than it until the pass
+        clears it (see maintain), so readers skip those.
+        """
+        with self._lock:
+            self._refresh()
+            os.makedirs(self.directory, exist_ok=True)
+            size = PARTITION_SIZES[self.partition]
+
+            partitions = {}
+            for record in records:
+                partitions.setdefault(partition_start(record_time(record), self.partition), []).append(record)
+
+            for start, new_records in sorted(partitions.items()):
+                entry = self._segments.get(start)
+                if entry is None:
+                    entry = self._segments[start] = {"id": self._next_id, "start": start, "end": start + size}
+                    self._next_id += 1
+                    existing = []
+                else:
+                    existing = self._read_segment(entry)
+                lines = {encode_record(record) for record in existing}
+                records = existing + [record for record in new_records if encode_record(record) not in lines]
+                self._write_segment(entry, records, entry.get("compression", ""))
+            if cutoff is not None:
+                self._pending = cutoff if self._pending is None else max(self._pending, cutoff)
+            self._write_manifest()
+            self._remove_unreferenced()
+
+    def records(self):
+        """
+        Function to yield every archived record, one segment at a time.
+        """
+        with self._lock:
+            self._refresh()
+            entries = sorted(self._segments.values(), key=lambda entry: entry["start"])
+        for entry in entries:
+            yield from self._read_segment(entry)
+
+    def pending_cutoff(self):
+        """
+        Function to get the time (epoch seconds) before which the store's records are
+        already archived but not yet removed from it, or None.
+        """
+        with self._lock:
+            self._refresh()
+            return self._pending
+
+    def senders(self):
+        """
+        Function to get every archived sender's last-seen time (epoch seconds) and type counts.
+        """
+        with self._lock:
+            self._refresh()
+            merged = {}
+            for entry in self._segments.values():
+                for sender, (last_seen, counts) in entry["senders"].items():
+                    summary = merged.setdefault(sender, [last_seen, {}])
+                    summary[0] = max(summary[0], last_seen)
+                    for record_type, count in counts.items():
+                        summary[1][record_type] = summary[1].get(record_type, 0) + count
+            return {sender: (last_seen, counts) for sender, (last_seen, counts) in merged.items()}
+
+    def query(self, sender=None, record_type=None, start=None, end=None, after=None, limit=None):
+        """
+        Function to find matching archived records in time order, opening only the
+        segments that overlap the range. Takes the same filters as TimeIndex.query().
+        Returns (key, record) pairs, where keys are (timestamp, record number) with
+        negative record numbers.
+        """
+        with self._lock:
+            self._refresh()
+            entries = sorted(self._segments.values(), key=lambda entry: entry["start"])
+
+        lower = start
+        if after is not None:
+            lower = after[0] if lower is None else max(lower, after[0])
+
+        results = []
+        for entry in entries:
+            if end is not None and entry["start"] > end:
+                break
+            if lower is not None and entry["end"] <= lower:
+                continue
+
+            # Later segments only hold later records
+            if limit is not None and len(results) >= limit and entry["start"] > results[-1][0][0]:
+                break
+            if sender is not None and sender not in entry["senders"]:
+                continue
+
+            for position, record in enumerate(self._read_segment(entry)):
+                timestamp = record_time(record)
+                key = (timestamp, -((entry["id"] << POSITION_BITS) | position) - 1)
+                if (start is not None and timestamp < start) or (end is not None and timestamp > end) \
+                        or (after is not None and key <= after):
+                    continue
+                if (sender is not None and record.get("sender") != sender) \
+                        or (record_type is not None and record.get(self.type_field) != record_type):
+                    continue
+                results.append((key, record))
+            results.sort(key=lambda item: item[0])
+            if limit is not None:
+                del results[limit:]
+        return results
+
+    def has_segments(self):
+        """
+        Function to check whether any records have been archived.
+        """
+        with self._lock:
+            self._refresh()
+            return bool(self._segments)
+
+    def _retire(self, now):
+        """
+        Function to delete or move away the segments past the retention horizon.
+        Returns whether any segment was retired.
+        """
+        if not self.retention_days:
+            return False
+        horizon = now - self.retention_days * 86400
+        expired = [entry for entry in self._segments.values() if entry["end"] <= horizon]
+        if not expired:
+            return False
+        for entry in expired:
+            del self._segments[entry["start"]]
+        self._write_manifest()
+
+        # Once no longer listed, the files are moved away or deleted
+        if self.retention_policy != "delete":
+            retired = os.path.join(self.directory, "retired")
+            os.makedirs(retired, exist_ok=True)
+            for entry in expired:
+                shutil.move(os.path.join(self.directory, entry["file"]), os.path.join(retired, entry["file"]))
+        self._remove_unreferenced()
+        return bool(expired)
+
+    def _compress_old(self, now):
+        """
+        Function to compress the uncompressed segments older than COMPRESS_AFTER_DAYS.
+        """
+        horizon = now - self.compress_after_days * 86400
+        changed = False
+        for entry in self._segments.values():
+            if not entry["compression"] and entry["end"] <= horizon:
+                self._write_segment(entry, self._read_segment(entry), self._compression())
+                changed = True
+        if changed:
+            self._write_manifest()
+            self._remove_unreferenced()
+
+    def maintain(self, now=None):
+        """
+        Function to run a maintenance pass: retire expired segments, move records
+        older than the active window out of the store, and compress old segments.
+        Returns the number of records moved.
+        """
+        now = to_epoch(now or datetime.now())
+        with self._lock:
+            self._refresh()
+            retired = self._retire(now)
+
+            # Finish the trim of an interrupted pass, even with archiving turned off since
+            moved = 0
+            cutoff = self._pending
+            if self.active_days:
+                cutoff = max(cutoff or 0, partition_start(now - self.active_days * 86400, self.partition))
+            if cutoff is not None:
+                def is_old(record):
+                    timestamp = record_time(record)
+                    return timestamp is not None and timestamp < cutoff
+
+                moved = self.store.evict(is_old, lambda records: self.add(records, cutoff))
+
+                # The store no longer holds the archived records
+                if self._pending is not None:
+                    self._pending = None
+                    self._write_manifest()
+
+            # Indexes folding in the archive must forget retired segments
+            if retired and not moved:
+                self.store.reindex()
+
+            if self._segments:
+                self._compress_old(now)
+            return moved
+
+    def start_maintenance(self, interval=MAINTENANCE_INTERVAL):
+        """
+        Function to run maintenance passes in a background thread, starting now.
+        Only the process writing the store may run them.
+        """
+        def run():
+            while True:
+                try:
+                    self.maintain()
+                except Exception as e:
+                    print(f"Maintenance of {self.store.path} failed: {e}", file=sys.stderr)
+                time.sleep(interval)
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=run, name="archive-maintenance")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stats(self):
+        """
+        Function to report the archived segments and their size on disk.
+        """
+        with self._lock:
+            self._refresh()
+            return {
+                "segments": len(self._segments),
+                "archived_records": sum(entry["count"] for entry in self._segments.values()),
+                "archived_bytes": sum(entry["bytes"] for entry in self._segments.values()),
+                "compressed_segments": sum(1 for entry in self._segments.values() if entry["compression"])
+            }
+
+
+if __name__ == '__main__':
+    from storage import open_store
+
+    for legacy_path in sys.argv[1:]:
+        archive = SegmentArchive(open_store(legacy_path, compact_every=0), TYPE_FIELDS[os.path.basename(legacy_path)])
+        moved = archive.maintain()
+        print(f"Moved {moved} records from {archive.store.path} into {archive.directory}: {archive.stats()}")
@@ -0,0 +1,427 @@
+"""
+Benchmark and load-test harness for the call, SMS and email collectors.
+
+For every source and dataset size, a synthetic dataset is generated with
+the collectors' own generators into a scratch directory. Each endpoint is
+then driven in-process (Flask test client) and over local HTTP with
+concurrent clients. p50/p99 latency, throughput and peak RSS are reported
+per endpoint and written to a JSON file that later runs can be compared
+against.
+
+With --fast-data, datasets are written by datagen.py (NumPy) instead,
+which is needed for the multi-million record sizes.
+
+Usage:
+    python bench.py --sizes 1000,100000 --clients 8 --output bench_results.json
+    python bench.py --sizes 1000000,10000000 --fast-data --skew 1.1
+    python bench.py --sizes 1000 --compare bench_results.json
+"""
+import argparse
+from datetime import datetime
+import http.client
+import importlib
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Default dataset sizes (records per source)
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000, 10000000]
+
+# Records posted per request by the batch collect endpoints
+BATCH_RECORDS = 100
+
+# Largest dataset for which the unpaginated get endpoint is benchmarked
+MAX_FULL_GET_SIZE = 100000
+
+# Relative p99 increase reported as a regression by --compare
+REGRESSION_THRESHOLD = 0.2
+
+# Per-source module, store and endpoint names
+SOURCES = {
+    "call": {
+        "module": "call",
+        "store": "call_log_store",
+        "collect": "/collect_call_log",
+        "collect_batch": "/collect_call_log_batch",
+        "get": "/get_call_logs",
+        "analyze": "/analyze_call_logs"
+    },
+    "sms": {
+        "module": "sms",
+        "store": "sms_store",
+        "collect": "/collect_sms",
+        "collect_batch": "/collect_sms_batch",
+        "get": "/get_sms_data",
+        "analyze": "/analyze_sms"
+    },
+    "email": {
+        "module": "email_log",
+        "store": "email_store",
+        "collect": "/collect_email",
+        "collect_batch": "/collect_email_batch",
+        "get": "/get_email_data",
+        "analyze": "/analyze_emails"
+    }
+}
+
+
+def generate_records(module, source, count):
+    """
+    Function to yield count synthetic records using the collector's own generator.
+    """
+    current_time = datetime.now()
+    produced = 0
+    while produced < count:
+        if source == "call":
+            records = [module.generate_call_log_entry(current_time)]
+        elif source == "sms":
+            records = module.generate_sms_conversation(current_time)
+        else:
+            records = module.generate_email_thread(current_time)
+        for record in records[:count - produced]:
+            yield record
+            produced += 1
+
+
+def percentile(sorted_values, fraction):
+    """
+    Function to read a percentile from sorted values.
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def reset_peak_rss():
+    """
+    Function to reset the process's peak RSS counter (Linux only).
+    Returns False when peak RSS can only be reported for the whole run.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_kb():
+    """
+    Function to read the process's peak RSS in KiB.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+class HttpClient:
+    """
+    Keep-alive HTTP client for one benchmark thread.
+    """
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port)
+
+    def request(self, method, path, body=None):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+
+class TestClient:
+    """
+    In-process client wrapping a Flask test client.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, data=body, content_type="application/json")
+        response.get_data()
+        return response.status_code
+
+
+def run_load(make_client, make_request, requests, clients):
+    """
+    Function to send requests from concurrent clients and measure latency.
+    make_request(i) returns (method, path, body) for request number i.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        client = make_client()
+        local = []
+        failed = 0
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            method, path, body = make_request(i)
+            start = time.perf_counter()
+            try:
+                status = client.request(method, path, body)
+            except Exception:
+                status = 0
+            local.append(time.perf_counter() - start)
+            if status >= 400 or status == 0:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    reset = reset_peak_rss()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "p50_ms": 1000 * percentile(latencies, 0.50),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "peak_rss_kb": peak_rss_kb(),
+        "peak_rss_scope": "endpoint" if reset else "process"
+    }
+
+
+def start_http_server(app):
+    """
+    Function to serve an app on a free local port in a background thread.
+    """
+    from werkzeug.serving import make_server
+
+    # Keep per-request access logs out of the measurements
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def scenarios(module, source, size, requests):
+    """
+    Function to list (name, make_request, request count) for every endpoint of a source.
+    """
+    endpoints = SOURCES[source]
+
+    def collect(i):
+        record = next(generate_records(module, source, 1))
+        return "POST", endpoints["collect"], json.dumps(record)
+
+    def collect_batch(i):
+        return "POST", endpoints["collect_batch"], json.dumps(list(generate_records(module, source, BATCH_RECORDS)))
+
+    def get_page(i):
+        return "GET", endpoints["get"] + "?limit=100", None
+
+    def get_all(i):
+        return "GET", endpoints["get"], None
+
+    def analyze(i):
+        return "GET", endpoints["analyze"], None
+
+    result = [
+        ("collect", collect, requests),
+        ("collect_batch", collect_batch, max(1, requests // 10)),
+        ("get_page", get_page, requests),
+        ("analyze", analyze, requests)
+    ]
+    if size <= MAX_FULL_GET_SIZE:
+        result.append(("get_all", get_all, max(1, requests // 10)))
+    return result
+
+
+def load_dataset(module, store, source, size, fast_data, skew):
+    """
+    Function to fill a store with a synthetic dataset and rebuild its indexes.
+    """
+    if fast_data:
+        import datagen
+
+        datagen.generate(source, size, os.path.dirname(os.path.abspath(store.path)), skew=skew)
+        store.refresh()
+    else:
+        store.replace(generate_records(module, source, size))
+
+
+def bench_source(source, size, modes, clients, requests, fast_data=False, skew=0.0):
+    """
+    Function to benchmark every endpoint of one source at one dataset size.
+    Must run inside a scratch directory, since the collectors store data in the working directory.
+    """
+    module = importlib.import_module(SOURCES[source]["module"])
+    store = getattr(module, SOURCES[source]["store"])
+
+    # Load the dataset, streaming it to disk and rebuilding the indexes
+    start = time.perf_counter()
+    load_dataset(module, store, source, size, fast_data, skew)
+    load_seconds = time.perf_counter() - start
+
+    results = []
+    for mode in modes:
+        server = None
+        if mode == "http":
+            server = start_http_server(module.app)
+            make_client = lambda: HttpClient(server.server_port)
+        else:
+            make_client = lambda: TestClient(module.app)
+
+        try:
+            for name, make_request, count in scenarios(module, source, size, requests):
+                # Restore the dataset size after collects grew it
+                if len(store) != size:
+                    load_dataset(module, store, source, size, fast_data, skew)
+                stats = run_load(make_client, make_request, count, clients)
+                stats.update({"source": source, "size": size, "mode": mode, "endpoint": name})
+                results.append(stats)
+                print(f"{source:5} {size:>9} {mode:9} {name:13} p50={stats['p50_ms']:8.2f}ms "
+                      f"p99={stats['p99_ms']:8.2f}ms {stats['throughput_rps']:9.1f} req/s "
+                      f"rss={stats['peak_rss_kb'] // 1024}MiB errors={stats['errors']}")
+        finally:
+            if server is not None:
+                server.shutdown()
+
+    return results, load_seconds
+
+
+def run_case(source, size, modes, clients, requests, fast_data=False, skew=0.0):
+    """
+    Function to benchmark one source and size in a fresh process and scratch directory.
+    A fresh process keeps peak RSS and index state from leaking between cases.
+    """
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        command = [
+            sys.executable, os.path.abspath(__file__), "--worker",
+            "--sources", source, "--sizes", str(size), "--modes", ",".join(modes),
+            "--clients", str(clients), "--requests", str(requests), "--skew", str(skew)
+        ]
+        if fast_data:
+            command.append("--fast-data")
+        output = subprocess.run(command, cwd=workdir, env=dict(os.environ, PYTHONPATH=REPO_DIR),
+                                stdout=subprocess.PIPE, check=True, text=True).stdout
+        lines = output.splitlines()
+        print("\n".join(lines[:-1]))
+        return json.loads(lines[-1])
+
+
+def git_revision():
+    """
+    Function to identify the benchmarked code.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(previous_path, results):
+    """
+    Function to print endpoints whose p99 latency regressed against a previous run.
+    """
+    with open(previous_path) as f:
+        previous = {
+            (r["source"], r["size"], r["mode"], r["endpoint"]): r for r in json.load(f)["results"]
+        }
+
+    regressions = 0
+    for result in results:
+        key = (result["source"], result["size"], result["mode"], result["endpoint"])
+        before = previous.get(key)
+        if not before or not before["p99_ms"]:
+            continue
+        change = (result["p99_ms"] - before["p99_ms"]) / before["p99_ms"]
+        if change > REGRESSION_THRESHOLD:
+            regressions += 1
+            print(f"REGRESSION {' '.join(map(str, key))}: p99 {before['p99_ms']:.2f}ms -> "
+                  f"{result['p99_ms']:.2f}ms ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the collect/get/analyze endpoints.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="comma-separated dataset sizes")
+    parser.add_argument("--sources", default="call,sms,email", help="comma-separated sources")
+    parser.add_argument("--modes", default="inprocess,http", help="comma-separated modes: inprocess, http")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--output", default="bench_results.json", help="file to write the results to")
+    parser.add_argument("--compare", help="previous results file to check for p99 regressions")
+    parser.add_argument("--fast-data", action="store_true", help="generate datasets with datagen.py (requires NumPy)")
+    parser.add_argument("--skew", type=float, default=0.0, help="sender skew for --fast-data datasets")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    sources = args.sources.split(",")
+    modes = args.modes.split(",")
+
+    # Worker process: run one case in the current directory and print JSON results last
+    if args.worker:
+        results, load_seconds = bench_source(sources[0], sizes[0], modes, args.clients, args.requests,
+                                             args.fast_data, args.skew)
+        print(json.dumps({"results": results, "load_seconds": load_seconds}))
+        return
+
+    results = []
+    load_times = []
+    for source in sources:
+        for size in sizes:
+            case = run_case(source, size, modes, args.clients, args.requests, args.fast_data, args.skew)
+            results.extend(case["results"])
+            load_times.append({"source": source, "size": size, "load_seconds": case["load_seconds"]})
+
+    report = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "clients": args.clients,
+        "requests": args.requests,
+        "fast_data": args.fast_data,
+        "skew": args.skew,
+        "load_times": load_times,
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results saved to {args.output}")
+
+    if args.compare and compare(args.compare, results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
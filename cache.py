@@ -0,0 +1,122 @@
+"""
+Response caching with ETags for the get_* and analyze_* endpoints.
+
+A response is identified by its path, its query parameters and the version
+of every store it reads, which RecordStore bumps on each commit. Views whose
+output also depends on the current time (analyze) pass an expires function
+returning a value that changes whenever the result would. The ETag is a
+hash of all of that, so polls of unchanged data get a 304 without running
+the view, and other repeated requests are served from a memory-bounded LRU.
+"""
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import threading
+
+from flask import Response, make_response, request
+
+# Total size of cached response bodies (bytes)
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    Least recently used cache of response bodies, bounded by their total size.
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Function to get a cached (body, mimetype) pair, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, mimetype):
+        """
+        Function to cache a response body, evicting the least recently used ones to stay in bounds.
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._entries[key] = (body, mimetype)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        """
+        Function to drop every cached response.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+# Cache shared by every app in the process
+response_cache = ResponseCache()
+
+
+def response_etag(stores, expires):
+    """
+    Function to compute the ETag of the current request from the data it depends on.
+    """
+    key = repr((
+        request.path,
+        sorted(request.args.items(multi=True)),
+        [store.version for store in stores],
+        expires(request.args) if expires is not None else None
+    ))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def cached(stores, expires=None, cache=response_cache):
+    """
+    Decorator to serve a GET view with ETags, 304 responses and the response cache.
+    Only 200 responses are cached, and streamed responses are never stored.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                etag = response_etag(stores, expires)
+            except Exception:
+                # Let the view report invalid parameters
+                return view(*args, **kwargs)
+
+            # The client already has this version
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                entry = cache.get(etag)
+                if entry is not None:
+                    response = Response(entry[0], mimetype=entry[1])
+                else:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if not response.is_streamed:
+                        cache.put(etag, response.get_data(), response.mimetype)
+
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return wrapper
+    return decorator
@@ -1,60 +1,125 @@
 from flask import Flask, request, jsonify
+from werkzeug.serving import is_running_from_reloader
 from datetime import datetime, timedelta
-import json
-import os
 import random
 import threading
 import time
 
+from alerts import StalenessMonitor, poll_alerts, stream_alerts
+from archive import SegmentArchive
+from cache import cached
+from config import DEBUG
+from dedup import DEDUP_FIELDS, DedupIndex
+from index import SenderIndex, TimeIndex, format_timestamp, parse_timestamp, to_epoch
+from ingest import PayloadError, collect_batch, read_batch
+from metrics import instrument, phase
+from pools import CALL_TYPES, DUMMY_SENDERS
+from query import QueryError, get_records, parse_days, staleness_expiry
+from rollups import RollupIndex
+from storage import open_store
+
 app = Flask(__name__)
 
+# Days without contact before a sender is reported as stale
+STALE_AFTER_DAYS = 7
+
+# Insight reported for a stale sender
+STALE_INSIGHT = "{sender} hasn't called in a while. Check on them!"
+
 # File to store collected call log data
 CALL_LOG_FILE = "call_log_data.json"
 
-# Ensure the data file exists
-if not os.path.exists(CALL_LOG_FILE):
-    with open(CALL_LOG_FILE, "w") as f:
-        json.dump([], f)
+# Append-only store for call log records (migrated from CALL_LOG_FILE on first use)
+call_log_store = open_store(CALL_LOG_FILE)
+
+# Day or week segments holding the call log records older than the active window
+call_log_archive = SegmentArchive(call_log_store, "log_type")
+
+# Request timers and store gauges, exposed on /metrics
+instrument(app, [call_log_store])
+
+# Per-sender last-seen times and type counts, kept up to date on every collect
+call_log_index = call_log_store.subscribe(SenderIndex("log_type", call_log_archive))
+
+# Time-ordered index used to filter and paginate retrieval
+call_log_times = call_log_store.subscribe(TimeIndex("log_type"))
+
+# Staleness alerts pushed to subscribers as senders go quiet
+call_log_alerts = call_log_store.subscribe(
+    StalenessMonitor("call", call_log_index, STALE_AFTER_DAYS, STALE_INSIGHT, call_log_store)
+)
 
-# List of dummy senders and call types
-DUMMY_SENDERS = ["Sarah", "Tom", "David", "Emma", "John", "Alice"]
-CALL_TYPES = ["incoming", "outgoing"]
+# Hourly and daily call counts per sender, for the analytics endpoint
+call_log_rollups = call_log_store.subscribe(RollupIndex("log_type"))
+
+# Hashes of the stored and archived call log records, so that retried syncs are not stored twice
+call_log_dedup = call_log_store.subscribe(DedupIndex(call_log_store, DEDUP_FIELDS[CALL_LOG_FILE], call_log_archive))
+
+def generate_call_log_entry(current_time):
+    """
+    Function to generate one dummy call log entry within the 7 days before current_time.
+    """
+    # Generate a random datetime within the last 7 days
+    random_time = current_time - timedelta(
+        days=random.randint(0, 7),
+        hours=random.randint(0, 23),
+        minutes=random.randint(0, 59),
+        seconds=random.randint(0, 59)
+    )
+
+    return {
+        "datetime": random_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "sender": random.choice(DUMMY_SENDERS),
+        "log_type": random.choice(CALL_TYPES)
+    }
 
 def generate_dummy_call_log():
     """
     Function to generate dummy call log data and save it to the file.
     """
     while True:
-        # Generate a random datetime within the last 7 days
-        current_time = datetime.now()
-        random_time = current_time - timedelta(
-            days=random.randint(0, 7),
-            hours=random.randint(0, 23),
-            minutes=random.randint(0, 59),
-            seconds=random.randint(0, 59)
-        )
-
         # Create a dummy call log entry
-        call_log_entry = {
-            "datetime": random_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "sender": random.choice(DUMMY_SENDERS),
-            "log_type": random.choice(CALL_TYPES)
-        }
-
-        # Load existing data
-        with open(CALL_LOG_FILE, "r") as f:
-            call_log_data = json.load(f)
+        call_log_entry = generate_call_log_entry(datetime.now())
 
         # Append new call log data
-        call_log_data.append(call_log_entry)
-
-        # Save updated data
-        with open(CALL_LOG_FILE, "w") as f:
-            json.dump(call_log_data, f, indent=4)
+        call_log_store.append(call_log_entry)
 
         # Wait for a random interval before generating the next call log (e.g., 1 to 10 seconds)
         time.sleep(random.randint(1, 10))
 
+def start_dummy_data():
+    """
+    Function to start the dummy call log generation thread.
+    """
+    dummy_data_thread = threading.Thread(target=generate_dummy_call_log)
+    dummy_data_thread.daemon = True  # Daemonize thread to stop it when the main program exits
+    dummy_data_thread.start()
+
+def validate_call_log(data):
+    """
+    Function to validate a call log record.
+    Returns an error message, or None if the record is valid.
+    """
+    # Validate required fields
+    if not isinstance(data, dict) or not all(key in data for key in ["datetime", "sender", "log_type"]):
+        return "Missing required fields"
+
+    # Validate the sender
+    if not isinstance(data["sender"], str):
+        return "Invalid sender. Must be a string"
+
+    # Validate log_type
+    if data["log_type"] not in ["incoming", "outgoing"]:
+        return "Invalid log_type. Must be 'incoming' or 'outgoing'"
+
+    # Parse datetime
+    try:
+        parse_timestamp(data["datetime"])
+    except (TypeError, ValueError):
+        return "Invalid datetime format. Use 'YYYY-MM-DD HH:MM:SS'"
+
+    return None
+
 @app.route('/collect_call_log', methods=['POST'])
 def collect_call_log():
     """
@@ -70,89 +135,131 @@ def collect_call_log():
         # Get JSON data from the request
         data = request.json
 
-        # Validate required fields
-        if not all(key in data for key in ["datetime", "sender", "log_type"]):
-            return jsonify({"status": "error", "message": "Missing required fields"}), 400
-
-        # Validate log_type
-        if data["log_type"] not in ["incoming", "outgoing"]:
-            return jsonify({"status": "error", "message": "Invalid log_type. Must be 'incoming' or 'outgoing'"}), 400
-
-        # Parse datetime
-        try:
-            datetime.strptime(data["datetime"], "%Y-%m-%d %H:%M:%S")
-        except ValueError:
-            return jsonify({"status": "error", "message": "Invalid datetime format. Use 'YYYY-MM-DD HH:MM:SS'"}), 400
+        # Validate the record
+        with phase("validate"):
+            error = validate_call_log(data)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
 
-        # Load existing data
-        with open(CALL_LOG_FILE, "r") as f:
-            call_log_data = json.load(f)
+        # Append new call log data, unless it was already collected (e.g. by a retried sync)
+        if call_log_dedup.extend([data]):
+            return jsonify({"status": "success", "message": "Call log data already collected", "duplicate": True}), 200
 
-        # Append new call log data
-        call_log_data.append(data)
+        return jsonify({"status": "success", "message": "Call log data collected successfully"}), 200
 
-        # Save updated data
-        with open(CALL_LOG_FILE, "w") as f:
-            json.dump(call_log_data, f, indent=4)
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        return jsonify({"status": "success", "message": "Call log data collected successfully"}), 200
+@app.route('/collect_call_log_batch', methods=['POST'])
+def collect_call_log_batch():
+    """
+    Endpoint to collect many call log records at once.
+    Accepts a JSON array of call log records, or NDJSON (one record per line)
+    with Content-Type: application/x-ndjson. Each record is validated like
+    /collect_call_log, and the accepted records are stored in one write. Records
+    already stored are counted as duplicates and not written again.
+    """
+    try:
+        entries = read_batch(request)
+    except PayloadError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
 
+    try:
+        return jsonify(collect_batch(call_log_store, entries, validate_call_log, call_log_dedup)), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/get_call_logs', methods=['GET'])
+@cached([call_log_store])
 def get_call_logs():
     """
-    Endpoint to retrieve all collected call log data.
+    Endpoint to retrieve collected call log data.
+    Optional query parameters:
+        sender=Sender Name
+        log_type=incoming/outgoing
+        start=YYYY-MM-DD HH:MM:SS, end=YYYY-MM-DD HH:MM:SS (inclusive range)
+        limit=N and cursor=<next_cursor from the previous page>
+        format=ndjson to stream the records as NDJSON
     """
     try:
-        with open(CALL_LOG_FILE, "r") as f:
-            call_log_data = json.load(f)
-        return jsonify({"status": "success", "data": call_log_data}), 200
+        return get_records(call_log_store, call_log_times, request.args, "log_type", call_log_archive), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/analyze_call_logs', methods=['GET'])
+@cached([call_log_store], expires=staleness_expiry(call_log_index, STALE_AFTER_DAYS))
 def analyze_call_logs():
     """
     Endpoint to analyze call logs and provide insights.
+    Optional query parameter: days=N, the number of days without a call before
+    a sender is reported (defaults to STALE_AFTER_DAYS). With keys=1, the
+    sender of every insight and the cutoff time are included too.
     """
     try:
-        with open(CALL_LOG_FILE, "r") as f:
-            call_log_data = json.load(f)
+        days = parse_days(request.args, STALE_AFTER_DAYS)
 
         # Get the current time
         current_time = datetime.now()
 
-        # Dictionary to store the last call time for each sender
-        last_call_times = {}
-
-        # Analyze call logs
-        for log in call_log_data:
-            sender = log["sender"]
-            log_time = datetime.strptime(log["datetime"], "%Y-%m-%d %H:%M:%S")
+        # Generate insights for senders with no call in the last N days
+        cutoff = to_epoch(current_time - timedelta(days=days))
+        senders = call_log_index.stale_senders(cutoff)
+        insights = []
+        for sender in senders:
+            insights.append(STALE_INSIGHT.format(sender=sender))
 
-            # Update the last call time for the sender
-            if sender not in last_call_times or log_time > last_call_times[sender]:
-                last_call_times[sender] = log_time
+        # Name the sender of every insight for the shard router, which merges them
+        response = {"status": "success", "insights": insights}
+        if request.args.get("keys") == "1":
+            response.update({"senders": senders, "cutoff": format_timestamp(cutoff)})
+        return jsonify(response), 200
 
-        # Generate insights
-        insights = []
-        for sender, last_call in last_call_times.items():
-            time_since_last_call = current_time - last_call
-            if time_since_last_call > timedelta(days=7):  # If no call in the last 7 days
-                insights.append(f"{sender} hasn't called in a while. Check on them!")
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        return jsonify({"status": "success", "insights": insights}), 200
+@app.route('/call_log_alerts', methods=['GET'])
+def get_call_log_alerts():
+    """
+    Endpoint to long-poll staleness alerts, fired as call log senders go quiet.
+    Optional query parameters:
+        after=<last_id from the previous response>
+        timeout=N seconds to wait for a new alert (up to 60)
+    """
+    try:
+        return poll_alerts("call", request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/call_log_alerts/stream', methods=['GET'])
+def stream_call_log_alerts():
+    """
+    Endpoint to subscribe to call log staleness alerts as server-sent events.
+    Optional query parameter: after=<id of the last alert received>; reconnecting
+    clients resume from their Last-Event-ID header.
+    """
+    try:
+        return stream_alerts("call", request.args, request.headers.get("Last-Event-ID")), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 if __name__ == '__main__':
-    # Start the dummy data generation thread
-    dummy_data_thread = threading.Thread(target=generate_dummy_call_log)
-    dummy_data_thread.daemon = True  # Daemonize thread to stop it when the main program exits
-    dummy_data_thread.start()
+    if DEBUG and not is_running_from_reloader():
+        # The reloader's child process serves the app, so it writes the store
+        call_log_store.close()
+    else:
+        # Start the dummy data generation thread
+        start_dummy_data()
+
+        # Move records older than the active window into segments, now and periodically
+        call_log_archive.start_maintenance()
 
     # Run the Flask app
-    app.run(debug=True)
+    app.run(debug=DEBUG)
@@ -0,0 +1,74 @@
+"""
+Serving and storage configuration for the collector services, read from the environment.
+
+    COLLECTOR_DEBUG    set to 0 to run the individual services without Flask debug
+                       mode (debugger and reloader); server.py never uses it
+    COLLECTOR_SERVER   server used by server.py: threaded, waitress or asgi; a server
+                       whose packages are not installed falls back to threaded
+    COLLECTOR_HOST     address to listen on
+    COLLECTOR_PORT     port to listen on
+    COLLECTOR_THREADS  request threads for server.py
+    COLLECTOR_METRICS  set to 0 to turn off request timing and the /metrics endpoint
+    COLLECTOR_PROFILE  set to 1 to start the sampling profiler at startup
+
+    COLLECTOR_PARTITION            segment length for archived records: day or week
+    COLLECTOR_ACTIVE_DAYS          days of records kept in the stores; older ones are
+                                   archived into segments (0, the default, keeps every
+                                   record; see archive.py for what archiving drops)
+    COLLECTOR_COMPRESS_AFTER_DAYS  age at which segments are compressed
+    COLLECTOR_RETENTION_DAYS       age at which segments are retired (0 keeps them forever)
+    COLLECTOR_RETENTION_POLICY     delete retired segments, or move them to "retired/"
+
+    COLLECTOR_SHARDS   shard worker processes started by shards.py (defaults to the CPU count)
+    COLLECTOR_ROUTERS  router processes started by shards.py
+"""
+import importlib.util
+import os
+import sys
+
+DEBUG = os.environ.get("COLLECTOR_DEBUG", "1") != "0"
+
+SERVER = os.environ.get("COLLECTOR_SERVER", "threaded")
+
+HOST = os.environ.get("COLLECTOR_HOST", "127.0.0.1")
+
+PORT = int(os.environ.get("COLLECTOR_PORT", "5000"))
+
+THREADS = int(os.environ.get("COLLECTOR_THREADS", "32"))
+
+METRICS = os.environ.get("COLLECTOR_METRICS", "1") != "0"
+
+PROFILE = os.environ.get("COLLECTOR_PROFILE", "0") == "1"
+
+PARTITION = os.environ.get("COLLECTOR_PARTITION", "week")
+
+ACTIVE_DAYS = int(os.environ.get("COLLECTOR_ACTIVE_DAYS", "0"))
+
+COMPRESS_AFTER_DAYS = int(os.environ.get("COLLECTOR_COMPRESS_AFTER_DAYS", "180"))
+
+RETENTION_DAYS = int(os.environ.get("COLLECTOR_RETENTION_DAYS", "0"))
+
+RETENTION_POLICY = os.environ.get("COLLECTOR_RETENTION_POLICY", "move")
+
+SHARDS = int(os.environ.get("COLLECTOR_SHARDS", os.cpu_count() or 1))
+
+ROUTERS = int(os.environ.get("COLLECTOR_ROUTERS", "1"))
+
+# Packages each server needs besides Flask (see requirements.txt)
+SERVER_PACKAGES = {
+    "threaded": [],
+    "waitress": ["waitress"],
+    "asgi": ["uvicorn", "asgiref"]
+}
+
+
+def resolve_server(server):
+    """
+    Function to get the server to run: the chosen one, or the threaded server
+    if the packages it needs are not installed.
+    """
+    missing = [name for name in SERVER_PACKAGES.get(server, []) if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f"Server '{server}' needs {', '.join(missing)}; using the threaded server", file=sys.stderr)
+        return "threaded"
+    return server
@@ -0,0 +1,154 @@
+from flask import Flask, request, jsonify
+from datetime import datetime, timedelta
+
+from config import DEBUG
+from call import call_log_store, call_log_index, call_log_rollups
+from email_log import email_store, email_index, email_rollups
+from index import format_timestamp, to_epoch
+from query import QueryError, parse_days
+from rollups import query_rollups
+from sms import sms_store, sms_index, sms_rollups
+
+app = Flask(__name__)
+
+# Days without contact on any channel before a contact is reported as stale
+STALE_AFTER_DAYS = 7
+
+# Sender name used for messages the user sent
+SELF_SENDER = "Me"
+
+# Store and per-sender index for every channel
+CHANNELS = {
+    "call": (call_log_store, call_log_index),
+    "sms": (sms_store, sms_index),
+    "email": (email_store, email_index)
+}
+
+# Hourly and daily rollups of every channel
+ROLLUPS = {
+    "call": call_log_rollups,
+    "sms": sms_rollups,
+    "email": email_rollups
+}
+
+
+def contact_activity():
+    """
+    Function to merge the per-sender indexes of all channels into one entry per contact.
+    Each entry holds the last contact time and channel, plus the last-seen time
+    and type counts on every channel the contact appears on (times in epoch seconds).
+    """
+    contacts = {}
+    for channel, (store, index) in CHANNELS.items():
+        # Pick up records collected by the other service processes
+        store.refresh()
+
+        for sender, (last_seen, counts) in index.senders().items():
+            if sender == SELF_SENDER:
+                continue
+            contact = contacts.setdefault(sender, {"last_contact": None, "last_channel": None, "channels": {}})
+            contact["channels"][channel] = {"last_seen": last_seen, "counts": counts}
+            if contact["last_contact"] is None or last_seen > contact["last_contact"]:
+                contact["last_contact"] = last_seen
+                contact["last_channel"] = channel
+    return contacts
+
+
+def inactive_contacts(days=STALE_AFTER_DAYS, now=None):
+    """
+    Function to list contacts with no call, SMS or email in the last N days.
+    Returns (contact, entry) pairs, least recently contacted first.
+    """
+    if now is None:
+        now = datetime.now()
+    cutoff = to_epoch(now - timedelta(days=days))
+    stale = [
+        (sender, contact) for sender, contact in contact_activity().items()
+        if contact["last_contact"] < cutoff
+    ]
+    return sorted(stale, key=lambda item: item[1]["last_contact"])
+
+
+def format_contact(sender, contact, now):
+    """
+    Function to turn a contact entry into a JSON-friendly dict.
+    """
+    return {
+        "contact": sender,
+        "last_contact": format_timestamp(contact["last_contact"]),
+        "last_channel": contact["last_channel"],
+        "days_since_last_contact": (to_epoch(now) - contact["last_contact"]) // 86400,
+        "channels": {
+            channel: {"last_seen": format_timestamp(entry["last_seen"]), "counts": entry["counts"]}
+            for channel, entry in contact["channels"].items()
+        }
+    }
+
+
+@app.route('/get_contacts', methods=['GET'])
+def get_contacts():
+    """
+    Endpoint to retrieve the merged activity of every contact across calls, SMS and email.
+    """
+    try:
+        now = datetime.now()
+        contacts = [format_contact(sender, contact, now) for sender, contact in contact_activity().items()]
+        return jsonify({"status": "success", "data": contacts}), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/analyze_contacts', methods=['GET'])
+def analyze_contacts():
+    """
+    Endpoint to find contacts not reached on any channel in a while.
+    Optional query parameter: days=N (defaults to STALE_AFTER_DAYS).
+    """
+    try:
+        days = parse_days(request.args, STALE_AFTER_DAYS)
+        now = datetime.now()
+
+        # Generate insights for contacts with no call, SMS or email in the last N days
+        stale = inactive_contacts(days, now)
+        insights = [f"You haven't been in touch with {sender} in a while. Check on them!" for sender, _ in stale]
+        contacts = [format_contact(sender, contact, now) for sender, contact in stale]
+
+        return jsonify({"status": "success", "insights": insights, "contacts": contacts}), 200
+
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/analytics', methods=['GET'])
+def get_analytics():
+    """
+    Endpoint to query hourly and daily activity rollups, without reading records.
+    Optional query parameters:
+        source=call,sms,email (defaults to every channel)
+        sender=Sender Name (defaults to every sender)
+        granularity=hour/day (defaults to day)
+        group=bucket/hour_of_day/weekday/hour_of_week (defaults to bucket)
+        start=YYYY-MM-DD HH:MM:SS, end=YYYY-MM-DD HH:MM:SS (defaults to the last 30 days)
+    """
+    try:
+        # Pick up records collected by the other service processes
+        for store, _ in CHANNELS.values():
+            store.refresh()
+
+        return query_rollups(ROLLUPS, request.args, datetime.now()), 200
+
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+if __name__ == '__main__':
+    # Run alone, this app only reads the stores; the collectors write them, whichever starts first
+    for store, _ in CHANNELS.values():
+        store.close()
+
+    # Run the Flask app
+    app.run(debug=DEBUG)
@@ -0,0 +1,209 @@
+"""
+Fast synthetic data generator for large-scale test datasets.
+
+Generates call log, SMS and email records with NumPy in batches, reusing the
+sender, content and subject pools of the collectors (see pools.py), and
+streams them straight into the collectors' JSON Lines storage format. Sender
+popularity follows a Zipf-like distribution (--skew) so heavy contacts can be
+modelled, and the output is reproducible for a given --seed.
+
+Usage:
+    python datagen.py --source sms --records 10000000 --senders 2000 --skew 1.1 --days 365 --output-dir data
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+
+import numpy as np
+
+from index import to_epoch
+import pools
+
+# Records generated per batch
+CHUNK_SIZE = 500000
+
+# Seconds in a day
+DAY = 86400
+
+# Data file written for each source, matching the collectors' stores
+OUTPUT_FILES = {
+    "call": "call_log_data.jsonl",
+    "sms": "sms_data.jsonl",
+    "email": "email_data.jsonl"
+}
+
+
+def load_pools(source):
+    """
+    Function to get the sender names and content pools of a collector.
+    """
+    if source == "call":
+        return {"names": pools.DUMMY_SENDERS, "types": pools.CALL_TYPES}
+    if source == "sms":
+        return {"names": pools.NAMES, "received": pools.RECEIVED_CONTENT, "sent": pools.SENT_CONTENT}
+    return {
+        "names": pools.NAMES,
+        "subjects": pools.EMAIL_SUBJECTS,
+        "received": pools.RECEIVED_BODY,
+        "sent": pools.SENT_BODY
+    }
+
+
+def sender_names(names, count):
+    """
+    Function to get count sender names, extending the pool with numbered contacts if needed.
+    """
+    names = list(names[:count])
+    return names + [f"Contact {i}" for i in range(len(names) + 1, count + 1)]
+
+
+def sender_weights(count, skew):
+    """
+    Function to get Zipf-like sender probabilities; skew 0 is uniform.
+    """
+    weights = np.arange(1, count + 1, dtype=np.float64) ** -skew
+    return weights / weights.sum()
+
+
+def encode_pool(values):
+    """
+    Function to JSON-encode every pool value once, so records are assembled from fragments.
+    """
+    return [json.dumps(value, ensure_ascii=False) for value in values]
+
+
+def format_times(epochs):
+    """
+    Function to format epoch seconds as 'YYYY-MM-DD HH:MM:SS' strings in one pass.
+    """
+    strings = np.datetime_as_string(epochs.astype("datetime64[s]"), unit="s")
+    return [value.replace("T", " ") for value in strings.tolist()]
+
+
+def call_lines(rng, pools, senders, weights, now, span, count):
+    """
+    Function to generate count call log records as JSON lines.
+    """
+    times = format_times(now - rng.integers(0, span, count))
+    sender_codes = rng.choice(len(senders), count, p=weights).tolist()
+    type_codes = rng.integers(0, len(pools["types"]), count).tolist()
+    names = encode_pool(senders)
+    types = encode_pool(pools["types"])
+    return [
+        f'{{"datetime":"{t}","sender":{names[s]},"log_type":{types[k]}}}\n'
+        for t, s, k in zip(times, sender_codes, type_codes)
+    ]
+
+
+def conversation_times(rng, now, span, count):
+    """
+    Function to generate received times and reply times 1 to 60 minutes later.
+    """
+    first = now - rng.integers(0, span, count)
+    reply = first + rng.integers(60, 3660, count)
+    return format_times(first), format_times(reply)
+
+
+def sms_lines(rng, pools, senders, weights, now, span, count):
+    """
+    Function to generate count // 2 SMS conversations (a received message and its reply) as JSON lines.
+    """
+    conversations = count // 2
+    first, reply = conversation_times(rng, now, span, conversations)
+    sender_codes = rng.choice(len(senders), conversations, p=weights).tolist()
+    received_codes = rng.integers(0, len(pools["received"]), conversations).tolist()
+    sent_codes = rng.integers(0, len(pools["sent"]), conversations).tolist()
+    names = encode_pool(senders)
+    received = encode_pool(pools["received"])
+    sent = encode_pool(pools["sent"])
+
+    lines = []
+    for t1, t2, s, r, k in zip(first, reply, sender_codes, received_codes, sent_codes):
+        lines.append(f'{{"datetime":"{t1}","sender":{names[s]},"type":"received","content":{received[r]}}}\n')
+        lines.append(f'{{"datetime":"{t2}","sender":"Me","type":"sent","content":{sent[k]}}}\n')
+    return lines
+
+
+def email_lines(rng, pools, senders, weights, now, span, count):
+    """
+    Function to generate count // 2 email threads (a received email and its reply) as JSON lines.
+    """
+    threads = count // 2
+    first, reply = conversation_times(rng, now, span, threads)
+    sender_codes = rng.choice(len(senders), threads, p=weights).tolist()
+    subject_codes = rng.integers(0, len(pools["subjects"]), threads).tolist()
+    received_codes = rng.integers(0, len(pools["received"]), threads).tolist()
+    sent_codes = rng.integers(0, len(pools["sent"]), threads).tolist()
+    names = encode_pool(senders)
+    subjects = encode_pool(pools["subjects"])
+    replies = encode_pool([f"Re: {subject}" for subject in pools["subjects"]])
+    received = encode_pool(pools["received"])
+    sent = encode_pool(pools["sent"])
+
+    lines = []
+    for t1, t2, s, j, r, k in zip(first, reply, sender_codes, subject_codes, received_codes, sent_codes):
+        lines.append(f'{{"datetime":"{t1}","sender":{names[s]},"type":"received","subject":{subjects[j]},'
+                     f'"body":{received[r]},"attachments":[]}}\n')
+        lines.append(f'{{"datetime":"{t2}","sender":"Me","type":"sent","subject":{replies[j]},'
+                     f'"body":{sent[k]},"attachments":[]}}\n')
+    return lines
+
+
+GENERATORS = {"call": call_lines, "sms": sms_lines, "email": email_lines}
+
+
+def generate(source, records, output_dir=".", senders=None, skew=0.0, days=8, seed=0, now=None):
+    """
+    Function to write a synthetic dataset for a source into output_dir.
+    Records are generated and written in batches of CHUNK_SIZE, and the file is
+    renamed into place once complete. Returns the path of the written file.
+    """
+    rng = np.random.default_rng(seed)
+    pools = load_pools(source)
+    names = sender_names(pools["names"], senders or len(pools["names"]))
+    weights = sender_weights(len(names), skew)
+    now = to_epoch(now or datetime.now())
+    span = days * DAY
+
+    # SMS and email records come in pairs
+    if source != "call":
+        records -= records % 2
+
+    path = os.path.join(output_dir, OUTPUT_FILES[source])
+    tmp_path = path + ".tmp"
+    os.makedirs(output_dir, exist_ok=True)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        written = 0
+        while written < records:
+            count = min(CHUNK_SIZE, records - written)
+            f.write("".join(GENERATORS[source](rng, pools, names, weights, now, span, count)))
+            written += count
+    os.replace(tmp_path, path)
+
+    # Drop the snapshot of the previous data, which no longer matches the log, and
+    # its generation, so indexes saved for the previous data are rebuilt
+    for suffix in (".snapshot", ".generation"):
+        stale_path = os.path.splitext(path)[0] + suffix
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate large synthetic call, SMS or email datasets.")
+    parser.add_argument("--source", choices=sorted(GENERATORS), required=True)
+    parser.add_argument("--records", type=int, required=True, help="number of records to generate")
+    parser.add_argument("--senders", type=int, help="number of distinct senders (default: the collector's name pool)")
+    parser.add_argument("--skew", type=float, default=0.0, help="Zipf exponent for sender popularity (0 = uniform)")
+    parser.add_argument("--days", type=int, default=8, help="days of history the records are spread over")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default=".")
+    args = parser.parse_args(argv)
+
+    path = generate(args.source, args.records, args.output_dir, args.senders, args.skew, args.days, args.seed)
+    print(f"Generated {args.records} {args.source} records in {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+"""
+Duplicate detection for collected records, so that retried syncs are not stored twice.
+
+A record is identified by a 128-bit hash of its identifying fields
+(DEDUP_FIELDS). DedupIndex is a store listener holding the hash of every
+stored record: a Bloom filter in memory answers most lookups, and the
+hashes themselves live in a sorted, memory-mapped file next to the store
+(e.g. "sms_data.hashes"), with the hashes of the latest records kept in a
+set until MERGE_EVERY of them are merged into the file. The file records
+how many records it covers and the store generation they came from, so a
+restart only hashes the records stored after it. Only the process holding
+"sms_data.hashes.lock" writes the file; others keep their hashes in memory.
+
+DedupIndex.extend() stores only the records not seen before. New hashes
+are claimed before the records are committed, so concurrent retries of the
+same sync cannot both get through.
+
+Offline pass, removing the duplicates already stored (stop the collectors first):
+    python dedup.py call_log_data.json sms_data.json email_data.json
+"""
+import argparse
+from array import array
+import hashlib
+import json
+import math
+import os
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from snapshot import map_arrays, write_arrays
+from storage import lock_owner, temp_path
+
+HASHES_MAGIC = b"CHASH001"
+
+# Fields identifying a record of each collector, keyed by data file
+DEDUP_FIELDS = {
+    "call_log_data.json": ["datetime", "sender", "log_type"],
+    "sms_data.json": ["datetime", "sender", "type", "content"],
+    "email_data.json": ["datetime", "sender", "type", "subject", "body"]
+}
+
+# Hashes kept in memory before they are merged into the hashes file
+MERGE_EVERY = 100000
+
+# Records the Bloom filter is first sized for; it doubles as the store grows
+BLOOM_CAPACITY = 1000000
+
+# False positive rate of the Bloom filter at capacity
+BLOOM_ERROR_RATE = 0.01
+
+# Records hashed per batch when catching up with the store
+CATCH_UP_CHUNK = 100000
+
+MASK64 = (1 << 64) - 1
+
+
+def record_hash(record, fields):
+    """
+    Function to hash the identifying fields of a record into 16 bytes.
+    """
+    values = [record.get(field) for field in fields] if isinstance(record, dict) else [record]
+    encoded = json.dumps(values, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(encoded.encode("utf-8"), digest_size=16).digest()
+
+
+def split_hash(digest):
+    """
+    Function to split a hash into its two 64-bit halves.
+    """
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+def hash_arrays(records, fields):
+    """
+    Function to hash records into two uint64 arrays, the high and low halves.
+    """
+    high, low = array("Q"), array("Q")
+    for record in records:
+        first, second = split_hash(record_hash(record, fields))
+        high.append(first)
+        low.append(second)
+    return np.array(high, np.uint64), np.array(low, np.uint64)
+
+
+class BloomFilter:
+    """
+    Bloom filter over 128-bit hashes, using double hashing on their halves.
+    """
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest):
+        first, second = split_hash(digest)
+        return [((first + i * second) & MASK64) % self.size for i in range(self.hashes)]
+
+    def add(self, digest):
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def add_arrays(self, high, low):
+        """
+        Function to add hashes given as uint64 halves, in one pass.
+        """
+        flags = np.zeros(self.size, bool)
+        for i in range(self.hashes):
+            # uint64 arithmetic wraps like the & MASK64 in _positions
+            flags[(high + np.uint64(i) * low) % np.uint64(self.size)] = True
+        packed = np.packbits(flags, bitorder="little")
+        existing = np.frombuffer(bytes(self.bits), np.uint8)
+        self.bits = bytearray((existing | packed).tobytes())
+
+    def __contains__(self, digest):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+
+class DedupIndex:
+    """
+    Index of the hashes of every record in a store.
+    Subscribe it to the store it indexes. With the store's SegmentArchive, the
+    archived records are hashed too.
+    """
+
+    def __init__(self, store, fields, archive=None, merge_every=MERGE_EVERY):
+        self.store = store
+        self.fields = fields
+        self.archive = archive
+        self.merge_every = merge_every
+        self.path = os.path.splitext(store.path)[0] + ".hashes"
+        self._lock = threading.Lock()
+        self._owner_lock = None
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+
+        # Sorted hash halves from the hashes file, covering the first count_on_disk records
+        self._high = np.empty(0, np.uint64)
+        self._low = np.empty(0, np.uint64)
+        self._count_on_disk = 0
+
+        # Hashes of later records, and hashes claimed by commits in progress
+        self._recent = set()
+        self._pending = set()
+        self._bloom = BloomFilter(BLOOM_CAPACITY)
+
+    @property
+    def writable(self):
+        """
+        Whether this process owns the hashes file.
+        """
+        return self._owner_lock is not None
+
+    def close(self):
+        """
+        Function to give up the hashes file, so that another process can write it.
+        """
+        with self._lock:
+            if self._owner_lock is not None:
+                self._owner_lock.close()
+                self._owner_lock = None
+
+    def _load(self):
+        """
+        Function to map the hashes file if it was written for the store's current generation.
+        Returns whether it was loaded.
+        """
+        try:
+            header, arrays = map_arrays(self.path, HASHES_MAGIC)
+            count = header["count"]
+            if count > len(self.store) or header["generation"] != self.store.generation:
+                return False
+        except (OSError, ValueError, KeyError, IndexError):
+            return False
+        self._high, self._low = arrays["high"], arrays["low"]
+        self.count = self._count_on_disk = count
+        return True
+
+    def _write(self, high, low):
+        """
+        Function to sort hash halves, drop repeats and write them as the hashes file
+        covering the records hashed so far. Without the file lock, they are only
+        kept in memory.
+        """
+        order = np.lexsort((low, high))
+        high, low = high[order], low[order]
+        if len(high):
+            keep = np.concatenate([[True], (high[1:] != high[:-1]) | (low[1:] != low[:-1])])
+            high, low = high[keep], low[keep]
+
+        if not self.writable:
+            self._high, self._low = high, low
+            self._count_on_disk = self.count
+            return
+
+        tmp_path = temp_path(self.path)
+        header = {"count": self.count, "generation": self.store.generation}
+        write_arrays(tmp_path, HASHES_MAGIC, header, {"high": high, "low": low})
+        os.replace(tmp_path, self.path)
+        self._load()
+
+    def _merge(self):
+        """
+        Function to merge the recent hashes into the hashes file.
+        """
+        recent_high, recent_low = (np.array(values, np.uint64) for values in zip(*map(split_hash, self._recent)))
+        self._write(np.concatenate([self._high, recent_high]), np.concatenate([self._low, recent_low]))
+        self._recent = set()
+
+    def _rebuild_bloom(self):
+        """
+        Function to size the Bloom filter for the store and fill it with every known hash.
+        """
+        self._bloom = BloomFilter(max(BLOOM_CAPACITY, 2 * max(self.count, len(self._high) + len(self._recent))))
+        self._bloom.add_arrays(self._high, self._low)
+        for digest in self._recent | self._pending:
+            self._bloom.add(digest)
+
+    def rebuild(self, records):
+        """
+        Function to rebuild the index, reusing the hashes file if it still matches the store.
+        """
+        if np is None:
+            return
+        with self._lock:
+            pending = self._pending
+            self._reset()
+            self._pending = pending
+            if self._owner_lock is None:
+                self._owner_lock = lock_owner(self.path + ".lock")
+            if self._load():
+                # Hash the records stored after the file
+                total = len(self.store)
+                for chunk_start in range(self.count, total, CATCH_UP_CHUNK):
+                    chunk = self.store.read_records(range(chunk_start, min(total, chunk_start + CATCH_UP_CHUNK)))
+                    self._recent.update(record_hash(record, self.fields) for record in chunk)
+                    self.count += len(chunk)
+            else:
+                # Hash everything again, archived records included, writing the file once
+                high, low = hash_arrays(records, self.fields)
+                self.count = len(high)
+                if self.archive is not None and self.archive.has_segments():
+                    archived_high, archived_low = hash_arrays(self.archive.records(), self.fields)
+                    high, low = np.concatenate([high, archived_high]), np.concatenate([low, archived_low])
+                self._write(high, low)
+            self._rebuild_bloom()
+
+    def add(self, records):
+        """
+        Function to update the index with newly stored records.
+        """
+        if np is None:
+            return
+        with self._lock:
+            for record in records:
+                digest = record_hash(record, self.fields)
+                self._recent.add(digest)
+                self._pending.discard(digest)
+                self._bloom.add(digest)
+                self.count += 1
+            if len(self._recent) >= self.merge_every:
+                self._merge()
+            if self.count > self._bloom.capacity:
+                self._rebuild_bloom()
+
+    def _contains(self, digest):
+        if digest in self._pending or digest in self._recent:
+            return True
+        if digest not in self._bloom:
+            return False
+
+        # Possible false positive: check the hashes file
+        high, low = split_hash(digest)
+        start = np.searchsorted(self._high, np.uint64(high), "left")
+        end = np.searchsorted(self._high, np.uint64(high), "right")
+        return bool((self._low[start:end] == np.uint64(low)).any())
+
+    def contains(self, records):
+        """
+        Function to check which records were stored or claimed before.
+        """
+        if np is None:
+            return [False for _ in records]
+        with self._lock:
+            return [self._contains(record_hash(record, self.fields)) for record in records]
+
+    def claim(self, records):
+        """
+        Function to pick out the records not stored or claimed before, claiming their
+        hashes until they are committed. Repeats within records count as duplicates.
+        Returns the new records and their hashes.
+        """
+        records = list(records)
+        if np is None:
+            return records, []
+        new = []
+        digests = []
+        with self._lock:
+            for record in records:
+                digest = record_hash(record, self.fields)
+                if self._contains(digest):
+                    continue
+                self._pending.add(digest)
+                self._bloom.add(digest)
+                new.append(record)
+                digests.append(digest)
+        return new, digests
+
+    def release(self, digests):
+        """
+        Function to drop claims that were not committed.
+        """
+        with self._lock:
+            self._pending.difference_update(digests)
+
+    def extend(self, records):
+        """
+        Function to store the records that were not stored before.
+        Blocks until they have been committed. Returns the number of duplicates.
+        """
+        records = list(records)
+        new, digests = self.claim(records)
+        try:
+            if new:
+                self.store.extend(new)
+        finally:
+            # Committed hashes have already moved to the index; the rest are given up
+            self.release(digests)
+        return len(records) - len(new)
+
+
+def dedup_store(store, fields):
+    """
+    Function to remove repeated records from a store, keeping the first of each.
+    Returns the number of records removed.
+    """
+    high, low = hash_arrays(store, fields)
+
+    # The sort is stable, so the first record of each group of equal hashes is the oldest
+    order = np.lexsort((low, high))
+    repeated = (high[order][1:] == high[order][:-1]) & (low[order][1:] == low[order][:-1])
+    keep = np.ones(len(high), bool)
+    keep[order[1:][repeated]] = False
+
+    removed = int(len(keep) - keep.sum())
+    if removed:
+        records = (record for record, kept in zip(store, keep) if kept)
+
+        # Without a snapshot the log is rewritten in place, so read it all first
+        store.replace(records if store.use_snapshots else list(records))
+    return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove duplicate records from collector data files.")
+    parser.add_argument("paths", nargs="+", help="data files, e.g. sms_data.json")
+    parser.add_argument("--fields", help="comma-separated fields identifying a record (defaults to the collector's)")
+    args = parser.parse_args(argv)
+
+    from storage import open_store
+
+    for path in args.paths:
+        fields = args.fields.split(",") if args.fields else DEDUP_FIELDS.get(os.path.basename(path))
+        if fields is None:
+            sys.exit(f"No dedup fields known for {path}; pass --fields")
+        store = open_store(path, compact_every=0)
+        removed = dedup_store(store, fields)
+        print(f"Removed {removed} duplicate records from {store.path} ({len(store)} kept)")
+
+
+if __name__ == '__main__':
+    main()
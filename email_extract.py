@@ -0,0 +1,534 @@
+"""
+Email extraction pipeline.
+
+Importable version of the email_extraction notebook. Parses .eml files,
+mbox files and Maildir folders on a process pool and streams the records,
+in the format /collect_email accepts, into email_log.py's store (or into a
+running collector over HTTP). Files already ingested are skipped using their
+mtime and a content hash recorded in a manifest, so re-runs over a large
+archive only parse new or changed messages. Messages the store rejects (e.g.
+with no Date: header) are reported and left out of the manifest, so they are
+retried on the next run.
+
+With --lazy, messages are memory-mapped and only the headers and the first
+text/plain part are decoded; attachments are listed with their estimated
+size without decoding their payloads. The manifest then keys messages by
+their size and headers instead of hashing their whole content.
+
+Usage:
+    python email_extract.py ~/Mail/archive.mbox ~/Mail/Maildir --me me@example.com
+    python email_extract.py ./Emails --url http://127.0.0.1:5000 --lazy
+"""
+import argparse
+import base64
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email import policy
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import parseaddr, parsedate_to_datetime
+import hashlib
+import json
+import logging
+import mailbox
+import mmap
+import os
+import quopri
+import urllib.request
+
+# File recording which sources and messages have been ingested
+MANIFEST_FILE = "email_ingest_manifest.jsonl"
+
+# Number of records written to the store per commit
+BATCH_SIZE = 500
+
+# Parse jobs queued per worker, bounding memory on large archives
+JOBS_PER_WORKER = 64
+
+# Deepest multipart nesting followed by the lazy parser
+MAX_MIME_DEPTH = 10
+
+logger = logging.getLogger(__name__)
+
+# Settings shared with the worker processes (see _init_worker)
+_known_hashes = frozenset()
+_me = frozenset()
+_label = "inbox"
+_lazy = False
+
+
+def get_email_body(msg):
+    """
+    Function to extract the plain text body of an email message.
+    """
+    try:
+        if msg.is_multipart():
+            for part in msg.walk():
+                if part.get_content_type() == "text/plain":
+                    charset = part.get_content_charset() or "utf-8"
+                    return part.get_payload(decode=True).decode(charset, errors="ignore")
+        else:
+            charset = msg.get_content_charset() or "utf-8"
+            return msg.get_payload(decode=True).decode(charset, errors="ignore")
+    except Exception as e:
+        logger.warning("Error extracting body: %s", e)
+    return ""
+
+
+def format_date(value):
+    """
+    Function to convert a Date header into 'YYYY-MM-DD HH:MM:SS' local time.
+    Returns None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        date = parsedate_to_datetime(str(value))
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return date.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def message_to_record(msg, body, attachments, me=frozenset(), label="inbox"):
+    """
+    Function to build an email record, as accepted by /collect_email, from parsed headers.
+    Messages sent from one of the addresses in me are stored as sent by "Me".
+    """
+    name, address = parseaddr(str(msg["From"] or ""))
+    if address.lower() in me:
+        sender, email_type = "Me", "sent"
+    else:
+        sender, email_type = name or address, "received"
+
+    return {
+        "datetime": format_date(msg["Date"]),
+        "sender": sender,
+        "type": email_type,
+        "subject": str(msg["Subject"] or ""),
+        "body": body,
+        "attachments": attachments,
+        "to": str(msg["To"] or ""),
+        "cc": str(msg["CC"] or ""),
+        "reply_to": str(msg["Reply-To"] or ""),
+        "label": label
+    }
+
+
+def parse_message(data, me=frozenset(), label="inbox"):
+    """
+    Function to parse a raw message into an email record.
+    """
+    msg = BytesParser(policy=policy.default).parsebytes(data)
+    attachments = [part.get_filename() for part in msg.walk() if part.get_filename()]
+    return message_to_record(msg, get_email_body(msg), attachments, me, label)
+
+
+def _header_end(data, start, end):
+    """
+    Function to locate the blank line that ends a block of headers.
+    Returns (end of headers, start of body).
+    """
+    crlf = data.find(b"\r\n\r\n", start, end)
+    lf = data.find(b"\n\n", start, end)
+    if lf != -1 and (crlf == -1 or lf < crlf):
+        return lf + 1, lf + 2
+    if crlf != -1:
+        return crlf + 2, crlf + 4
+    return end, end
+
+
+def _parse_headers(data, start, end):
+    """
+    Function to parse the headers of a message or MIME part, leaving its body untouched.
+    Returns (headers, start of body).
+    """
+    headers_end, body_start = _header_end(data, start, end)
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(bytes(data[start:headers_end]))
+    return headers, body_start
+
+
+def _split_multipart(data, start, end, boundary):
+    """
+    Function to find the (start, end) byte ranges of the parts of a multipart body.
+    Only the boundary lines are searched for; part payloads are not copied.
+    """
+    delimiter = b"--" + boundary.encode("utf-8", errors="ignore")
+    parts = []
+    part_start = None
+    position = start
+    while True:
+        found = data.find(delimiter, position, end)
+        if found == -1:
+            break
+
+        # A delimiter only counts at the start of a line
+        if found != start and data[found - 1:found] != b"\n":
+            position = found + len(delimiter)
+            continue
+
+        if part_start is not None:
+            part_end = found - 1
+            if part_end > part_start and data[part_end - 1:part_end] == b"\r":
+                part_end -= 1
+            parts.append((part_start, max(part_start, part_end)))
+
+        # Closing delimiter
+        if data[found + len(delimiter):found + len(delimiter) + 2] == b"--":
+            break
+
+        line_end = data.find(b"\n", found, end)
+        if line_end == -1:
+            break
+        part_start = position = line_end + 1
+    return parts
+
+
+def _decode_payload(data, start, end, headers):
+    """
+    Function to decode a text part's payload according to its transfer encoding and charset.
+    """
+    payload = bytes(data[start:end])
+    encoding = str(headers.get("Content-Transfer-Encoding", "")).strip().lower()
+    if encoding == "base64":
+        payload = base64.b64decode(payload)
+    elif encoding == "quoted-printable":
+        payload = quopri.decodestring(payload)
+    charset = headers.get_content_charset() or "utf-8"
+    try:
+        return payload.decode(charset, errors="ignore")
+    except LookupError:
+        return payload.decode("utf-8", errors="ignore")
+
+
+def _estimated_size(start, end, headers):
+    """
+    Function to estimate a part's decoded size from its encoded length, without decoding it.
+    """
+    size = end - start
+    encoding = str(headers.get("Content-Transfer-Encoding", "")).strip().lower()
+    if encoding == "base64":
+        # 76-character lines plus line breaks, 4 characters per 3 bytes
+        return size * 76 // 78 * 3 // 4
+    return size
+
+
+def _walk_lazy(data, start, end, headers, found, depth=0):
+    """
+    Function to walk a MIME tree, decoding only the first text/plain part.
+    found collects the body and the (name, size) of every attachment.
+    """
+    if headers.get_content_maintype() == "multipart" and depth < MAX_MIME_DEPTH:
+        boundary = headers.get_param("boundary")
+        if boundary:
+            for part_start, part_end in _split_multipart(data, start, end, str(boundary)):
+                part_headers, body_start = _parse_headers(data, part_start, part_end)
+                _walk_lazy(data, body_start, part_end, part_headers, found, depth + 1)
+            return
+
+    filename = headers.get_filename()
+    if filename:
+        found["attachments"].append((filename, _estimated_size(start, end, headers)))
+    elif found["body"] is None and headers.get_content_type() == "text/plain":
+        found["body"] = _decode_payload(data, start, end, headers)
+
+
+def parse_message_lazy(data, me=frozenset(), label="inbox"):
+    """
+    Function to parse a raw message into an email record without decoding attachments.
+    data can be bytes or a memory map; only the headers and first text/plain part are copied.
+    The record also lists attachment_sizes, estimated from the encoded payloads.
+    """
+    headers, body_start = _parse_headers(data, 0, len(data))
+    found = {"body": None, "attachments": []}
+    _walk_lazy(data, body_start, len(data), headers, found)
+
+    record = message_to_record(headers, found["body"] or "", [name for name, _ in found["attachments"]], me, label)
+    record["attachment_sizes"] = [size for _, size in found["attachments"]]
+    return record
+
+
+def _init_worker(known_hashes, me, label, lazy=False):
+    """
+    Function to hand the run settings to a worker once, instead of with every job.
+    """
+    global _known_hashes, _me, _label, _lazy
+    _known_hashes = known_hashes
+    _me = me
+    _label = label
+    _lazy = lazy
+
+
+def _parse_job(job):
+    """
+    Function run in a worker to hash and parse one message.
+    A job is (key, mtime, path, data); data is None when the message is a file.
+    Returns (key, mtime, digest, record, error).
+    """
+    key, mtime, path, data = job
+    try:
+        if data is None:
+            with open(path, "rb") as f:
+                # Map the file instead of reading it, so untouched attachments never load
+                if _lazy and os.fstat(f.fileno()).st_size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        return _parse_data(key, mtime, mapped)
+                data = f.read()
+        return _parse_data(key, mtime, data)
+    except Exception as e:
+        return key, mtime, None, None, f"Error processing {key}: {e}"
+
+
+def _message_digest(data):
+    """
+    Function to hash a message for the manifest. Lazily parsed messages are hashed
+    by their size and headers only, so their attachments are not read just to be hashed.
+    """
+    if not _lazy:
+        return hashlib.sha256(data).hexdigest()
+    headers_end, _ = _header_end(data, 0, len(data))
+    digest = hashlib.sha256(b"%d\n" % len(data))
+    digest.update(data[:headers_end])
+    return digest.hexdigest()
+
+
+def _parse_data(key, mtime, data):
+    """
+    Function to hash and parse one message's raw data in a worker.
+    """
+    digest = _message_digest(data)
+
+    # Content already ingested under another name or mtime
+    if digest in _known_hashes:
+        return key, mtime, digest, None, None
+
+    if _lazy:
+        return key, mtime, digest, parse_message_lazy(data, _me, _label), None
+    return key, mtime, digest, parse_message(data, _me, _label), None
+
+
+class Manifest:
+    """
+    Append-only record of ingested sources and message hashes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtimes = {}
+        self.hashes = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("mtime") is not None:
+                        self.mtimes[entry["key"]] = entry["mtime"]
+                    if entry.get("sha256"):
+                        self.hashes.add(entry["sha256"])
+
+    def is_current(self, key, mtime):
+        """
+        Function to check whether a source was ingested at this mtime.
+        """
+        return self.mtimes.get(key) == mtime
+
+    def add(self, entries):
+        """
+        Function to record ingested (key, mtime, digest) entries.
+        """
+        with open(self.path, "a", encoding="utf-8") as f:
+            for key, mtime, digest in entries:
+                f.write(json.dumps({"key": key, "mtime": mtime, "sha256": digest}) + "\n")
+                if mtime is not None:
+                    self.mtimes[key] = mtime
+                if digest:
+                    self.hashes.add(digest)
+
+
+def iter_jobs(sources, manifest, done_sources):
+    """
+    Function to list parse jobs for .eml files, Maildir folders and mbox files.
+    Sources whose mtime has not changed since the last run are skipped.
+    Whole mbox files are appended to done_sources once all their messages are queued.
+    """
+    for source in sources:
+        source = os.path.abspath(source)
+
+        # Maildir: one message per file under cur/ and new/
+        if os.path.isdir(os.path.join(source, "cur")) or os.path.isdir(os.path.join(source, "new")):
+            for sub in ("cur", "new"):
+                folder = os.path.join(source, sub)
+                if not os.path.isdir(folder):
+                    continue
+                for entry in os.scandir(folder):
+                    if entry.is_file():
+                        mtime = entry.stat().st_mtime
+                        if not manifest.is_current(entry.path, mtime):
+                            yield entry.path, mtime, entry.path, None
+
+        # Folder of .eml files
+        elif os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                for name in files:
+                    if name.endswith(".eml"):
+                        path = os.path.join(root, name)
+                        mtime = os.path.getmtime(path)
+                        if not manifest.is_current(path, mtime):
+                            yield path, mtime, path, None
+
+        # Single .eml file
+        elif source.endswith(".eml"):
+            mtime = os.path.getmtime(source)
+            if not manifest.is_current(source, mtime):
+                yield source, mtime, source, None
+
+        # mbox file: messages are read as raw bytes and parsed by the workers
+        else:
+            mtime = os.path.getmtime(source)
+            if manifest.is_current(source, mtime):
+                continue
+            box = mailbox.mbox(source, create=False)
+            try:
+                for index, key in enumerate(box.iterkeys()):
+                    yield f"{source}#{index}", None, None, box.get_bytes(key)
+            finally:
+                box.close()
+            done_sources.append((source, mtime, None))
+
+
+def _bounded_map(executor, fn, jobs, window):
+    """
+    Function like executor.map that keeps at most window jobs in flight.
+    """
+    futures = deque()
+    for job in jobs:
+        futures.append(executor.submit(fn, job))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def store_sink():
+    """
+    Function to get a sink that writes records straight into email_log.py's store.
+    While the email collector runs against the same file, the store is read-only
+    here and storing fails; use the HTTP sink then.
+    """
+    from email_log import email_dedup, email_store, validate_email
+    from ingest import collect_batch
+
+    def sink(records):
+        return collect_batch(email_store, [(record, None) for record in records], validate_email, email_dedup)
+    return sink
+
+
+def http_sink(url):
+    """
+    Function to get a sink that posts records to a running collector's /collect_email_batch.
+    """
+    endpoint = url.rstrip("/") + "/collect_email_batch"
+
+    def sink(records):
+        payload = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+        request = urllib.request.Request(endpoint, data=payload, headers={"Content-Type": "application/x-ndjson"})
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+    return sink
+
+
+def ingest(sources, sink, me=(), label="inbox", workers=None, backend="process", manifest_path=MANIFEST_FILE,
+           lazy=False):
+    """
+    Function to parse every new message in the sources and stream the records into sink.
+    sink receives lists of records and returns a /collect_email_batch style result,
+    with the number of records accepted and the errors of the rejected ones by index.
+    With lazy set, attachments are listed but never decoded.
+    Returns counters for the run.
+    """
+    manifest = Manifest(manifest_path)
+    me = frozenset(address.lower() for address in me)
+    workers = workers or os.cpu_count() or 1
+    executor_class = ProcessPoolExecutor if backend == "process" else ThreadPoolExecutor
+
+    stats = {"parsed": 0, "stored": 0, "duplicates": 0, "rejected": 0, "skipped": 0, "failed": 0}
+    batch = []
+    entries = []
+    seen = set()
+    done_sources = []
+
+    # mbox files with a message that was not stored, which must be read again next run
+    incomplete = set()
+
+    def flush():
+        rejected = {}
+        if batch:
+            result = sink(batch)
+            stats["stored"] += result["accepted"]
+            stats["duplicates"] += result.get("duplicates", 0)
+            stats["rejected"] += len(result["errors"])
+            rejected = {error["index"]: error["message"] for error in result["errors"]}
+
+        # Only mark messages as ingested once their records are stored
+        for key, mtime, digest, position in entries:
+            if position in rejected:
+                logger.error("Rejected %s: %s", key, rejected[position])
+                seen.discard(digest)
+                incomplete.add(key.rsplit("#", 1)[0])
+        manifest.add((key, mtime, digest) for key, mtime, digest, position in entries if position not in rejected)
+        batch.clear()
+        entries.clear()
+
+    with executor_class(max_workers=workers, initializer=_init_worker,
+                        initargs=(frozenset(manifest.hashes), me, label, lazy)) as executor:
+        jobs = iter_jobs(sources, manifest, done_sources)
+        for key, mtime, digest, record, error in _bounded_map(executor, _parse_job, jobs, workers * JOBS_PER_WORKER):
+            if error:
+                logger.error(error)
+                stats["failed"] += 1
+                incomplete.add(key.rsplit("#", 1)[0])
+                continue
+
+            # Skip content seen in an earlier run or earlier in this one
+            if record is None or digest in seen:
+                stats["skipped"] += 1
+                entries.append((key, mtime, None, None))
+                continue
+            seen.add(digest)
+
+            stats["parsed"] += 1
+            entries.append((key, mtime, digest, len(batch)))
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                flush()
+
+    flush()
+    manifest.add(entry for entry in done_sources if entry[0] not in incomplete)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest .eml files, mbox files and Maildir folders into the email store.")
+    parser.add_argument("sources", nargs="+", help=".eml files, folders of .eml files, Maildir folders or mbox files")
+    parser.add_argument("--me", action="append", default=[], help="your own address; messages from it are stored as sent (repeatable)")
+    parser.add_argument("--label", default="inbox", help="label stored with every record")
+    parser.add_argument("--url", help="post to a running email collector instead of writing the store directly")
+    parser.add_argument("--workers", type=int, help="number of parser workers (default: CPU count)")
+    parser.add_argument("--backend", choices=["process", "thread"], default="process", help="worker pool type")
+    parser.add_argument("--manifest", default=MANIFEST_FILE, help="file recording what has been ingested")
+    parser.add_argument("--lazy", action="store_true", help="skip attachment payloads and memory-map message files")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(message)s")
+
+    sink = http_sink(args.url) if args.url else store_sink()
+    stats = ingest(args.sources, sink, me=args.me, label=args.label, workers=args.workers,
+                   backend=args.backend, manifest_path=args.manifest, lazy=args.lazy)
+    print(f"Extraction completed. Parsed {stats['parsed']}, stored {stats['stored']}, "
+          f"already stored {stats['duplicates']}, rejected {stats['rejected']}, skipped {stats['skipped']}, "
+          f"failed {stats['failed']}.")
+
+
+if __name__ == '__main__':
+    main()
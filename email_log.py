@@ -1,132 +1,150 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify
+from werkzeug.serving import is_running_from_reloader
 from datetime import datetime, timedelta
-import json
-import os
 import random
 
+from alerts import StalenessMonitor, poll_alerts, stream_alerts
+from archive import SegmentArchive
+from cache import cached
+from config import DEBUG
+from dedup import DEDUP_FIELDS, DedupIndex
+from index import SenderIndex, TimeIndex, format_timestamp, parse_timestamp, to_epoch
+from ingest import PayloadError, collect_batch, read_batch
+from metrics import instrument, phase
+from pools import EMAIL_SUBJECTS, NAMES, RECEIVED_BODY, SENT_BODY
+from query import QueryError, get_records, parse_days, staleness_expiry
+from rollups import RollupIndex
+from search import SearchIndex, search_records
+from storage import open_store
+from threads import ThreadIndex, get_reply_parents, get_reply_times, get_threads, get_unanswered
+
 app = Flask(__name__)
 
+# Endpoints used only by the shard router, registered on shard workers (see server.py)
+shard_api = Blueprint("email_shard", __name__)
+
+# Days without contact before a sender is reported as stale
+STALE_AFTER_DAYS = 7
+
+# Insight reported for a stale sender
+STALE_INSIGHT = "{sender} hasn't emailed in a while. Check on them!"
+
 # File to store collected email data
 EMAIL_FILE = "email_data.json"
 
-# Ensure the data file exists
-if not os.path.exists(EMAIL_FILE):
-    with open(EMAIL_FILE, "w", encoding="utf-8") as f:
-        json.dump([], f, ensure_ascii=False)
-
-# List of 150 unique names
-NAMES = [
-    "John Doe", "Jane Smith", "Alice Johnson", "Bob Brown", "Charlie Davis", "Eve Wilson", "Frank Moore", "Grace Taylor",
-    "Hank Anderson", "Ivy Thomas", "Jack White", "Karen Harris", "Leo Martin", "Mia Thompson", "Nina Garcia", "Oscar Martinez",
-    "Paul Robinson", "Quinn Clark", "Rachel Rodriguez", "Steve Lewis", "Tina Lee", "Uma Walker", "Victor Hall", "Wendy Allen",
-    "Xander Young", "Yara Hernandez", "Zack King", "Aaron Wright", "Bella Lopez", "Caleb Hill", "Daisy Scott", "Eli Green",
-    "Fiona Adams", "Gabe Baker", "Hazel Gonzalez", "Ian Nelson", "Jade Carter", "Kai Mitchell", "Luna Perez", "Mason Roberts",
-    "Nora Turner", "Owen Phillips", "Penny Campbell", "Quincy Parker", "Riley Evans", "Sofia Edwards", "Theo Collins",
-    "Ursula Stewart", "Violet Sanchez", "Wyatt Morris", "Xena Rogers", "Yvonne Reed", "Zane Cook", "Ava Morgan", "Blake Bell",
-    "Cora Murphy", "Dexter Bailey", "Eva Rivera", "Felix Cooper", "Gwen Richardson", "Hugo Cox", "Isla Howard", "Jake Ward",
-    "Kira Torres", "Liam Peterson", "Maya Gray", "Nolan Ramirez", "Olive James", "Peyton Watson", "Quinn Brooks",
-    "Rory Kelly", "Sadie Sanders", "Tobias Price", "Uma Bennett", "Vera Wood", "Wade Barnes", "Xyla Ross", "Yara Henderson",
-    "Zeke Coleman", "Aria Jenkins", "Brett Perry", "Clara Powell", "Dante Long", "Eliza Patterson", "Finn Hughes",
-    "Gia Flores", "Hank Washington", "Ivy Butler", "Jett Simmons", "Kara Foster", "Luca Gonzales", "Mila Bryant",
-    "Nash Alexander", "Ophelia Russell", "Parker Griffin", "Quinn Diaz", "Remy Hayes", "Sienna Myers", "Tucker Ford",
-    "Uma Chavez", "Violet Murray", "Wes Ortiz", "Xander Vargas", "Yara Simpson", "Zeke Crawford", "Avery Black",
-    "Brielle Holmes", "Cruz Stone", "Dahlia Meyer", "Emmett Boyd", "Freya Mills", "Gunner Warren", "Harlow Fox",
-    "Ira Rose", "Jax Lane", "Kira Rice", "Luca Moreno", "Maren Schmidt", "Nash Patel", "Olive Ferguson", "Peyton Nichols",
-    "Quinn Herrera", "Rory Medina", "Sadie Ryan", "Tobias Fernandez", "Uma Weber", "Vera Castillo", "Wade Harvey",
-    "Xyla Hoffman", "Yara Elliott", "Zeke Cunningham", "Aria Knight", "Brett Bradley", "Clara Carroll", "Dante Hudson",
-    "Eliza Duncan", "Finn Armstrong", "Gia Berry", "Hank Andrews", "Ivy Johnston", "Jett Ray", "Kara Lane"
-]
-
-# Example email subjects
-EMAIL_SUBJECTS = [
-    "Follow-up on Project Deadline",
-    "Meeting Reminder",
-    "Coffee Catch-Up",
-    "New Software Issues",
-    "Weekend Plans",
-    "Book Recommendation",
-    "Package Delivery Notification",
-    "Trip Recommendations",
-    "Report Submission",
-    "Action Items from Last Meeting"
-]
-
-# Example email body content for received emails
-RECEIVED_BODY = [
-    "Hi, I just wanted to check in and see how you're doing. It's been a while since we last talked.",
-    "I was thinking about our project deadline. Do you think we can meet it? Let's discuss tomorrow.",
-    "Remember that meeting we had last week? I think we should follow up on the action items.",
-    "I saw this interesting article and thought you might find it useful. Here's the link: [link]",
-    "Can you send me the report by EOD? I need to review it before the meeting tomorrow.",
-    "I'm planning a trip next month. Do you have any recommendations for places to visit?",
-    "I just finished reading that book you recommended. It was fantastic! Thanks for the suggestion.",
-    "I'm having some issues with the new software. Can you help me troubleshoot it?",
-    "Let's catch up this weekend. How about we grab a coffee on Saturday?",
-    "I just got a notification that your package has been delivered. Did you receive it?"
-]
-
-# Example email body content for sent emails (replies)
-SENT_BODY = [
-    "Hey! I'm doing well, thanks for checking in. How about you?",
-    "Yes, I think we can meet the deadline. Let's discuss the details tomorrow.",
-    "I agree. I'll send a follow-up email to the team today.",
-    "Thanks for sharing! I'll check it out later.",
-    "Sure, I'll send the report by EOD.",
-    "How about visiting the mountains? I heard it's beautiful this time of year.",
-    "I'm glad you liked it! Let me know if you want more recommendations.",
-    "Sure, I can help. What issues are you facing?",
-    "Sounds great! Let's meet at 10 AM on Saturday.",
-    "Yes, I received it. Thanks for letting me know!"
-]
-
-def generate_email_data():
+# Append-only store for email records (migrated from EMAIL_FILE on first use)
+email_store = open_store(EMAIL_FILE)
+
+# Day or week segments holding the email records older than the active window
+email_archive = SegmentArchive(email_store, "type")
+
+# Request timers and store gauges, exposed on /metrics
+instrument(app, [email_store])
+
+# Per-sender last-seen times and type counts, kept up to date on every collect
+email_index = email_store.subscribe(SenderIndex("type", email_archive))
+
+# Time-ordered index used to filter and paginate retrieval
+email_times = email_store.subscribe(TimeIndex("type"))
+
+# Staleness alerts pushed to subscribers as senders go quiet
+email_alerts = email_store.subscribe(
+    StalenessMonitor("email", email_index, STALE_AFTER_DAYS, STALE_INSIGHT, email_store)
+)
+
+# Full-text index of email subjects and bodies, kept on disk next to the store
+email_search = email_store.subscribe(SearchIndex(email_store, ["subject", "body"]))
+
+# Conversation threads, pairing received messages with their replies
+email_threads = email_store.subscribe(ThreadIndex("type", subject_field="subject"))
+
+# Hourly and daily email counts and reply latencies per sender, for the analytics endpoint
+email_rollups = email_store.subscribe(RollupIndex("type", email_threads))
+
+# Hashes of the stored and archived emails, so that retried syncs are not stored twice
+email_dedup = email_store.subscribe(DedupIndex(email_store, DEDUP_FIELDS[EMAIL_FILE], email_archive))
+
+def generate_email_thread(current_time):
+    """
+    Function to generate one two-way email thread: a received email and its reply.
+    """
+    records = []
+
+    # Randomly select a sender
+    sender = random.choice(NAMES)
+
+    # Generate a random datetime within the last 7 days for the first email
+    first_email_time = current_time - timedelta(
+        days=random.randint(0, 7),
+        hours=random.randint(0, 23),
+        minutes=random.randint(0, 59),
+        seconds=random.randint(0, 59)
+    )
+
+    # Create the first email (received)
+    records.append({
+        "datetime": first_email_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "sender": sender,
+        "type": "received",
+        "subject": random.choice(EMAIL_SUBJECTS),
+        "body": random.choice(RECEIVED_BODY),
+        "attachments": []  # No attachments for simplicity
+    })
+
+    # Generate a reply (sent) within a few minutes to an hour
+    reply_time = first_email_time + timedelta(
+        minutes=random.randint(1, 60),
+        seconds=random.randint(0, 59)
+    )
+
+    # Create the reply email (sent)
+    records.append({
+        "datetime": reply_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "sender": "Me",  # The user is the sender of the reply
+        "type": "sent",
+        "subject": f"Re: {random.choice(EMAIL_SUBJECTS)}",  # Add "Re:" to indicate a reply
+        "body": random.choice(SENT_BODY),
+        "attachments": []  # No attachments for simplicity
+    })
+
+    return records
+
+def generate_email_data(threads=250):
     """
     Function to generate pre-defined email data with two-way conversations and save it to the file.
     """
     email_data = []
     current_time = datetime.now()
 
-    for _ in range(250):  # Generate 250 email threads (500 emails in total)
-        # Randomly select a sender
-        sender = random.choice(NAMES)
-
-        # Generate a random datetime within the last 7 days for the first email
-        first_email_time = current_time - timedelta(
-            days=random.randint(0, 7),
-            hours=random.randint(0, 23),
-            minutes=random.randint(0, 59),
-            seconds=random.randint(0, 59)
-        )
-
-        # Create the first email (received)
-        email_data.append({
-            "datetime": first_email_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "sender": sender,
-            "type": "received",
-            "subject": random.choice(EMAIL_SUBJECTS),
-            "body": random.choice(RECEIVED_BODY),
-            "attachments": []  # No attachments for simplicity
-        })
-
-        # Generate a reply (sent) within a few minutes to an hour
-        reply_time = first_email_time + timedelta(
-            minutes=random.randint(1, 60),
-            seconds=random.randint(0, 59)
-        )
-
-        # Create the reply email (sent)
-        email_data.append({
-            "datetime": reply_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "sender": "Me",  # The user is the sender of the reply
-            "type": "sent",
-            "subject": f"Re: {random.choice(EMAIL_SUBJECTS)}",  # Add "Re:" to indicate a reply
-            "body": random.choice(SENT_BODY),
-            "attachments": []  # No attachments for simplicity
-        })
+    for _ in range(threads):  # Generate 250 email threads by default (500 emails in total)
+        email_data.extend(generate_email_thread(current_time))
 
     # Save the generated data
-    with open(EMAIL_FILE, "w", encoding="utf-8") as f:
-        json.dump(email_data, f, indent=4, ensure_ascii=False)
+    email_store.replace(email_data)
+
+def validate_email(data):
+    """
+    Function to validate an email record.
+    Returns an error message, or None if the record is valid.
+    """
+    # Validate required fields
+    if not isinstance(data, dict) or not all(key in data for key in ["datetime", "sender", "type", "subject", "body"]):
+        return "Missing required fields"
+
+    # Validate field types
+    for key in ["sender", "subject", "body"]:
+        if not isinstance(data[key], str):
+            return f"Invalid {key}. Must be a string"
+    if not isinstance(data.get("attachments", []), list):
+        return "Invalid attachments. Must be a list"
+
+    # Parse datetime
+    try:
+        parse_timestamp(data["datetime"])
+    except (TypeError, ValueError):
+        return "Invalid datetime format. Use 'YYYY-MM-DD HH:MM:SS'"
+
+    return None
 
 @app.route('/collect_email', methods=['POST'])
 def collect_email():
@@ -146,83 +164,212 @@ def collect_email():
         # Get JSON data from the request
         data = request.json
 
-        # Validate required fields
-        if not all(key in data for key in ["datetime", "sender", "type", "subject", "body"]):
-            return jsonify({"status": "error", "message": "Missing required fields"}), 400
+        # Validate the record
+        with phase("validate"):
+            error = validate_email(data)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
 
-        # Parse datetime
-        try:
-            datetime.strptime(data["datetime"], "%Y-%m-%d %H:%M:%S")
-        except ValueError:
-            return jsonify({"status": "error", "message": "Invalid datetime format. Use 'YYYY-MM-DD HH:MM:SS'"}), 400
+        # Append new email data, unless it was already collected (e.g. by a retried sync)
+        if email_dedup.extend([data]):
+            return jsonify({"status": "success", "message": "Email data already collected", "duplicate": True}), 200
 
-        # Load existing data
-        with open(EMAIL_FILE, "r", encoding="utf-8") as f:
-            email_data = json.load(f)
-
-        # Append new email data
-        email_data.append(data)
+        return jsonify({"status": "success", "message": "Email data collected successfully"}), 200
 
-        # Save updated data
-        with open(EMAIL_FILE, "w", encoding="utf-8") as f:
-            json.dump(email_data, f, indent=4, ensure_ascii=False)
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        return jsonify({"status": "success", "message": "Email data collected successfully"}), 200
+@app.route('/collect_email_batch', methods=['POST'])
+def collect_email_batch():
+    """
+    Endpoint to collect many email records at once.
+    Accepts a JSON array of email records, or NDJSON (one record per line)
+    with Content-Type: application/x-ndjson. Each record is validated like
+    /collect_email, and the accepted records are stored in one write. Records
+    already stored are counted as duplicates and not written again.
+    """
+    try:
+        entries = read_batch(request)
+    except PayloadError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
 
+    try:
+        return jsonify(collect_batch(email_store, entries, validate_email, email_dedup)), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/get_email_data', methods=['GET'])
+@cached([email_store])
 def get_email_data():
     """
-    Endpoint to retrieve all collected email data.
+    Endpoint to retrieve collected email data.
+    Optional query parameters:
+        sender=Sender Name
+        type=received/sent
+        start=YYYY-MM-DD HH:MM:SS, end=YYYY-MM-DD HH:MM:SS (inclusive range)
+        limit=N and cursor=<next_cursor from the previous page>
+        format=ndjson to stream the records as NDJSON
     """
     try:
-        with open(EMAIL_FILE, "r", encoding="utf-8") as f:
-            email_data = json.load(f)
-        return jsonify({"status": "success", "data": email_data}), 200
+        return get_records(email_store, email_times, request.args, "type", email_archive), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/analyze_emails', methods=['GET'])
+@cached([email_store], expires=staleness_expiry(email_index, STALE_AFTER_DAYS))
 def analyze_emails():
     """
     Endpoint to analyze email data and provide insights.
+    Optional query parameter: days=N, the number of days without an email before
+    a sender is reported (defaults to STALE_AFTER_DAYS). With keys=1, the
+    sender of every insight and the cutoff time are included too.
     """
     try:
-        with open(EMAIL_FILE, "r", encoding="utf-8") as f:
-            email_data = json.load(f)
+        days = parse_days(request.args, STALE_AFTER_DAYS)
 
         # Get the current time
         current_time = datetime.now()
 
-        # Dictionary to store the last email time for each sender
-        last_email_times = {}
+        # Generate insights for senders with no email in the last N days
+        cutoff = to_epoch(current_time - timedelta(days=days))
+        senders = email_index.stale_senders(cutoff)
+        insights = []
+        for sender in senders:
+            insights.append(STALE_INSIGHT.format(sender=sender))
 
-        # Analyze email data
-        for email in email_data:
-            sender = email["sender"]
-            email_time = datetime.strptime(email["datetime"], "%Y-%m-%d %H:%M:%S")
+        # Name the sender of every insight for the shard router, which merges them
+        response = {"status": "success", "insights": insights}
+        if request.args.get("keys") == "1":
+            response.update({"senders": senders, "cutoff": format_timestamp(cutoff)})
+        return jsonify(response), 200
 
-            # Update the last email time for the sender
-            if sender not in last_email_times or email_time > last_email_times[sender]:
-                last_email_times[sender] = email_time
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        # Generate insights
-        insights = []
-        for sender, last_email in last_email_times.items():
-            time_since_last_email = current_time - last_email
-            if time_since_last_email > timedelta(days=7):  # If no email in the last 7 days
-                insights.append(f"{sender} hasn't emailed in a while. Check on them!")
+@app.route('/search_emails', methods=['GET'])
+@cached([email_store])
+def search_emails():
+    """
+    Endpoint to search email subjects and bodies, best match first.
+    Query parameters:
+        q=words to find: word, prefix* or "exact phrase" (all must match)
+    Optional query parameters:
+        sender=Sender Name
+        start=YYYY-MM-DD HH:MM:SS, end=YYYY-MM-DD HH:MM:SS (inclusive range)
+        limit=N and cursor=<next_cursor from the previous page>
+    """
+    try:
+        return search_records(email_search, request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/email_threads', methods=['GET'])
+@cached([email_store])
+def get_email_threads():
+    """
+    Endpoint to list email conversation threads, newest first.
+    Optional query parameters:
+        thread=<thread_id> to get one thread and its records
+        sender=Sender Name
+        limit=N (default 100) and cursor=<next_cursor from the previous page>
+    """
+    try:
+        return get_threads(email_store, email_threads, request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/email_reply_times', methods=['GET'])
+@cached([email_store])
+def get_email_reply_times():
+    """
+    Endpoint to get reply latency statistics per contact, in seconds.
+    Optional query parameter: sender=Sender Name
+    """
+    try:
+        return get_reply_times(email_threads, request.args), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@shard_api.route('/email_reply_parents', methods=['POST'])
+def get_email_reply_parents():
+    """
+    Endpoint to find the threads sent email records would reply to, without storing them.
+    Used by the shard router to store replies with the thread they answer.
+    Expects a JSON array of sent email records, and returns whether each is stored
+    already, and the threads waiting for a reply, most recently waiting first.
+    """
+    try:
+        records = request.get_json(silent=True)
+        stored = email_dedup.contains(records) if isinstance(records, list) else []
+        return get_reply_parents(email_threads, records, stored), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/email_unanswered', methods=['GET'])
+@cached([email_store])
+def get_email_unanswered():
+    """
+    Endpoint to list received emails still waiting for a reply, oldest first.
+    Optional query parameters:
+        sender=Sender Name
+        limit=N (default 100) and cursor=<next_cursor from the previous page>
+    """
+    try:
+        return get_unanswered(email_store, email_threads, request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        return jsonify({"status": "success", "insights": insights}), 200
+@app.route('/email_alerts', methods=['GET'])
+def get_email_alerts():
+    """
+    Endpoint to long-poll staleness alerts, fired as email senders go quiet.
+    Optional query parameters:
+        after=<last_id from the previous response>
+        timeout=N seconds to wait for a new alert (up to 60)
+    """
+    try:
+        return poll_alerts("email", request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/email_alerts/stream', methods=['GET'])
+def stream_email_alerts():
+    """
+    Endpoint to subscribe to email staleness alerts as server-sent events.
+    Optional query parameter: after=<id of the last alert received>; reconnecting
+    clients resume from their Last-Event-ID header.
+    """
+    try:
+        return stream_alerts("email", request.args, request.headers.get("Last-Event-ID")), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 if __name__ == '__main__':
-    # Generate the email data once at the start
-    generate_email_data()
+    if DEBUG and not is_running_from_reloader():
+        # The reloader's child process serves the app, so it writes the store
+        email_store.close()
+    else:
+        # Generate the email data once at the start
+        generate_email_data()
+
+        # Move records older than the active window into segments, now and periodically
+        email_archive.start_maintenance()
 
     # Run the Flask app
-    app.run(debug=True)
+    app.run(debug=DEBUG)
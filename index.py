@@ -0,0 +1,460 @@
+from bisect import bisect_left, bisect_right, insort
+from calendar import timegm
+from datetime import date, datetime
+from heapq import merge
+from itertools import islice
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Timestamp of records whose datetime could not be parsed
+MISSING_TIME = -(2 ** 63)
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Lookup tables for the time of day in 'HH:MM' and 'SS' form
+_MINUTE_SECONDS = {f"{hour:02d}:{minute:02d}": hour * 3600 + minute * 60 for hour in range(24) for minute in range(60)}
+_SECONDS = {f"{second:02d}": second for second in range(60)}
+
+# Start of day in epoch seconds for recently parsed dates
+DAY_CACHE_SIZE = 100000
+_day_cache = {}
+
+
+def to_epoch(value):
+    """
+    Function to convert a naive datetime into integer seconds, keeping wall-clock time.
+    """
+    return timegm(value.timetuple())
+
+
+def _parse_day(value):
+    """
+    Function to get the epoch seconds at the start of a 'YYYY-MM-DD' day, or None if malformed.
+    """
+    seconds = _day_cache.get(value)
+    if seconds is None:
+        digits = value[0:4] + value[5:7] + value[8:10]
+        if value[4] != "-" or value[7] != "-" or not (digits.isascii() and digits.isdigit()):
+            return None
+        try:
+            seconds = (date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal() - EPOCH_ORDINAL) * 86400
+        except ValueError:
+            return None
+        if len(_day_cache) >= DAY_CACHE_SIZE:
+            _day_cache.clear()
+        _day_cache[value] = seconds
+    return seconds
+
+
+def parse_timestamp(value):
+    """
+    Function to parse a 'YYYY-MM-DD HH:MM:SS' string into epoch seconds.
+    Values in exactly that form are parsed with lookup tables; anything else
+    goes through strptime, so the accepted inputs are unchanged.
+    Raises ValueError or TypeError for invalid values.
+    """
+    if len(value) == 19 and value[10] == " " and value[16] == ":":
+        day = _parse_day(value[:10])
+        minutes = _MINUTE_SECONDS.get(value[11:16])
+        second = _SECONDS.get(value[17:19])
+        if day is not None and minutes is not None and second is not None:
+            return day + minutes + second
+    return to_epoch(datetime.strptime(value, DATETIME_FORMAT))
+
+
+def format_timestamp(seconds):
+    """
+    Function to format epoch seconds as a 'YYYY-MM-DD HH:MM:SS' string.
+    """
+    days, seconds = divmod(seconds, 86400)
+    day = date.fromordinal(days + EPOCH_ORDINAL)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return f"{day.year:04d}-{day.month:02d}-{day.day:02d} {hour:02d}:{minute:02d}:{second:02d}"
+
+
+def indexable(value):
+    """
+    Function to check that a field value can key an index: a string, or None when absent.
+    Records with a sender or type of any other kind are left out of the indexes.
+    """
+    return value is None or isinstance(value, str)
+
+
+def _indexable_codes(values):
+    """
+    Function to flag the dictionary values of a snapshot column that can key an index.
+    """
+    return np.array([indexable(value) for value in values], dtype=bool)
+
+
+def _column(snapshot, field):
+    """
+    Function to get the codes of a snapshot field and its values, with code -1 mapped to None.
+    """
+    if field not in snapshot.columns:
+        return np.full(len(snapshot), -1, np.int64), [None]
+    return snapshot.columns[field].astype(np.int64), list(snapshot.dictionaries[field]) + [None]
+
+
+class SenderIndex:
+    """
+    In-memory per-sender summary of a record store.
+
+    Keeps the last time each sender was seen (as epoch seconds) and how many
+    records of each type (e.g. incoming/outgoing or received/sent) they have.
+    Subscribed to a RecordStore, it is built once from the log and then
+    updated with every commit, so analyze handlers never rescan the stored
+    records, and compare integers rather than datetimes. Given the store's
+    SegmentArchive, it also counts the records archived out of the store,
+    and skips the stored copies of those until the store has been trimmed.
+    """
+
+    def __init__(self, type_field, archive=None):
+        # Record field holding the type/direction ("log_type" or "type")
+        self.type_field = type_field
+        self.archive = archive
+        self._lock = threading.Lock()
+        self.last_seen = {}
+        self.counts = {}
+
+    def _add_archived(self):
+        """
+        Function to fold the per-sender summaries of the archived records into the index.
+        """
+        if self.archive is None:
+            return
+        for sender, (last_seen, counts) in self.archive.senders().items():
+            if sender not in self.last_seen or last_seen > self.last_seen[sender]:
+                self.last_seen[sender] = last_seen
+            sender_counts = self.counts.setdefault(sender, {})
+            for record_type, count in counts.items():
+                sender_counts[record_type] = sender_counts.get(record_type, 0) + count
+
+    def _pending_cutoff(self):
+        return self.archive.pending_cutoff() if self.archive is not None else None
+
+    def rebuild(self, records):
+        """
+        Function to rebuild the index from scratch.
+        """
+        with self._lock:
+            self.last_seen = {}
+            self.counts = {}
+            self._add_archived()
+            self._add(records)
+
+    def rebuild_snapshot(self, snapshot):
+        """
+        Function to rebuild the index from the columns of a store snapshot.
+        """
+        with self._lock:
+            self.last_seen = {}
+            self.counts = {}
+            sender_codes, senders = _column(snapshot, "sender")
+            type_codes, types = _column(snapshot, self.type_field)
+            type_codes[type_codes < 0] = len(types) - 1
+
+            # Only records with a string sender, an indexable type and a valid datetime are counted
+            valid = (sender_codes >= 0) & (snapshot.timestamps != MISSING_TIME) \
+                & _indexable_codes(senders)[sender_codes] & _indexable_codes(types)[type_codes]
+
+            # Records already archived are counted from the archive
+            pending = self._pending_cutoff()
+            if pending is not None:
+                valid &= snapshot.timestamps >= pending
+            sender_codes = sender_codes[valid]
+            type_codes = type_codes[valid]
+            times = snapshot.timestamps[valid]
+
+            # Latest time and per-type counts for every sender code
+            last = np.full(len(senders), MISSING_TIME, np.int64)
+            np.maximum.at(last, sender_codes, times)
+            counts = np.bincount(sender_codes * len(types) + type_codes, minlength=len(senders) * len(types))
+            counts = counts.reshape(len(senders), len(types))
+
+            for code in np.flatnonzero(last != MISSING_TIME).tolist():
+                sender = senders[code]
+                self.last_seen[sender] = int(last[code])
+                self.counts[sender] = {types[t]: int(n) for t, n in enumerate(counts[code].tolist()) if n}
+            self._add_archived()
+
+    def add(self, records):
+        """
+        Function to update the index with newly stored records.
+        """
+        with self._lock:
+            self._add(records)
+
+    def _add(self, records):
+        pending = self._pending_cutoff()
+        for record in records:
+            try:
+                sender = record["sender"]
+                record_time = parse_timestamp(record["datetime"])
+                record_type = record.get(self.type_field)
+                if not isinstance(sender, str) or not indexable(record_type):
+                    continue
+            except (KeyError, TypeError, ValueError):
+                # Skip records the index cannot place
+                continue
+            if pending is not None and record_time < pending:
+                # Already counted from the archive
+                continue
+
+            # Update the last time the sender was seen
+            if sender not in self.last_seen or record_time > self.last_seen[sender]:
+                self.last_seen[sender] = record_time
+
+            # Count records by type
+            sender_counts = self.counts.setdefault(sender, {})
+            sender_counts[record_type] = sender_counts.get(record_type, 0) + 1
+
+    def stale_senders(self, cutoff):
+        """
+        Function to list senders not seen since the cutoff (epoch seconds).
+        """
+        with self._lock:
+            return [sender for sender, last in self.last_seen.items() if last < cutoff]
+
+    def next_stale(self, cutoff):
+        """
+        Function to get the earliest last-seen time not yet older than the cutoff.
+        The stale_senders() result for a later cutoff only changes once the
+        cutoff passes this time (or a record is added). Returns None if every
+        sender is already stale.
+        """
+        with self._lock:
+            return min((last for last in self.last_seen.values() if last >= cutoff), default=None)
+
+    def senders(self):
+        """
+        Function to get a copy of every sender's last-seen time (epoch seconds) and type counts.
+        """
+        with self._lock:
+            return {
+                sender: (last, dict(self.counts[sender]))
+                for sender, last in self.last_seen.items()
+            }
+
+    def last_seen_times(self, senders=None):
+        """
+        Function to get the last-seen time (epoch seconds) of the given senders, or of every sender.
+        """
+        with self._lock:
+            if senders is None:
+                return dict(self.last_seen)
+            return {sender: self.last_seen[sender] for sender in senders if sender in self.last_seen}
+
+    def sender_summary(self, sender):
+        """
+        Function to get the last-seen time and type counts for a sender.
+        """
+        with self._lock:
+            if sender not in self.last_seen:
+                return None
+            return {
+                "last_seen": format_timestamp(self.last_seen[sender]),
+                "counts": dict(self.counts[sender])
+            }
+
+
+class TimeIndex:
+    """
+    In-memory index of a record store ordered by record datetime.
+
+    Holds (timestamp, record number) pairs sorted by time, for all records and
+    per sender and per type, so filtered and paginated queries only touch the
+    matching records. Record numbers are positions in the store, as used by
+    RecordStore.read_records().
+
+    When the store has a snapshot, the snapshot records are kept as sorted
+    NumPy arrays built in one pass over its columns, and only records stored
+    after it go into the Python lists; queries merge the two.
+    """
+
+    def __init__(self, type_field):
+        # Record field holding the type/direction ("log_type" or "type")
+        self.type_field = type_field
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self._all = []
+        self._by_sender = {}
+        self._by_type = {}
+        self._types = []
+
+        # Sorted (times, record numbers) arrays for the snapshot records
+        self._base_count = 0
+        self._base = None
+        self._base_by_sender = {}
+        self._base_by_type = {}
+        self._base_types = None
+        self._base_type_codes = {}
+
+    def rebuild(self, records):
+        """
+        Function to rebuild the index from scratch.
+        """
+        with self._lock:
+            self._reset()
+            self._add(records)
+
+    def rebuild_snapshot(self, snapshot):
+        """
+        Function to rebuild the index from the columns of a store snapshot.
+        """
+        with self._lock:
+            self._reset()
+            self.count = self._base_count = len(snapshot)
+
+            # Records without a valid datetime, or with a sender or type that
+            # cannot key the index, cannot be queried
+            sender_codes, senders = _column(snapshot, "sender")
+            type_codes, types = _column(snapshot, self.type_field)
+            seqs = np.flatnonzero((snapshot.timestamps != MISSING_TIME)
+                                  & _indexable_codes(senders)[sender_codes] & _indexable_codes(types)[type_codes])
+            times = snapshot.timestamps[seqs]
+            order = np.argsort(times, kind="stable")
+            self._base = (times[order], seqs[order])
+
+            self._base_by_sender = self._group(snapshot, "sender", times, seqs)
+            self._base_by_type = self._group(snapshot, self.type_field, times, seqs)
+            self._base_types = type_codes
+            self._base_type_codes = {value: code for code, value in enumerate(types[:-1]) if indexable(value)}
+
+    def _group(self, snapshot, field, times, seqs):
+        """
+        Function to split time-sorted record numbers by the value of a field.
+        """
+        codes, values = _column(snapshot, field)
+        codes = codes[seqs]
+
+        # Sort by code, then time; the sort is stable so record numbers stay ordered
+        order = np.lexsort((times, codes))
+        codes, times, seqs = codes[order], times[order], seqs[order]
+        bounds = np.searchsorted(codes, np.arange(-1, len(values)))
+        groups = {}
+        for code in range(-1, len(values) - 1):
+            lo, hi = bounds[code + 1], bounds[code + 2]
+            if lo < hi:
+                groups[values[code]] = (times[lo:hi], seqs[lo:hi])
+        return groups
+
+    def add(self, records):
+        """
+        Function to update the index with newly stored records.
+        """
+        with self._lock:
+            self._add(records)
+
+    def _add(self, records):
+        for record in records:
+            seq = self.count
+            self.count += 1
+            sender = record.get("sender")
+            record_type = record.get(self.type_field)
+            self._types.append(record_type)
+            if not indexable(sender) or not indexable(record_type):
+                # Records whose sender or type cannot key the index cannot be queried
+                continue
+            try:
+                key = (parse_timestamp(record["datetime"]), seq)
+            except (KeyError, TypeError, ValueError):
+                # Records without a valid datetime cannot be queried by time
+                continue
+
+            # Records mostly arrive in time order, so inserts land near the end
+            insort(self._all, key)
+            insort(self._by_sender.setdefault(sender, []), key)
+            insort(self._by_type.setdefault(record_type, []), key)
+
+    def query(self, sender=None, record_type=None, start=None, end=None, after=None, limit=None):
+        """
+        Function to find matching records in time order.
+        start and end are inclusive epoch seconds, and after is the
+        (timestamp, record number) key of the last record already returned.
+        Returns a list of (timestamp, record number) keys.
+        """
+        with self._lock:
+            # Scan the most selective time-ordered list
+            if sender is not None:
+                keys = self._by_sender.get(sender, [])
+                base = self._base_by_sender.get(sender)
+            elif record_type is not None:
+                keys = self._by_type.get(record_type, [])
+                base = self._base_by_type.get(record_type)
+            else:
+                keys = self._all
+                base = self._base
+
+            # Narrow the scan to the requested time range
+            lo = 0
+            if start is not None:
+                lo = bisect_left(keys, (start, -1))
+            if after is not None:
+                lo = max(lo, bisect_right(keys, after))
+            hi = len(keys)
+            if end is not None:
+                hi = bisect_right(keys, (end, self.count))
+
+            results = []
+            for i in range(lo, hi):
+                key = keys[i]
+                if record_type is not None and self._types[key[1] - self._base_count] != record_type:
+                    continue
+                results.append(key)
+                if limit is not None and len(results) >= limit:
+                    break
+
+            # Merge in the matching snapshot records
+            if base is not None:
+                type_filter = record_type if sender is not None else None
+                base_results = self._query_base(base, type_filter, start, end, after, limit)
+                results = list(islice(merge(base_results, results), limit))
+            return results
+
+    def _query_base(self, base, record_type, start, end, after, limit):
+        """
+        Function to find matching snapshot records in a sorted (times, record numbers) pair.
+        """
+        times, seqs = base
+        lo = 0
+        if start is not None:
+            lo = int(np.searchsorted(times, start, "left"))
+        if after is not None:
+            # Skip past the after key: first by time, then by record number among equal times
+            first = int(np.searchsorted(times, after[0], "left"))
+            last = int(np.searchsorted(times, after[0], "right"))
+            lo = max(lo, first + int(np.searchsorted(seqs[first:last], after[1], "right")))
+        hi = len(times)
+        if end is not None:
+            hi = int(np.searchsorted(times, end, "right"))
+
+        if record_type is None:
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            return list(zip(times[lo:hi].tolist(), seqs[lo:hi].tolist()))
+
+        # Filter by type in growing windows until the limit is reached
+        code = self._base_type_codes.get(record_type)
+        if code is None:
+            return []
+        results = []
+        window = max(limit or 0, 1024)
+        while lo < hi and (limit is None or len(results) < limit):
+            stop = min(hi, lo + window)
+            window_seqs = seqs[lo:stop]
+            mask = self._base_types[window_seqs] == code
+            results.extend(zip(times[lo:stop][mask].tolist(), window_seqs[mask].tolist()))
+            lo = stop
+            window *= 2
+        return results[:limit]
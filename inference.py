@@ -0,0 +1,425 @@
+from flask import Flask, request, jsonify
+from concurrent.futures import Future
+import argparse
+import copy
+import hashlib
+import re
+import threading
+import time
+
+from storage import open_store
+
+app = Flask(__name__)
+
+# GPTQ 4-bit model, used when a CUDA GPU is available
+MODEL_NAME = "ModelCloud/DeepSeek-R1-Distill-Qwen-7B-gptqmodel-4bit-vortex-v1"
+
+# Unquantized model for CPU-only machines (GPTQ kernels need a GPU); quantized to int8 at load time
+FALLBACK_MODEL_NAME = "deepseek-ai/DeepSeek-R1-Distill-Qwen-1.5B"
+
+# Largest number of messages generated together
+MAX_BATCH_SIZE = 8
+
+# Time the worker waits for more requests before running a batch (seconds)
+BATCH_WAIT = 0.02
+
+# Tokens generated per message
+MAX_NEW_TOKENS = 128
+
+# File memoizing results per task, model and message content
+RESULT_CACHE_FILE = "inference_cache.json"
+
+# Shared prompt prefix per task; its KV cache is computed once and reused
+SYSTEM_PROMPTS = {
+    "summarize": "You summarize personal messages. Reply with a one-sentence summary of the message.\n\nMessage:\n",
+    "classify": "You classify personal messages. Reply with exactly one label from: "
+                "work, social, logistics, support, other.\n\nMessage:\n"
+}
+
+# Text placed after each message
+ANSWER_SUFFIX = "\n\nAnswer:"
+
+# Field holding the message text in each store
+TEXT_FIELDS = {"sms": "content", "email": "body"}
+
+
+def record_key(task, model_name, text):
+    """
+    Function to hash a message for the result cache.
+    """
+    return hashlib.sha256(f"{task}\0{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+def clean_output(text):
+    """
+    Function to strip the reasoning block that R1-distilled models emit before the answer.
+    """
+    text = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL)
+    if "</think>" in text:
+        text = text.split("</think>", 1)[1]
+    return text.strip()
+
+
+class TransformersBackend:
+    """
+    Causal language model loaded once with Hugging Face transformers.
+
+    Uses the GPTQ model on GPU, and an int8 dynamically quantized fallback on
+    CPU. The KV cache of each task's system prompt is computed once and copied
+    into every batch, so only the message tokens are run through the model.
+    Any local model directory (e.g. a tiny test model) can be passed as model_name.
+    """
+
+    def __init__(self, model_name=None, device=None, max_new_tokens=MAX_NEW_TOKENS):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.torch = torch
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model_name = model_name or (MODEL_NAME if self.device == "cuda" else FALLBACK_MODEL_NAME)
+        self.max_new_tokens = max_new_tokens
+
+        # Load the tokenizer, padding on the left so batched prompts end together
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # Load the model
+        if self.device == "cuda":
+            model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float16, device_map="auto")
+        else:
+            model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        model.eval()
+        self.model = model
+
+        # KV caches of the shared system prompts
+        self._prefix_cache = {}
+
+    def _prefix(self, prompt):
+        """
+        Function to get the token ids and KV cache of a shared prompt prefix.
+        """
+        if prompt not in self._prefix_cache:
+            from transformers import DynamicCache
+
+            ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.model.device)
+            with self.torch.no_grad():
+                cache = self.model(ids, use_cache=True).past_key_values
+            if isinstance(cache, tuple):
+                cache = DynamicCache.from_legacy_cache(cache)
+            self._prefix_cache[prompt] = (ids, cache)
+        return self._prefix_cache[prompt]
+
+    def generate(self, prefix, prompts):
+        """
+        Function to generate a completion for each prompt, all starting with prefix.
+        """
+        torch = self.torch
+        prefix_ids, prefix_cache = self._prefix(prefix)
+        count = len(prompts)
+
+        # Tokenize only the per-message part; pads sit between prefix and message
+        suffix = self.tokenizer(prompts, add_special_tokens=False, padding=True, return_tensors="pt").to(self.model.device)
+        input_ids = torch.cat([prefix_ids.expand(count, -1), suffix.input_ids], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids).expand(count, -1), suffix.attention_mask], dim=1)
+
+        # Copy the prefix cache for this batch
+        cache = copy.deepcopy(prefix_cache)
+        if count > 1:
+            cache.batch_repeat_interleave(count)
+
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=cache,
+                max_new_tokens=self.max_new_tokens,
+                do_sample=False,
+                pad_token_id=self.tokenizer.pad_token_id
+            )
+        return self.tokenizer.batch_decode(output[:, input_ids.shape[1]:], skip_special_tokens=True)
+
+
+class ResultCache:
+    """
+    Memoized results, rebuilt from and appended to a record store.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.results = {}
+
+    def rebuild(self, records):
+        with self._lock:
+            self.results = {}
+            for record in records:
+                self.results[record["key"]] = record["result"]
+
+    def add(self, records):
+        with self._lock:
+            for record in records:
+                self.results[record["key"]] = record["result"]
+
+    def get(self, key):
+        with self._lock:
+            return self.results.get(key)
+
+
+class InferenceWorker:
+    """
+    Long-lived worker that micro-batches inference requests.
+
+    Requests arriving within BATCH_WAIT of each other are generated together,
+    up to MAX_BATCH_SIZE per task. Results are memoized by task, model and
+    message hash, so the same content never goes through the model twice.
+    The backend only needs a model_name and generate(prefix, prompts).
+    """
+
+    def __init__(self, backend, cache_file=RESULT_CACHE_FILE, max_batch_size=MAX_BATCH_SIZE, batch_wait=BATCH_WAIT):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+
+        # Memoized results
+        self.cache_store = open_store(cache_file)
+        self.cache = self.cache_store.subscribe(ResultCache())
+
+        # Requests waiting for the model, and futures for requests in flight
+        self._pending = []
+        self._pending_cond = threading.Condition()
+        self._inflight = {}
+
+        # Counters
+        self.requests = 0
+        self.cache_hits = 0
+        self.generated = 0
+        self.batches = 0
+
+        self._thread = threading.Thread(target=self._run, name="inference-worker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, task, text):
+        """
+        Function to queue a message for a task. Returns a Future with the result.
+        """
+        if task not in SYSTEM_PROMPTS:
+            raise ValueError(f"Unknown task '{task}'. Must be one of: {', '.join(SYSTEM_PROMPTS)}")
+
+        key = record_key(task, self.backend.model_name, text)
+        with self._pending_cond:
+            self.requests += 1
+
+            # Serve memoized results without touching the model
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache_hits += 1
+                future = Future()
+                future.set_result(cached)
+                return future
+
+            # Share the result of an identical request already queued
+            if key in self._inflight:
+                self.cache_hits += 1
+                return self._inflight[key]
+
+            future = Future()
+            self._inflight[key] = future
+            self._pending.append((task, text, key, future))
+            self._pending_cond.notify()
+            return future
+
+    def run(self, task, texts, timeout=None):
+        """
+        Function to process several messages and wait for all results.
+        """
+        futures = [self.submit(task, text) for text in texts]
+        return [future.result(timeout) for future in futures]
+
+    def _run(self):
+        """
+        Function run by the worker thread to generate pending requests in batches.
+        """
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+
+            # Give concurrent requests a moment to join this batch
+            if self.batch_wait:
+                time.sleep(self.batch_wait)
+
+            # Take one batch of a single task
+            with self._pending_cond:
+                task = self._pending[0][0]
+                batch = [item for item in self._pending if item[0] == task][:self.max_batch_size]
+                taken = set(id(item) for item in batch)
+                self._pending = [item for item in self._pending if id(item) not in taken]
+
+            self._generate(task, batch)
+
+    def _generate(self, task, batch):
+        """
+        Function to run one batch through the model and resolve its futures.
+        """
+        try:
+            outputs = self.backend.generate(SYSTEM_PROMPTS[task], [text + ANSWER_SUFFIX for _, text, _, _ in batch])
+            results = [clean_output(output) for output in outputs]
+            self.cache_store.extend([{"key": key, "result": result} for (_, _, key, _), result in zip(batch, results)])
+        except Exception as e:
+            with self._pending_cond:
+                for _, _, key, future in batch:
+                    self._inflight.pop(key, None)
+                    future.set_exception(e)
+            return
+
+        with self._pending_cond:
+            self.generated += len(batch)
+            self.batches += 1
+            for (_, _, key, future), result in zip(batch, results):
+                self._inflight.pop(key, None)
+                future.set_result(result)
+
+    def stats(self):
+        """
+        Function to report request, cache and batching counters.
+        """
+        return {
+            "model": self.backend.model_name,
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "generated": self.generated,
+            "batches": self.batches,
+            "avg_batch_size": self.generated / self.batches if self.batches else 0.0,
+            "pending": len(self._pending)
+        }
+
+
+class WorkerUnavailable(RuntimeError):
+    """
+    Raised when the inference worker cannot be started, e.g. without torch or the model.
+    """
+
+
+# Worker shared by all requests, created by start_worker() or by the first request
+worker = None
+_worker_lock = threading.Lock()
+
+
+def start_worker(backend=None, **kwargs):
+    """
+    Function to load the model and start the shared inference worker.
+    """
+    global worker
+    with _worker_lock:
+        worker = InferenceWorker(backend or TransformersBackend(), **kwargs)
+    return worker
+
+
+def get_worker():
+    """
+    Function to get the shared inference worker, loading the default model on first
+    use when the app is imported or mounted without calling start_worker().
+    """
+    global worker
+    with _worker_lock:
+        if worker is None:
+            try:
+                worker = InferenceWorker(TransformersBackend())
+            except Exception as e:
+                raise WorkerUnavailable(f"Inference model unavailable: {e}")
+        return worker
+
+
+def source_store(source):
+    """
+    Function to get the record store holding SMS or email messages.
+    """
+    if source == "sms":
+        from sms import sms_store
+        return sms_store
+    if source == "email":
+        from email_log import email_store
+        return email_store
+    raise ValueError("Invalid source. Must be 'sms' or 'email'")
+
+
+@app.route('/analyze_messages', methods=['POST'])
+def analyze_messages():
+    """
+    Endpoint to summarize or classify message texts.
+    Expected JSON payload:
+    {
+        "task": "summarize" or "classify",
+        "texts": ["message text", ...]
+    }
+    """
+    try:
+        data = request.json
+        if not isinstance(data, dict) or "task" not in data or not isinstance(data.get("texts"), list):
+            return jsonify({"status": "error", "message": "Missing required fields"}), 400
+        results = get_worker().run(data["task"], [str(text) for text in data["texts"]])
+        return jsonify({"status": "success", "results": results}), 200
+    except WorkerUnavailable as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/analyze_stored_messages', methods=['GET'])
+def analyze_stored_messages():
+    """
+    Endpoint to summarize or classify the latest stored SMS contents or email bodies.
+    Query parameters: source=sms/email, task=summarize/classify, limit=N (default 10).
+    """
+    try:
+        source = request.args.get("source", "sms")
+        task = request.args.get("task", "summarize")
+        limit = int(request.args.get("limit", 10))
+        if limit <= 0:
+            raise ValueError("Invalid limit. Must be a positive integer")
+
+        # Read only the latest records
+        store = source_store(source)
+        store.refresh()
+        total = len(store)
+        records = store.read_records(range(max(0, total - limit), total))
+
+        results = get_worker().run(task, [str(record.get(TEXT_FIELDS[source], "")) for record in records])
+        data = [dict(record, result=result) for record, result in zip(records, results)]
+        return jsonify({"status": "success", "data": data}), 200
+    except WorkerUnavailable as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/inference_stats', methods=['GET'])
+def inference_stats():
+    """
+    Endpoint to retrieve the inference worker counters.
+    The model is not loaded just to report them.
+    """
+    if worker is None:
+        return jsonify({"status": "error", "message": "Inference model not loaded yet"}), 503
+    return jsonify({"status": "success", "stats": worker.stats()}), 200
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the message inference service.")
+    parser.add_argument("--model", help="model name or local path (default depends on the device)")
+    parser.add_argument("--device", choices=["cuda", "cpu"], help="device to run on (default: cuda if available)")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    # Load the model once, before serving
+    start_worker(TransformersBackend(args.model, args.device))
+
+    # Run the Flask app; the reloader would load the model a second time
+    app.run(port=args.port, use_reloader=False)
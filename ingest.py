@@ -0,0 +1,74 @@
+import json
+
+from metrics import phase
+
+# Content types treated as newline-delimited JSON
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+class PayloadError(ValueError):
+    """
+    Raised when a batch payload cannot be read at all.
+    """
+
+
+def read_batch(request):
+    """
+    Function to read a batch of records from a request.
+    Accepts a JSON array, or NDJSON (one record per line) when sent with an
+    NDJSON content type. Returns a list of (record, error) pairs so that a
+    malformed NDJSON line is reported against its position in the batch.
+    """
+    if request.mimetype in NDJSON_TYPES:
+        entries = []
+        with phase("parse"):
+            for line in request.stream:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append((json.loads(line), None))
+                except ValueError as e:
+                    entries.append((None, f"Invalid JSON: {e}"))
+        return entries
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise PayloadError("Expected a JSON array or NDJSON records")
+    return [(record, None) for record in data]
+
+
+def collect_batch(store, entries, validate, dedup=None):
+    """
+    Function to validate a batch of records and commit the accepted ones.
+    Every record is checked with the same validate function used by the
+    single-record handler, and all accepted records are written in one commit.
+    With a DedupIndex, valid records that were already stored are
+    acknowledged but not written again: accepted counts the records written,
+    and duplicates the ones skipped.
+    """
+    valid = []
+    errors = []
+    with phase("validate"):
+        for index, (record, error) in enumerate(entries):
+            if error is None:
+                error = validate(record)
+            if error is None:
+                valid.append(record)
+            else:
+                errors.append({"index": index, "message": error})
+
+    # Commit all valid records together
+    duplicates = 0
+    if dedup is not None:
+        duplicates = dedup.extend(valid)
+    elif valid:
+        store.extend(valid)
+
+    return {
+        "status": "success",
+        "accepted": len(valid) - duplicates,
+        "rejected": len(errors),
+        "duplicates": duplicates,
+        "errors": errors
+    }
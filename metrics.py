@@ -0,0 +1,384 @@
+"""
+Request metrics and profiling for the collector services.
+
+instrument(app, stores) times every request of an app, and adds:
+    /metrics  Prometheus text exposition of the metrics of this process
+    /profile  GET: collapsed stacks from the sampling profiler (flame graph input)
+              POST ?enabled=1/0: start or stop the profiler
+
+Each request is broken down into phases, added up over the request:
+    parse          reading the JSON or NDJSON request body
+    validate       checking collected records
+    storage_write  waiting for records to be committed to disk
+    storage_read   reading stored records
+    serialize      encoding the JSON response
+Waits for a store's lock are timed separately, along with histograms of request
+and response sizes and of records written and read per request, and gauges
+of every store's size and writer counters.
+
+With COLLECTOR_METRICS=0 nothing is registered and phase() only checks a
+thread-local. The profiler is off unless COLLECTOR_PROFILE=1 or switched on
+through /profile.
+"""
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+import os
+import sys
+import threading
+import time
+
+from flask import Response, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from flask.wrappers import Request
+
+from config import METRICS, PROFILE
+
+# Histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Interval between profiler samples (seconds)
+PROFILE_INTERVAL = 0.005
+
+# Deepest stack kept per profiler sample
+PROFILE_DEPTH = 64
+
+# Functions reported on /metrics from the profiler
+PROFILE_TOP = 20
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """
+    Prometheus histogram with labels.
+    """
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        """
+        Function to add a value to the series with the given label values.
+        """
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts, then the +Inf count and the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(values)) for labels, values in self._series.items()]
+        for labels, values in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                bucket_labels = _labels(self.labels, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {values[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "collector_request_duration_seconds", "Time to handle a request.",
+    ("route", "method", "status"), LATENCY_BUCKETS
+)
+PHASE_SECONDS = Histogram(
+    "collector_request_phase_seconds", "Time spent in each phase of a request.",
+    ("route", "phase"), LATENCY_BUCKETS
+)
+LOCK_WAIT_SECONDS = Histogram(
+    "collector_store_lock_wait_seconds", "Time spent waiting for a store lock.",
+    ("store", "operation"), LATENCY_BUCKETS
+)
+REQUEST_BYTES = Histogram(
+    "collector_request_size_bytes", "Size of request bodies.",
+    ("route",), SIZE_BUCKETS
+)
+RESPONSE_BYTES = Histogram(
+    "collector_response_size_bytes", "Size of response bodies (streamed responses excluded).",
+    ("route",), SIZE_BUCKETS
+)
+REQUEST_RECORDS = Histogram(
+    "collector_request_records", "Records written or read by a request.",
+    ("route", "operation"), COUNT_BUCKETS
+)
+HISTOGRAMS = [REQUEST_SECONDS, PHASE_SECONDS, LOCK_WAIT_SECONDS, REQUEST_BYTES, RESPONSE_BYTES, REQUEST_RECORDS]
+
+
+@contextmanager
+def phase(name):
+    """
+    Context manager adding the time spent in its block to a phase of the current request.
+    Does nothing outside an instrumented request.
+    """
+    phases = getattr(_local, "phases", None)
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def count_records(operation, count):
+    """
+    Function to add to the records written or read by the current request.
+    """
+    records = getattr(_local, "records", None)
+    if records is not None:
+        records[operation] = records.get(operation, 0) + count
+
+
+@contextmanager
+def timed_lock(lock, store, operation):
+    """
+    Context manager holding a lock, timing the wait for it when metrics are on.
+    """
+    if not METRICS:
+        with lock:
+            yield
+        return
+    start = time.perf_counter()
+    with lock:
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - start, store, operation)
+        yield
+
+
+class SamplingProfiler:
+    """
+    Profiler sampling the stacks of every thread at a fixed interval.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def start(self):
+        """
+        Function to start sampling, if not already running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Function to stop sampling, keeping the samples taken so far.
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """
+        Function to get the samples as collapsed stacks, one "stack count" per line.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def top(self, count=PROFILE_TOP):
+        """
+        Function to get the functions most often at the top of the sampled stacks.
+        """
+        functions = Counter()
+        for stack, samples in list(self.samples.items()):
+            functions[stack.rsplit(";", 1)[-1]] += samples
+        return functions.most_common(count)
+
+
+# Profiler shared by every app in the process
+profiler = SamplingProfiler()
+if PROFILE:
+    profiler.start()
+
+# Stores reported on /metrics, keyed by path
+_stores = {}
+
+
+def _store_lines():
+    lines = [
+        "# HELP collector_store_records Records in a store.",
+        "# TYPE collector_store_records gauge",
+        "# HELP collector_store_file_bytes Size of a store's files.",
+        "# TYPE collector_store_file_bytes gauge"
+    ]
+
+    # Writer counters from RecordStore.stats(), one metric per counter
+    writer = {}
+    for store in list(_stores.values()):
+        labels = f'store="{_escape(store.name)}"'
+        lines.append(f"collector_store_records{{{labels}}} {len(store)}")
+        for kind, path in (("log", store.path), ("snapshot", store.snapshot_path)):
+            if os.path.exists(path):
+                lines.append(f'collector_store_file_bytes{{{labels},file="{kind}"}} {os.path.getsize(path)}')
+        for key, value in store.stats().items():
+            if isinstance(value, (int, float)):
+                writer.setdefault(key, []).append(f"collector_store_{key}{{{labels}}} {value}")
+    for key, values in writer.items():
+        lines.append(f"# TYPE collector_store_{key} gauge")
+        lines.extend(values)
+    return lines
+
+
+def render():
+    """
+    Function to render every metric in the Prometheus text format.
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    lines.extend(_store_lines())
+    lines.extend([
+        "# HELP collector_profiler_enabled Whether the sampling profiler is running.",
+        "# TYPE collector_profiler_enabled gauge",
+        f"collector_profiler_enabled {int(profiler.enabled)}",
+        "# HELP collector_profile_samples Profiler samples with the function at the top of the stack.",
+        "# TYPE collector_profile_samples counter"
+    ])
+    for function, count in profiler.top():
+        lines.append(f'collector_profile_samples{{function="{_escape(function)}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+class TimedRequest(Request):
+    """
+    Request timing the parsing of JSON bodies.
+    """
+
+    def get_json(self, *args, **kwargs):
+        with phase("parse"):
+            return super().get_json(*args, **kwargs)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider timing the encoding of responses.
+    """
+
+    def response(self, *args, **kwargs):
+        with phase("serialize"):
+            return super().response(*args, **kwargs)
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def _start_request():
+    _local.phases = {}
+    _local.records = {}
+    _local.start = time.perf_counter()
+
+
+def _finish_request(response):
+    phases, records = getattr(_local, "phases", None), getattr(_local, "records", None)
+    if phases is None:
+        return response
+    route = _route()
+    REQUEST_SECONDS.observe(time.perf_counter() - _local.start, route, request.method, str(response.status_code))
+    for name, seconds in phases.items():
+        PHASE_SECONDS.observe(seconds, route, name)
+    for operation, count in records.items():
+        REQUEST_RECORDS.observe(count, route, operation)
+    if request.content_length:
+        REQUEST_BYTES.observe(request.content_length, route)
+    if not response.is_streamed:
+        RESPONSE_BYTES.observe(response.content_length or 0, route)
+    return response
+
+
+def _end_request(exception=None):
+    _local.phases = None
+    _local.records = None
+
+
+def instrument(app, stores):
+    """
+    Function to time the requests of an app and add the /metrics and /profile endpoints.
+    Does nothing when metrics are disabled.
+    """
+    if not METRICS:
+        return
+    for store in stores:
+        _stores[store.path] = store
+
+    app.request_class = TimedRequest
+    app.json = TimedJSONProvider(app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_end_request)
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        """
+        Endpoint to expose the metrics of this process in the Prometheus text format.
+        """
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route('/profile', methods=['GET', 'POST'])
+    def profile():
+        """
+        Endpoint to get the profiler samples as collapsed stacks (GET), or to start
+        or stop the profiler (POST with enabled=1 or enabled=0).
+        """
+        if request.method == 'GET':
+            return Response(profiler.collapsed(), mimetype="text/plain")
+        if request.args.get("enabled") not in ("0", "1"):
+            return jsonify({"status": "error", "message": "Use enabled=1 or enabled=0"}), 400
+        if request.args["enabled"] == "1":
+            profiler.start()
+        else:
+            profiler.stop()
+        return jsonify({"status": "success", "enabled": profiler.enabled}), 200
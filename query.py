@@ -0,0 +1,178 @@
+from datetime import datetime, timedelta
+from heapq import merge
+from itertools import islice
+
+from flask import Response, jsonify
+
+from index import parse_timestamp, to_epoch
+from storage import encode_record
+
+# Number of records read per chunk when streaming NDJSON
+STREAM_CHUNK_SIZE = 1000
+
+
+class QueryError(ValueError):
+    """
+    Raised when retrieval query parameters are invalid.
+    """
+
+
+def parse_time(value):
+    """
+    Function to parse a 'YYYY-MM-DD HH:MM:SS' or 'YYYY-MM-DD' query value into epoch seconds.
+    """
+    for candidate in (value, value + " 00:00:00"):
+        try:
+            return parse_timestamp(candidate)
+        except ValueError:
+            continue
+    raise QueryError(f"Invalid datetime '{value}'. Use 'YYYY-MM-DD HH:MM:SS' or 'YYYY-MM-DD'")
+
+
+def parse_days(args, default):
+    """
+    Function to read the staleness threshold in days from the query parameters.
+    """
+    if "days" not in args:
+        return default
+    try:
+        days = float(args["days"])
+    except ValueError:
+        raise QueryError("Invalid days. Must be a positive number")
+    if days <= 0:
+        raise QueryError("Invalid days. Must be a positive number")
+    return days
+
+
+def staleness_expiry(index, default_days):
+    """
+    Function to build the cache expiry function of an analyze endpoint.
+    Its value changes when the next sender goes stale, which is the only way
+    the result changes without new records.
+    """
+    def expires(args):
+        days = parse_days(args, default_days)
+        return index.next_stale(to_epoch(datetime.now() - timedelta(days=days)))
+    return expires
+
+
+def encode_cursor(key):
+    """
+    Function to turn the key of the last returned record into a cursor string.
+    """
+    return f"{key[0]}:{key[1]}"
+
+
+def decode_cursor(cursor):
+    """
+    Function to turn a cursor string back into a record key.
+    """
+    try:
+        timestamp, seq = cursor.split(":")
+        return int(timestamp), int(seq)
+    except ValueError:
+        raise QueryError("Invalid cursor")
+
+
+def parse_query(args, type_field):
+    """
+    Function to read retrieval filters from request query parameters.
+    Supported parameters: sender, <type_field> (type or log_type), start, end,
+    cursor, limit and format=ndjson.
+    """
+    filters = {
+        "sender": args.get("sender"),
+        "record_type": args.get(type_field),
+        "start": parse_time(args["start"]) if "start" in args else None,
+        "end": parse_time(args["end"]) if "end" in args else None,
+        "after": decode_cursor(args["cursor"]) if "cursor" in args else None
+    }
+
+    limit = None
+    if "limit" in args:
+        try:
+            limit = int(args["limit"])
+        except ValueError:
+            raise QueryError("Invalid limit. Must be a positive integer")
+        if limit <= 0:
+            raise QueryError("Invalid limit. Must be a positive integer")
+
+    return filters, limit, args.get("format") == "ndjson"
+
+
+def query_archive(store, index, archive, filters, limit):
+    """
+    Function to find matching records in time order in both the store and its
+    archived segments. Returns the record keys and the records.
+    """
+    # Records before a pending archive cutoff are read from the archive only
+    stored_filters = dict(filters)
+    pending = archive.pending_cutoff()
+    if pending is not None:
+        stored_filters["start"] = pending if filters["start"] is None else max(filters["start"], pending)
+    keys = index.query(limit=limit, **stored_filters)
+    archived = archive.query(limit=limit, **filters)
+
+    # Merge by key; stored records are read once the page is known
+    page = list(islice(merge(((key, None) for key in keys), archived, key=lambda item: item[0]), limit))
+    stored = iter(store.read_records([key[1] for key, record in page if record is None]))
+    return [key for key, _ in page], [next(stored) if record is None else record for _, record in page]
+
+
+def stream_records(store, index, filters, limit, archive=None):
+    """
+    Function to yield matching records as NDJSON, one chunk at a time.
+    Only one chunk of record keys and lines is held in memory at once.
+    """
+    filters = dict(filters)
+    sent = 0
+    while limit is None or sent < limit:
+        chunk_size = STREAM_CHUNK_SIZE if limit is None else min(STREAM_CHUNK_SIZE, limit - sent)
+        if archive is not None:
+            keys, records = query_archive(store, index, archive, filters, chunk_size)
+            if not keys:
+                break
+            yield "".join(encode_record(record) for record in records).encode("utf-8")
+        else:
+            keys = index.query(limit=chunk_size, **filters)
+            if not keys:
+                break
+            yield b"".join(store.read_lines(seq for _, seq in keys))
+        sent += len(keys)
+        filters["after"] = keys[-1]
+        if len(keys) < chunk_size:
+            break
+
+
+def get_records(store, index, args, type_field, archive=None):
+    """
+    Function to build the response for a get_* endpoint.
+    Returns the matching records in datetime order, either as one page of
+    JSON with a next_cursor for the following page, or streamed as NDJSON.
+    With the store's SegmentArchive, archived records are included too,
+    reading only the segments that overlap the requested range. With keys=1,
+    the cursor of every record is included as well, so that the shard router
+    can merge pages from several shards.
+    """
+    filters, limit, stream = parse_query(args, type_field)
+    if archive is not None and not archive.has_segments():
+        archive = None
+
+    if stream:
+        return Response(stream_records(store, index, filters, limit, archive), mimetype="application/x-ndjson")
+
+    if archive is not None:
+        keys, data = query_archive(store, index, archive, filters, limit)
+    else:
+        keys = index.query(limit=limit, **filters)
+        data = store.read_records([seq for _, seq in keys])
+
+    # Hand out a cursor only when there may be more records
+    next_cursor = None
+    if limit is not None and len(keys) == limit:
+        next_cursor = encode_cursor(keys[-1])
+
+    response = {"status": "success", "data": data, "next_cursor": next_cursor}
+    if args.get("keys") == "1":
+        response["keys"] = [encode_cursor(key) for key in keys]
+    return jsonify(response)
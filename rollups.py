@@ -0,0 +1,237 @@
+"""
+Hourly and daily activity rollups per sender.
+
+RollupIndex is a store listener that adds every record to counters for its
+hour and its day, per sender and for all senders together, by record type
+(log_type for calls, type for SMS and email). Given the store's
+ThreadIndex, it also rolls up reply latencies by the hour and day of the
+reply. Analytics queries read only the buckets of the requested range, never
+the records, so their cost depends on the range and not on the history.
+"""
+import threading
+
+from flask import jsonify
+
+from index import format_timestamp, indexable, parse_timestamp, to_epoch
+from query import QueryError, parse_time
+
+# Bucket sizes (seconds)
+GRANULARITIES = {
+    "hour": 3600,
+    "day": 86400
+}
+
+# Ways to group the buckets of a range
+GROUPS = ["bucket", "hour_of_day", "weekday", "hour_of_week"]
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+# Days covered when no start is given
+DEFAULT_RANGE_DAYS = 30
+
+# Most buckets one query may read
+MAX_BUCKETS = 10000
+
+
+class RollupIndex:
+    """
+    In-memory hourly and daily counters of a record store.
+    Subscribe it after the store's ThreadIndex, which it reads reply latencies from.
+    """
+
+    def __init__(self, type_field, threads=None):
+        # Record field holding the type/direction ("log_type" or "type")
+        self.type_field = type_field
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # {granularity: {(sender, bucket): {type: count}}}; sender None counts every sender
+        self._counts = {granularity: {} for granularity in GRANULARITIES}
+
+        # {granularity: {(contact, bucket): [replies, total latency, max latency]}}
+        self._latencies = {granularity: {} for granularity in GRANULARITIES}
+        self._reply_count = 0
+
+    def rebuild(self, records):
+        """
+        Function to rebuild the rollups from scratch.
+        """
+        with self._lock:
+            self._reset()
+            self._add(records)
+
+    def add(self, records):
+        """
+        Function to update the rollups with newly stored records.
+        """
+        with self._lock:
+            self._add(records)
+
+    def _add(self, records):
+        for record in records:
+            try:
+                sender = record["sender"]
+                record_time = parse_timestamp(record["datetime"])
+                record_type = record.get(self.type_field)
+                if not isinstance(sender, str) or not indexable(record_type):
+                    continue
+            except (KeyError, TypeError, ValueError):
+                # Skip records the rollups cannot place
+                continue
+
+            for granularity, size in GRANULARITIES.items():
+                counts = self._counts[granularity]
+                bucket = record_time - record_time % size
+                for key in ((sender, bucket), (None, bucket)):
+                    bucket_counts = counts.get(key)
+                    if bucket_counts is None:
+                        bucket_counts = counts[key] = {}
+                    bucket_counts[record_type] = bucket_counts.get(record_type, 0) + 1
+
+        if self.threads is None:
+            return
+
+        # Roll up the replies the thread index matched since the last update
+        replies = self.threads.replies(self._reply_count)
+        self._reply_count += len(replies)
+        for reply_time, contact, latency in replies:
+            for granularity, size in GRANULARITIES.items():
+                latencies = self._latencies[granularity]
+                bucket = reply_time - reply_time % size
+                for key in ((contact, bucket), (None, bucket)):
+                    entry = latencies.get(key)
+                    if entry is None:
+                        entry = latencies[key] = [0, 0, 0]
+                    entry[0] += 1
+                    entry[1] += latency
+                    entry[2] = max(entry[2], latency)
+
+    def series(self, granularity, start, end, sender=None):
+        """
+        Function to get the (bucket start, type counts, latency entry) of every
+        non-empty bucket between start and end (epoch seconds, inclusive).
+        """
+        size = GRANULARITIES[granularity]
+        with self._lock:
+            counts = self._counts[granularity]
+            latencies = self._latencies[granularity]
+            series = []
+            for bucket in range(start - start % size, end + 1, size):
+                bucket_counts = counts.get((sender, bucket))
+                entry = latencies.get((sender, bucket))
+                if bucket_counts is not None or entry is not None:
+                    series.append((bucket, dict(bucket_counts or {}), list(entry) if entry else None))
+            return series
+
+
+def _slot(bucket, group):
+    """
+    Function to get the slot of a bucket when grouping by hour of day, weekday or hour of week.
+    """
+    day, seconds = divmod(bucket, 86400)
+
+    # 1970-01-01 was a Thursday
+    weekday = (day + 3) % 7
+    hour = seconds // 3600
+    if group == "hour_of_day":
+        return hour
+    if group == "weekday":
+        return weekday
+    return weekday * 24 + hour
+
+
+def _slot_fields(slot, group):
+    if group == "hour_of_day":
+        return {"hour": slot}
+    if group == "weekday":
+        return {"weekday": WEEKDAYS[slot]}
+    return {"weekday": WEEKDAYS[slot // 24], "hour": slot % 24}
+
+
+def _latency_stats(entry):
+    return {"replies": entry[0], "mean_seconds": entry[1] / entry[0], "max_seconds": entry[2]}
+
+
+def parse_analytics(args, sources, now):
+    """
+    Function to read the parameters of an analytics request.
+    """
+    source_names = args["source"].split(",") if "source" in args else list(sources)
+    for name in source_names:
+        if name not in sources:
+            raise QueryError(f"Invalid source '{name}'. Use one of: {', '.join(sources)}")
+
+    granularity = args.get("granularity", "day")
+    if granularity not in GRANULARITIES:
+        raise QueryError(f"Invalid granularity '{granularity}'. Use one of: {', '.join(GRANULARITIES)}")
+
+    group = args.get("group", "bucket")
+    if group not in GROUPS:
+        raise QueryError(f"Invalid group '{group}'. Use one of: {', '.join(GROUPS)}")
+    if group in ("hour_of_day", "hour_of_week"):
+        granularity = "hour"
+
+    end = parse_time(args["end"]) if "end" in args else to_epoch(now)
+    start = parse_time(args["start"]) if "start" in args else end - DEFAULT_RANGE_DAYS * 86400
+    if start > end:
+        raise QueryError("Invalid range. start must not be after end")
+    size = GRANULARITIES[granularity]
+    if (end - end % size - (start - start % size)) // size + 1 > MAX_BUCKETS:
+        raise QueryError(f"Range too long for {granularity} buckets (at most {MAX_BUCKETS})")
+
+    return source_names, granularity, group, start, end
+
+
+def query_rollups(sources, args, now):
+    """
+    Function to build the response of the analytics endpoint from the rollups of
+    every source ({source name: RollupIndex}).
+    Each entry holds record counts by source and type, their total, and reply
+    latency statistics where the source has them. With a group other than
+    bucket, the buckets are added up per hour of day, weekday or hour of week,
+    and the busiest slot is reported.
+    """
+    source_names, granularity, group, start, end = parse_analytics(args, sources, now)
+    sender = args.get("sender")
+
+    # {slot: [counts by source, latency entry]}
+    slots = {}
+    for name in source_names:
+        for bucket, counts, latency in sources[name].series(granularity, start, end, sender):
+            slot = bucket if group == "bucket" else _slot(bucket, group)
+            entry = slots.setdefault(slot, [{}, None])
+            source_counts = entry[0].setdefault(name, {})
+            for record_type, count in counts.items():
+                source_counts[record_type] = source_counts.get(record_type, 0) + count
+            if latency is not None:
+                if entry[1] is None:
+                    entry[1] = [0, 0, 0]
+                entry[1][0] += latency[0]
+                entry[1][1] += latency[1]
+                entry[1][2] = max(entry[1][2], latency[2])
+
+    data = []
+    for slot in sorted(slots):
+        counts, latency = slots[slot]
+        item = {"bucket": format_timestamp(slot)} if group == "bucket" else _slot_fields(slot, group)
+        item["counts"] = counts
+        item["total"] = sum(sum(source_counts.values()) for source_counts in counts.values())
+        if latency is not None:
+            item["latency"] = _latency_stats(latency)
+        data.append(item)
+
+    response = {
+        "status": "success",
+        "sources": source_names,
+        "sender": sender,
+        "granularity": granularity,
+        "group": group,
+        "start": format_timestamp(start),
+        "end": format_timestamp(end),
+        "data": data
+    }
+    if group != "bucket":
+        response["busiest"] = max(data, key=lambda item: item["total"], default=None)
+    return jsonify(response)
@@ -0,0 +1,621 @@
+"""
+Full-text search over stored messages (SMS content, email subject and body).
+
+SearchIndex is an on-disk inverted index kept next to the store, e.g.
+"sms_data.search/". Newly stored records are indexed in memory, and every
+FLUSH_EVERY records they are written out as an immutable, memory-mapped
+segment (see snapshot.write_arrays); segments are merged into one once there
+are more than MAX_SEGMENTS. A segment holds the sorted vocabulary, the
+postings (record numbers and term frequencies) of every term, and the
+length, time and sender of every record, so filtering and BM25 ranking run
+on NumPy arrays. On startup the segments are reused if they were built from
+the store's current generation, and only the records stored after them are
+indexed again.
+
+Only one process writes the index: the first to lock "sms_data.search/lock".
+Other processes that subscribe a SearchIndex to the same store (e.g.
+contacts.py, through the collectors it imports) read the segments but keep
+the records after them in memory, and never write or delete any file.
+
+Words and adjacent word pairs are indexed, so two-word phrases are exact
+lookups; longer phrases are matched on their word pairs and then checked
+against the record text.
+
+Query syntax (every part must match):
+    word        records containing the word
+    pre*        records with a word starting with "pre"
+    "a b c"     records containing the phrase
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import glob
+import json
+import math
+import os
+import re
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from flask import jsonify
+
+from index import MISSING_TIME, parse_timestamp
+from query import QueryError, parse_time
+from snapshot import map_arrays, write_arrays
+from storage import lock_owner, temp_path
+
+SEGMENT_MAGIC = b"CSEG0001"
+
+# Records indexed in memory before they are written out as a segment
+FLUSH_EVERY = 100000
+
+# Segments kept before they are merged into one
+MAX_SEGMENTS = 8
+
+# Most words a prefix query expands to, per segment
+MAX_EXPANSIONS = 512
+
+# Records read per batch when checking long phrases
+VERIFY_BATCH_SIZE = 200
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 1000
+
+# BM25 ranking parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    """
+    Function to split text into lowercase words.
+    """
+    if not isinstance(text, str):
+        return []
+    return TOKEN_RE.findall(text.lower())
+
+
+def record_terms(record, fields):
+    """
+    Function to get the terms of a record (words, and adjacent word pairs within
+    each field) and its length in words.
+    """
+    terms = []
+    length = 0
+    for field in fields:
+        words = tokenize(record.get(field))
+        length += len(words)
+        terms.extend(words)
+        terms.extend(f"{first} {second}" for first, second in zip(words, words[1:]))
+    return terms, length
+
+
+def contains_phrase(record, fields, words):
+    """
+    Function to check whether one of the fields of a record contains the words in order.
+    """
+    size = len(words)
+    for field in fields:
+        tokens = tokenize(record.get(field))
+        for i in range(len(tokens) - size + 1):
+            if tokens[i:i + size] == words:
+                return True
+    return False
+
+
+def parse_search(query):
+    """
+    Function to split a search query into (kind, words) clauses, where kind is
+    "term", "prefix" or "phrase".
+    """
+    clauses = []
+    for quoted, token in QUERY_RE.findall(query):
+        prefix = not quoted and token.endswith("*")
+        words = tokenize(quoted or token)
+        if not words:
+            continue
+        if prefix and len(words) == 1:
+            clauses.append(("prefix", words))
+        elif len(words) == 1:
+            clauses.append(("term", words))
+        else:
+            clauses.append(("phrase", words))
+    return clauses
+
+
+def _union(postings):
+    """
+    Function to merge (record numbers, term frequencies) pairs, adding up frequencies.
+    """
+    seqs = np.concatenate([p[0] for p in postings])
+    tfs = np.concatenate([p[1] for p in postings])
+    order = np.argsort(seqs, kind="stable")
+    seqs, tfs = seqs[order], tfs[order]
+    unique, starts = np.unique(seqs, return_index=True)
+    return unique, np.add.reduceat(tfs, starts) if len(seqs) else tfs
+
+
+def _intersect(postings):
+    """
+    Function to intersect (record numbers, term frequencies) pairs, keeping the lowest frequency.
+    """
+    seqs, tfs = postings[0]
+    for other_seqs, other_tfs in postings[1:]:
+        seqs, i, j = np.intersect1d(seqs, other_seqs, assume_unique=True, return_indices=True)
+        tfs = np.minimum(tfs[i], other_tfs[j])
+    return seqs, tfs
+
+
+class _MemorySegment:
+    """
+    Records indexed since the last flush.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.total_length = 0
+        self.postings = {}
+        self._lengths = array("i")
+        self._times = array("q")
+        self._senders = array("i")
+        self.sender_names = []
+        self.sender_codes = {}
+
+    def add(self, record, fields):
+        seq = self.start + self.count
+        self.count += 1
+        terms, length = record_terms(record, fields)
+        for term, tf in Counter(terms).items():
+            entry = self.postings.get(term)
+            if entry is None:
+                entry = self.postings[term] = (array("q"), array("i"))
+            entry[0].append(seq)
+            entry[1].append(tf)
+        self._lengths.append(length)
+        self.total_length += length
+
+        try:
+            self._times.append(parse_timestamp(record["datetime"]))
+        except (KeyError, TypeError, ValueError):
+            self._times.append(MISSING_TIME)
+
+        sender = record.get("sender")
+        code = -1
+        if isinstance(sender, str):
+            code = self.sender_codes.get(sender)
+            if code is None:
+                code = self.sender_codes[sender] = len(self.sender_names)
+                self.sender_names.append(sender)
+        self._senders.append(code)
+
+    def lookup(self, term):
+        entry = self.postings.get(term)
+        if entry is None:
+            return None
+        return np.array(entry[0], np.int64), np.array(entry[1], np.int32)
+
+    def expand(self, prefix):
+        return sorted(term for term in self.postings if term.startswith(prefix) and " " not in term)[:MAX_EXPANSIONS]
+
+    def columns(self):
+        return (
+            np.array(self._lengths, np.int32),
+            np.array(self._times, np.int64),
+            np.array(self._senders, np.int32)
+        )
+
+
+class _DiskSegment:
+    """
+    Immutable segment mapped from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        header, arrays = map_arrays(path, SEGMENT_MAGIC)
+        self.start = header["start"]
+        self.count = header["count"]
+        self.words = header["words"]
+        self.pairs = header["pairs"]
+        self.sender_names = header["senders"]
+        self.sender_codes = {sender: code for code, sender in enumerate(self.sender_names)}
+        self.offsets = arrays["offsets"]
+        self.seqs = arrays["seqs"]
+        self.tfs = arrays["tfs"]
+        self.lengths = arrays["lengths"]
+        self.times = arrays["times"]
+        self.senders = arrays["senders"]
+        self.total_length = int(self.lengths.sum())
+
+    def lookup(self, term):
+        # Words come first in the postings, then word pairs
+        terms, base = (self.pairs, len(self.words)) if " " in term else (self.words, 0)
+        i = bisect_left(terms, term)
+        if i == len(terms) or terms[i] != term:
+            return None
+        lo, hi = self.offsets[base + i], self.offsets[base + i + 1]
+        return self.seqs[lo:hi], self.tfs[lo:hi]
+
+    def expand(self, prefix):
+        i = bisect_left(self.words, prefix)
+        terms = []
+        while i < len(self.words) and self.words[i].startswith(prefix) and len(terms) < MAX_EXPANSIONS:
+            terms.append(self.words[i])
+            i += 1
+        return terms
+
+    def columns(self):
+        return self.lengths, self.times, self.senders
+
+
+def _write_segment(path, start, count, terms, postings, lengths, times, senders, sender_names):
+    """
+    Function to write a segment; terms must be sorted words followed by sorted word pairs,
+    and postings the matching list of (record numbers, term frequencies).
+    """
+    sizes = np.array([len(seqs) for seqs, _ in postings], np.int64)
+    arrays = {
+        "offsets": np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+        "seqs": np.concatenate([seqs for seqs, _ in postings]).astype(np.int64) if postings else np.empty(0, np.int64),
+        "tfs": np.concatenate([tfs for _, tfs in postings]).astype(np.int32) if postings else np.empty(0, np.int32),
+        "lengths": lengths.astype(np.int32),
+        "times": times.astype(np.int64),
+        "senders": senders.astype(np.int32)
+    }
+    words = [term for term in terms if " " not in term]
+    header = {
+        "start": start,
+        "count": count,
+        "words": words,
+        "pairs": terms[len(words):],
+        "senders": sender_names
+    }
+    tmp_path = temp_path(path)
+    write_arrays(tmp_path, SEGMENT_MAGIC, header, arrays)
+    os.replace(tmp_path, path)
+
+
+class SearchIndex:
+    """
+    On-disk inverted index of the text fields of a record store.
+    Subscribe it to the store it indexes.
+    """
+
+    def __init__(self, store, fields, flush_every=FLUSH_EVERY):
+        self.store = store
+        self.fields = fields
+        self.flush_every = flush_every
+        self.directory = os.path.splitext(store.path)[0] + ".search"
+        self._lock = threading.Lock()
+        self._owner_lock = None
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self._segments = []
+        self._memory = _MemorySegment(0)
+
+    @property
+    def writable(self):
+        """
+        Whether this process owns the index files.
+        """
+        return self._owner_lock is not None
+
+    def close(self):
+        """
+        Function to give up the index files, so that another process can write them.
+        """
+        with self._lock:
+            if self._owner_lock is not None:
+                self._owner_lock.close()
+                self._owner_lock = None
+
+    def _manifest_path(self):
+        return os.path.join(self.directory, "manifest.json")
+
+    def _write_manifest(self):
+        if not self.writable:
+            return
+        manifest = {
+            "segments": [os.path.basename(segment.path) for segment in self._segments],
+            "count": self._memory.start,
+            "generation": self.store.generation
+        }
+        tmp_path = temp_path(self._manifest_path())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._manifest_path())
+
+        # Remove segments that were merged away
+        keep = set(manifest["segments"])
+        for path in glob.glob(os.path.join(self.directory, "*.seg")):
+            if os.path.basename(path) not in keep:
+                os.remove(path)
+
+    def _load(self):
+        """
+        Function to reuse the segments on disk if they were built from the store's
+        current generation. Returns the number of records they cover, or None.
+        """
+        try:
+            with open(self._manifest_path(), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            count = manifest["count"]
+            if count > len(self.store) or manifest["generation"] != self.store.generation:
+                return None
+            self._segments = [_DiskSegment(os.path.join(self.directory, name)) for name in manifest["segments"]]
+        except (OSError, ValueError, KeyError, IndexError):
+            self._segments = []
+            return None
+        return count
+
+    def rebuild(self, records):
+        """
+        Function to rebuild the index, reusing segments that still match the store.
+        """
+        if np is None:
+            return
+        with self._lock:
+            self._reset()
+            os.makedirs(self.directory, exist_ok=True)
+            if self._owner_lock is None:
+                self._owner_lock = lock_owner(os.path.join(self.directory, "lock"))
+            count = self._load()
+            if count is None:
+                # Index everything again
+                self._reset()
+                self._write_manifest()
+                self._add(records)
+                return
+
+            # Index the records stored after the segments
+            self.count = count
+            self._memory = _MemorySegment(count)
+            total = len(self.store)
+            for chunk_start in range(count, total, self.flush_every):
+                self._add(self.store.read_records(range(chunk_start, min(total, chunk_start + self.flush_every))))
+
+    def add(self, records):
+        """
+        Function to update the index with newly stored records.
+        """
+        if np is None:
+            return
+        with self._lock:
+            self._add(records)
+
+    def _add(self, records):
+        for record in records:
+            self._memory.add(record, self.fields)
+            self.count += 1
+            if self._memory.count >= self.flush_every and self.writable:
+                self._flush()
+
+    def _flush(self):
+        """
+        Function to write the records indexed in memory out as a segment.
+        """
+        memory = self._memory
+        words = sorted(term for term in memory.postings if " " not in term)
+        pairs = sorted(term for term in memory.postings if " " in term)
+        terms = words + pairs
+        postings = [memory.lookup(term) for term in terms]
+        lengths, times, senders = memory.columns()
+        path = os.path.join(self.directory, f"{memory.start:012d}-{memory.start + memory.count:012d}.seg")
+        _write_segment(path, memory.start, memory.count, terms, postings, lengths, times, senders, memory.sender_names)
+
+        self._segments.append(_DiskSegment(path))
+        self._memory = _MemorySegment(memory.start + memory.count)
+        if len(self._segments) > MAX_SEGMENTS:
+            self._merge()
+        self._write_manifest()
+
+    def _merge(self):
+        """
+        Function to merge every segment into one.
+        """
+        segments = self._segments
+        words = sorted(set().union(*(segment.words for segment in segments)))
+        pairs = sorted(set().union(*(segment.pairs for segment in segments)))
+        terms = words + pairs
+        term_ids = {term: i for i, term in enumerate(terms)}
+        sender_names = []
+        sender_codes = {}
+
+        ids, seqs, tfs, lengths, times, senders = [], [], [], [], [], []
+        for segment in segments:
+            # Map the segment's terms and senders to the merged ones
+            segment_ids = np.array([term_ids[term] for term in segment.words + segment.pairs], np.int64)
+            ids.append(np.repeat(segment_ids, np.diff(segment.offsets)))
+            seqs.append(segment.seqs)
+            tfs.append(segment.tfs)
+            sender_map = np.array(
+                [sender_codes.setdefault(sender, len(sender_codes)) for sender in segment.sender_names] + [-1],
+                np.int32
+            )
+            senders.append(sender_map[segment.senders])
+            lengths.append(segment.lengths)
+            times.append(segment.times)
+        sender_names = list(sender_codes)
+
+        # Group postings by term; the sort is stable, so record numbers stay in order
+        ids = np.concatenate(ids)
+        order = np.argsort(ids, kind="stable")
+        seqs = np.concatenate(seqs)[order]
+        tfs = np.concatenate(tfs)[order]
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(ids, minlength=len(terms)))])
+        postings = [(seqs[bounds[i]:bounds[i + 1]], tfs[bounds[i]:bounds[i + 1]]) for i in range(len(terms))]
+
+        start = segments[0].start
+        count = sum(segment.count for segment in segments)
+        path = os.path.join(self.directory, f"{start:012d}-{start + count:012d}.seg")
+        _write_segment(
+            path, start, count, terms, postings,
+            np.concatenate(lengths), np.concatenate(times), np.concatenate(senders), sender_names
+        )
+        self._segments = [_DiskSegment(path)]
+
+    def _match(self, segment, kind, words):
+        """
+        Function to find the (record numbers, term frequencies) of a clause in a segment.
+        """
+        if kind == "term":
+            return segment.lookup(words[0])
+        if kind == "prefix":
+            postings = [segment.lookup(term) for term in segment.expand(words[0])]
+            return _union(postings) if postings else None
+
+        # Phrases are matched on their word pairs
+        postings = [segment.lookup(f"{first} {second}") for first, second in zip(words, words[1:])]
+        if any(p is None for p in postings):
+            return None
+        return _intersect(postings)
+
+    def rank(self, clauses, sender=None, start=None, end=None, limit=None):
+        """
+        Function to find the records matching every clause, best BM25 score first
+        (newest first among equal scores). start and end are inclusive epoch
+        seconds. Returns the (record number, score) pairs of the top limit
+        matches (every match if limit is None) and the number of matches.
+        """
+        if np is None:
+            raise RuntimeError("Full-text search requires NumPy")
+        with self._lock:
+            segments = self._segments + [self._memory]
+            total_length = sum(segment.total_length for segment in segments)
+
+            # Match every clause in every segment, counting document frequencies
+            matches = []
+            frequencies = [0] * len(clauses)
+            for segment in segments:
+                segment_matches = [self._match(segment, kind, words) for kind, words in clauses]
+                for i, match in enumerate(segment_matches):
+                    if match is not None:
+                        frequencies[i] += len(match[0])
+                matches.append(segment_matches)
+
+            columns = [segment.columns() for segment in segments]
+
+        count = max(self.count, 1)
+        average_length = max(total_length / count, 1.0)
+        idf = [math.log(1 + (count - df + 0.5) / (df + 0.5)) for df in frequencies]
+
+        all_seqs, all_scores = [], []
+        for segment, segment_matches, (lengths, times, senders) in zip(segments, matches, columns):
+            if any(match is None for match in segment_matches):
+                continue
+            seqs, _ = _intersect([(match[0], np.arange(len(match[0]))) for match in segment_matches])
+
+            # Apply the sender and time filters
+            local = seqs - segment.start
+            mask = np.ones(len(seqs), bool)
+            if sender is not None:
+                code = segment.sender_codes.get(sender)
+                if code is None:
+                    continue
+                mask &= senders[local] == code
+            if start is not None:
+                mask &= times[local] >= start
+            if end is not None:
+                mask &= (times[local] <= end) & (times[local] != MISSING_TIME)
+            seqs, local = seqs[mask], local[mask]
+
+            # BM25 over the clauses
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[local] / average_length)
+            scores = np.zeros(len(seqs))
+            for weight, (match_seqs, match_tfs) in zip(idf, segment_matches):
+                tf = match_tfs[np.searchsorted(match_seqs, seqs)].astype(np.float64)
+                scores += weight * tf * (BM25_K1 + 1) / (tf + norm)
+            all_seqs.append(seqs)
+            all_scores.append(scores)
+
+        if not all_seqs:
+            return [], 0
+        seqs = np.concatenate(all_seqs)
+        scores = np.concatenate(all_scores)
+        total = len(seqs)
+
+        # Only fully sort the matches that can make the top limit
+        if limit is not None and limit < total:
+            threshold = np.partition(scores, total - limit)[total - limit]
+            keep = scores >= threshold
+            seqs, scores = seqs[keep], scores[keep]
+        order = np.lexsort((-seqs, -scores))
+        if limit is not None:
+            order = order[:limit]
+        return list(zip(seqs[order].tolist(), scores[order].tolist())), total
+
+    def search(self, clauses, sender=None, start=None, end=None, offset=0, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Function to get one page of matching records as (score, record) pairs,
+        and the number of matches (an upper bound for phrases of three or more words).
+        """
+        long_phrases = [words for kind, words in clauses if kind == "phrase" and len(words) > 2]
+        if not long_phrases:
+            ranked, total = self.rank(clauses, sender, start, end, offset + limit)
+            page = ranked[offset:]
+            records = self.store.read_records([seq for seq, _ in page])
+            return [(score, record) for (_, score), record in zip(page, records)], total
+
+        # Check long phrases against the record text, in rank order
+        ranked, total = self.rank(clauses, sender, start, end)
+        hits = []
+        for batch_start in range(0, len(ranked), VERIFY_BATCH_SIZE):
+            batch = ranked[batch_start:batch_start + VERIFY_BATCH_SIZE]
+            for (_, score), record in zip(batch, self.store.read_records([seq for seq, _ in batch])):
+                if all(contains_phrase(record, self.fields, words) for words in long_phrases):
+                    hits.append((score, record))
+            if len(hits) >= offset + limit:
+                break
+        return hits[offset:offset + limit], total
+
+
+def search_records(index, args):
+    """
+    Function to build the response of a search endpoint.
+    Returns one page of matching records, best match first, with a
+    next_cursor for the following page.
+    """
+    clauses = parse_search(args.get("q", ""))
+    if not clauses:
+        raise QueryError("Missing search query. Use q=<words>")
+
+    start = parse_time(args["start"]) if "start" in args else None
+    end = parse_time(args["end"]) if "end" in args else None
+
+    limit = DEFAULT_SEARCH_LIMIT
+    offset = 0
+    try:
+        if "limit" in args:
+            limit = int(args["limit"])
+        if "cursor" in args:
+            offset = int(args["cursor"])
+    except ValueError:
+        raise QueryError("Invalid limit or cursor")
+    if not 0 < limit <= MAX_SEARCH_LIMIT or offset < 0:
+        raise QueryError(f"Invalid limit or cursor. limit must be between 1 and {MAX_SEARCH_LIMIT}")
+
+    hits, total = index.search(clauses, args.get("sender"), start, end, offset, limit)
+
+    # Hand out a cursor only when there may be more matches
+    next_cursor = None
+    if len(hits) == limit and offset + limit < total:
+        next_cursor = str(offset + limit)
+
+    return jsonify({
+        "status": "success",
+        "data": [{"score": round(score, 4), "record": record} for score, record in hits],
+        "total": total,
+        "next_cursor": next_cursor
+    })
@@ -0,0 +1,143 @@
+"""
+Production serving mode for the collector services.
+
+Mounts the call log, SMS and email collectors and the contacts service in a
+single process, so their stores and indexes are opened once and shared, and
+serves them without the Flask development server. Every route keeps its URL
+(e.g. /collect_sms, /get_call_logs), so clients need no changes.
+
+Servers:
+    threaded  Werkzeug's threaded server, with no extra dependencies (default)
+    waitress  multi-threaded WSGI server (pip install waitress)
+    asgi      uvicorn with an ASGI adapter (pip install uvicorn asgiref),
+              or run "uvicorn --factory server:create_asgi_app"
+A server whose packages are missing falls back to the threaded server.
+
+Storage I/O does not hold up request threads beyond their own commit:
+collects from concurrent requests are written and fsync'd together by each
+store's writer thread. Handlers are still synchronous, so under the ASGI
+server each request occupies a worker thread of the adapter while it waits
+for storage. Each data file must have a single writing process, so to scale
+past one process, run shards.py, which partitions the data by sender across
+several of these servers.
+
+Usage:
+    python server.py --port 5000
+    python server.py --server waitress --threads 64 --port 5000
+"""
+import argparse
+import logging
+
+import call
+import config
+import contacts
+import email_log
+import sms
+
+# Apps mounted by the server, in dispatch order
+APPS = [call.app, sms.app, email_log.app, contacts.app]
+
+# Internal endpoints of the apps, served only by shard workers for the shard router
+SHARD_APIS = [(sms.app, sms.shard_api), (email_log.app, email_log.shard_api)]
+
+
+class Dispatcher:
+    """
+    WSGI app that hands each request to the mounted app owning its path.
+    """
+
+    def __init__(self, apps):
+        self.apps = apps
+        self.routes = {}
+        for app in apps:
+            for rule in app.url_map.iter_rules():
+                self.routes.setdefault(rule.rule, app)
+
+    def __call__(self, environ, start_response):
+        # Unknown paths fall through to the first app for its 404 response
+        app = self.routes.get(environ.get("PATH_INFO", ""), self.apps[0])
+        return app(environ, start_response)
+
+
+def create_app(debug=False, shard=False):
+    """
+    Function to build the combined WSGI app.
+    With shard=True, the internal endpoints the shard router needs are mounted too.
+    """
+    for app in APPS:
+        app.debug = debug
+    if shard:
+        for app, blueprint in SHARD_APIS:
+            if blueprint.name not in app.blueprints:
+                app.register_blueprint(blueprint)
+    return Dispatcher(APPS)
+
+
+def create_asgi_app():
+    """
+    Function to build the combined app as an ASGI app.
+    """
+    from asgiref.wsgi import WsgiToAsgi
+
+    return WsgiToAsgi(create_app())
+
+
+def generate_data():
+    """
+    Function to run the startup data generation of the individual services.
+    """
+    sms.generate_sms_data()
+    email_log.generate_email_data()
+    call.start_dummy_data()
+
+
+def start_maintenance():
+    """
+    Function to start the archive maintenance of every store served.
+    """
+    for archive in (call.call_log_archive, sms.sms_archive, email_log.email_archive):
+        archive.start_maintenance()
+
+
+def serve(app, server=config.SERVER, host=config.HOST, port=config.PORT, threads=config.THREADS):
+    """
+    Function to serve the combined app with the chosen server until interrupted.
+    """
+    server = config.resolve_server(server)
+    if server == "waitress":
+        from waitress import serve as waitress_serve
+
+        waitress_serve(app, host=host, port=port, threads=threads)
+    elif server == "asgi":
+        from asgiref.wsgi import WsgiToAsgi
+        import uvicorn
+
+        uvicorn.run(WsgiToAsgi(app), host=host, port=port, log_level="warning")
+    elif server == "threaded":
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        make_server(host, port, app, threaded=True).serve_forever()
+    else:
+        raise ValueError(f"Unknown server '{server}'")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the call log, SMS, email and contacts services in one process.")
+    parser.add_argument("--server", choices=["waitress", "asgi", "threaded"], default=config.SERVER)
+    parser.add_argument("--host", default=config.HOST)
+    parser.add_argument("--port", type=int, default=config.PORT)
+    parser.add_argument("--threads", type=int, default=config.THREADS, help="request threads (waitress only)")
+    parser.add_argument("--generate", action="store_true", help="generate dummy data at startup like the individual services")
+    parser.add_argument("--debug", action="store_true", help="run the apps in Flask debug mode")
+    parser.add_argument("--shard", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        generate_data()
+    start_maintenance()
+    serve(create_app(args.debug, args.shard), args.server, args.host, args.port, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1022 @@
+"""
+Sender-sharded serving mode for the collector services.
+
+Records are partitioned by sender across N shard workers: every record of a
+sender, on every channel, goes to shard crc32(sender) % N. Sent SMS and
+emails carry no recipient, so they go to the shard of the thread they reply
+to instead, picked the way ThreadIndex picks it (see place_records), so
+reply matching works on every shard as it does in one process. The user's
+own sender is therefore spread over the shards: queries for it go to every
+shard, and it is only reported stale when no other shard has a record of it
+in the meantime. Each worker is a server.py process running in its own
+directory (<data-dir>/shard-<i>/), started with --shard so it also serves the
+internal reply parents endpoints the routers use. It owns that shard's
+stores, indexes, archive and alerts, and scales on its own core. Because a contact's calls, SMS and emails all live on one
+shard, per-contact results never need combining across shards.
+
+In front of the workers, R router processes share one listening socket and
+keep every route's URL:
+    collects        go to the shard owning the record's sender; batches are
+                    split by sender and sent to every shard involved at once
+    queries         go to the owning shard when a sender is given, and are
+                    fanned out to every shard otherwise
+Fanned-out results are merged: retrieval, threads, unanswered messages and
+search results are merged in their usual order, insights, contacts and
+reply times are concatenated, and analytics buckets are added up. Paged
+endpoints hand out one cursor holding every shard's own cursor, so pages
+follow each other exactly. Thread ids are made unique across shards
+(local id * N + shard). Search scores are computed per shard, from that
+shard's term statistics. Alerts are polled from every shard once per
+ALERT_POLL_INTERVAL, and their ids and last_id become cursors of the same
+kind. The routers hold no state, so add routers if they become the
+bottleneck rather than the shards.
+
+Existing data files can be split across the shards before they start, with
+--split, which places replies exactly by threading the whole files first.
+Archived segments of those files are not split. Changing the
+number of shards requires splitting the data again.
+
+Usage:
+    python shards.py --shards 4 --routers 2 --port 5000 --data-dir shards
+    python shards.py --shards 4 --split call_log_data.json sms_data.json email_data.json
+"""
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from itertools import islice
+import http.client
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+import zlib
+
+from flask import Flask, Response, jsonify, request
+
+import config
+from index import format_timestamp, parse_timestamp
+from ingest import PayloadError, read_batch
+from metrics import instrument
+from query import STREAM_CHUNK_SIZE, QueryError
+from rollups import WEEKDAYS
+from search import DEFAULT_SEARCH_LIMIT
+from storage import encode_record
+from threads import DEFAULT_THREAD_LIMIT, MAX_REPLY_CANDIDATES, REPLY_WINDOW, THREAD_GAP, ThreadIndex, normalize_subject
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Data files of the collectors, split across the shards by sender
+DATA_FILES = ["call_log_data.json", "sms_data.json", "email_data.json"]
+
+# Subject field of the data files with threads (None for SMS), used to place replies
+THREADED_FILES = {
+    "sms_data.json": None,
+    "email_data.json": "subject"
+}
+
+# Reply parent route and subject field of the collect routes with threads
+REPLY_PARENTS = {
+    "/collect_sms": ("/sms_reply_parents", None),
+    "/collect_sms_batch": ("/sms_reply_parents", None),
+    "/collect_email": ("/email_reply_parents", "subject"),
+    "/collect_email_batch": ("/email_reply_parents", "subject")
+}
+
+# Sender of the user's own messages, stored with the threads they reply to on any shard
+SELF_SENDER = "Me"
+
+# Retrieval route of the source of every staleness route
+RECORD_ROUTES = {
+    "/analyze_call_logs": "/get_call_logs",
+    "/analyze_sms": "/get_sms_data",
+    "/analyze_emails": "/get_email_data",
+    "/call_log_alerts": "/get_call_logs",
+    "/sms_alerts": "/get_sms_data",
+    "/email_alerts": "/get_email_data"
+}
+
+# File in the data directory recording the number of shards
+SHARDS_FILE = "shards.json"
+
+# Address the shard workers listen on
+SHARD_HOST = "127.0.0.1"
+
+# Longest wait for a shard response (seconds)
+SHARD_TIMEOUT = 120
+
+# Longest wait for the shard workers to start, e.g. while rebuilding indexes (seconds)
+STARTUP_TIMEOUT = 600
+
+# Threads per router sending requests to the shards in parallel
+FAN_OUT_THREADS = 64
+
+# Interval between alert polls of the shards (seconds)
+ALERT_POLL_INTERVAL = 1.0
+
+# Longest long-poll wait and interval between keep-alive comments, as in alerts.py (seconds)
+MAX_POLL_TIMEOUT = 60
+KEEPALIVE_INTERVAL = 15
+
+# Routes of the collector services, by how the router handles them
+ROUTES = {
+    "/collect_call_log": "collect",
+    "/collect_sms": "collect",
+    "/collect_email": "collect",
+    "/collect_call_log_batch": "batch",
+    "/collect_sms_batch": "batch",
+    "/collect_email_batch": "batch",
+    "/get_call_logs": "records",
+    "/get_sms_data": "records",
+    "/get_email_data": "records",
+    "/analyze_call_logs": "insights",
+    "/analyze_sms": "insights",
+    "/analyze_emails": "insights",
+    "/search_sms": "search",
+    "/search_emails": "search",
+    "/sms_threads": "threads",
+    "/email_threads": "threads",
+    "/sms_reply_times": "reply_times",
+    "/email_reply_times": "reply_times",
+    "/sms_unanswered": "unanswered",
+    "/email_unanswered": "unanswered",
+    "/call_log_alerts": "alerts",
+    "/sms_alerts": "alerts",
+    "/email_alerts": "alerts",
+    "/call_log_alerts/stream": "alert_stream",
+    "/sms_alerts/stream": "alert_stream",
+    "/email_alerts/stream": "alert_stream",
+    "/get_contacts": "contacts",
+    "/analyze_contacts": "stale_contacts",
+    "/analytics": "analytics"
+}
+
+ShardResponse = namedtuple("ShardResponse", ["status", "content_type", "body"])
+
+
+class ShardError(Exception):
+    """
+    Raised when a shard answers with an error, which is passed on to the client.
+    """
+
+    def __init__(self, response):
+        super().__init__(response.body.decode("utf-8", "replace"))
+        self.response = response
+
+
+def shard_of(sender, shards):
+    """
+    Function to get the shard owning a sender's records.
+    Records without a valid sender go to shard 0, which rejects them.
+    """
+    if not isinstance(sender, str):
+        return 0
+    return zlib.crc32(sender.encode("utf-8")) % shards
+
+
+def _sender(record):
+    return record.get("sender") if isinstance(record, dict) else None
+
+
+def encode_cursors(cursors):
+    """
+    Function to join the cursors of every shard into one cursor string.
+    """
+    return ",".join("" if cursor is None else str(cursor) for cursor in cursors)
+
+
+def decode_cursors(value, shards):
+    """
+    Function to split a cursor string into the cursor of every shard (None where a shard has not started).
+    """
+    if value is None:
+        return [None] * shards
+    parts = value.split(",")
+    if len(parts) != shards:
+        raise QueryError("Invalid cursor")
+    return [part or None for part in parts]
+
+
+class ShardPool:
+    """
+    HTTP client of the shard workers, with one keep-alive connection per thread and shard.
+    """
+
+    def __init__(self, ports, host=SHARD_HOST, timeout=SHARD_TIMEOUT):
+        self.ports = ports
+        self.host = host
+        self.timeout = timeout
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=FAN_OUT_THREADS, thread_name_prefix="fan-out")
+
+    def __len__(self):
+        return len(self.ports)
+
+    def owner(self, sender):
+        return shard_of(sender, len(self.ports))
+
+    def _connection(self, shard, fresh=False):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if fresh or shard not in connections:
+            if shard in connections:
+                connections[shard].close()
+            connections[shard] = http.client.HTTPConnection(self.host, self.ports[shard], timeout=self.timeout)
+        return connections[shard]
+
+    def request(self, shard, method, path, body=None, content_type=None):
+        """
+        Function to send a request to a shard. Returns its ShardResponse.
+        """
+        headers = {"Content-Type": content_type} if content_type else {}
+        for attempt in range(2):
+            connection = self._connection(shard, fresh=attempt > 0)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                return ShardResponse(response.status, response.getheader("Content-Type"), response.read())
+            except (http.client.HTTPException, ConnectionError):
+                # The shard may have closed the kept-alive connection; retry once on a new one.
+                # A retried collect is safe, since shards do not store a record twice
+                connection.close()
+                if attempt:
+                    raise
+
+    def fan_out(self, method, requests, content_type=None):
+        """
+        Function to send requests ((shard, path, body) tuples) to their shards in parallel.
+        Returns the responses in the same order.
+        """
+        if len(requests) == 1:
+            shard, path, body = requests[0]
+            return [self.request(shard, method, path, body, content_type)]
+        futures = [
+            self._executor.submit(self.request, shard, method, path, body, content_type)
+            for shard, path, body in requests
+        ]
+        return [future.result() for future in futures]
+
+    def get_json(self, requests):
+        """
+        Function to send GET requests ((shard, path, params) tuples) in parallel and decode
+        their JSON responses. Raises ShardError if a shard answers with an error.
+        """
+        responses = self.fan_out("GET", [(shard, f"{path}?{urlencode(params)}", None) for shard, path, params in requests])
+        for response in responses:
+            if response.status >= 400:
+                raise ShardError(response)
+        return [json.loads(response.body) for response in responses]
+
+
+def _proxy(response):
+    return Response(response.body, status=response.status, content_type=response.content_type)
+
+
+def _targets(pool, params):
+    """
+    Function to get the shards a query goes to: the owner of its sender, or every shard.
+    """
+    if "sender" in params and params["sender"] != SELF_SENDER:
+        return [pool.owner(params["sender"])]
+    return list(range(len(pool)))
+
+
+def _limit(params, default=None):
+    if "limit" not in params:
+        return default
+    try:
+        return int(params["limit"])
+    except ValueError:
+        raise QueryError("Invalid limit. Must be a positive integer")
+
+
+def fan_out_page(pool, path, params, limit, order, item_cursor, field="data", reverse=False):
+    """
+    Function to get one page of a paged endpoint, merged from the shards the query goes to.
+    Each shard is asked for a full page after its own cursor, and the pages are
+    merged by order(body, position, item). item_cursor(body, position, item, cursor)
+    gives a shard's cursor after one of its items. Returns the (shard, item)
+    pairs of the page, the cursor of the next page (None on the last page) and
+    the response of every shard asked.
+    """
+    cursors = decode_cursors(params.pop("cursor", None), len(pool))
+    requests = []
+    for shard in _targets(pool, params):
+        shard_params = dict(params, keys="1")
+        if limit is not None:
+            shard_params["limit"] = limit
+        if cursors[shard] is not None:
+            shard_params["cursor"] = cursors[shard]
+        requests.append((shard, path, shard_params))
+    bodies = dict(zip((shard for shard, _, _ in requests), pool.get_json(requests)))
+
+    # Merge the pages, keeping each shard's own order
+    pages = [
+        [(order(body, position, item), shard, position) for position, item in enumerate(body[field])]
+        for shard, body in bodies.items()
+    ]
+    merged = heapq.merge(*pages, reverse=reverse)
+    taken = list(merged if limit is None else islice(merged, limit))
+
+    # Move the cursor of every shard past its items on this page
+    used = {}
+    for _, shard, position in taken:
+        cursors[shard] = item_cursor(bodies[shard], position, bodies[shard][field][position], cursors[shard])
+        used[shard] = position + 1
+    more = any(
+        used.get(shard, 0) < len(body[field]) or body.get("next_cursor") is not None
+        for shard, body in bodies.items()
+    )
+    next_cursor = encode_cursors(cursors) if limit is not None and len(taken) == limit and more else None
+
+    return [(shard, bodies[shard][field][position]) for _, shard, position in taken], next_cursor, bodies
+
+
+def _global_thread_id(thread_id, shard, shards):
+    return thread_id * shards + shard
+
+
+def _waiting_threads(pool, parent_path, records):
+    """
+    Function to ask every shard about sent records: which shard stores each one
+    already, and which threads are waiting for a reply.
+    Returns the storing shard of every record (None where there is none), and
+    the waiting threads of every shard as [shard, oldest waiting time, latest
+    waiting time, contact, normalized subject] entries, most recently waiting last.
+    """
+    body = json.dumps(records).encode("utf-8")
+    responses = pool.fan_out("POST", [(shard, parent_path, body) for shard in range(len(pool))], "application/json")
+    for response in responses:
+        if response.status >= 400:
+            raise ShardError(response)
+    answers = [json.loads(response.body) for response in responses]
+
+    storing = [
+        next((shard for shard, answer in enumerate(answers) if answer["stored"][position]), None)
+        for position in range(len(records))
+    ]
+    waiting = sorted(
+        (
+            [shard, parse_timestamp(thread["first_waiting"]), parse_timestamp(thread["last_waiting"]),
+             thread["conversation"], thread["subject"]]
+            for shard, answer in enumerate(answers) for thread in answer["waiting"]
+        ),
+        key=lambda entry: (entry[2], entry[0])
+    )
+    return storing, waiting
+
+
+def _reply_parent(waiting, record_time, key):
+    """
+    Function to pick the waiting thread a sent message replies to, as ThreadIndex
+    does: the most recently waiting one, preferring a matching subject.
+    """
+    parent = None
+    for entry in reversed(waiting[-MAX_REPLY_CANDIDATES:]):
+        # The reply must come after a waiting message, and within the window of the latest one
+        if entry[1] > record_time or record_time - entry[2] > REPLY_WINDOW:
+            continue
+        if entry[4] == key:
+            return entry
+        if parent is None:
+            parent = entry
+    return parent
+
+
+def place_records(pool, path, records):
+    """
+    Function to pick the shard of every record of a collect, in order.
+    A record goes to the owner of its sender, except a sent message of a source
+    with threads: it has no recipient, so it goes to the shard of the thread it
+    replies to, or to the shard storing it already when it is sent again. The
+    router replays ThreadIndex's matching over the threads the shards have
+    waiting and the messages of the batch, so replies are matched as they
+    would be on one shard holding every record.
+    """
+    if path not in REPLY_PARENTS:
+        return [pool.owner(_sender(record)) for record in records]
+    parent_path, subject_field = REPLY_PARENTS[path]
+
+    sent = [position for position, record in enumerate(records) if isinstance(record, dict) and record.get("type") == "sent"]
+    storing, waiting = _waiting_threads(pool, parent_path, [records[position] for position in sent]) if sent else ([], [])
+    storing = dict(zip(sent, storing))
+
+    shards = []
+    for position, record in enumerate(records):
+        shard = pool.owner(_sender(record))
+        try:
+            record_time = parse_timestamp(record["datetime"])
+        except (KeyError, TypeError, ValueError):
+            # Invalid records are rejected by the owner of their sender
+            shards.append(shard)
+            continue
+        key = normalize_subject(record.get(subject_field)) if subject_field else None
+
+        if position in storing:
+            if storing[position] is not None:
+                shard = storing[position]
+            else:
+                parent = _reply_parent(waiting, record_time, key)
+                if parent is not None:
+                    shard = parent[0]
+
+                    # The reply answers the messages of its thread sent before it
+                    if parent[2] <= record_time:
+                        waiting.remove(parent)
+        else:
+            # The message joins its sender's thread, which becomes the most recently waiting
+            entry = next((entry for entry in reversed(waiting) if entry[3:] == [_sender(record), key]), None)
+            if entry is not None and abs(record_time - entry[2]) <= THREAD_GAP:
+                waiting.remove(entry)
+                entry[2] = max(entry[2], record_time)
+            else:
+                entry = [shard, record_time, record_time, _sender(record), key]
+            waiting.append(entry)
+        shards.append(shard)
+    return shards
+
+
+def route_collect(pool, path):
+    """
+    Function to send a collected record to the shard it belongs to.
+    """
+    body = request.get_data()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    shard, = place_records(pool, path, [data])
+    return _proxy(pool.request(shard, "POST", path, body, request.content_type))
+
+
+def route_batch(pool, path):
+    """
+    Function to split a batch by shard, collect every part on its shard at once
+    and add up the results. Errors keep the positions of the original batch.
+    """
+    try:
+        entries = read_batch(request)
+    except PayloadError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    # {shard: [(position in the batch, record)]}; unreadable lines are rejected here
+    readable = [(index, record) for index, (record, error) in enumerate(entries) if error is None]
+    errors = [{"index": index, "message": error} for index, (_, error) in enumerate(entries) if error is not None]
+    parts = {}
+    for (index, record), shard in zip(readable, place_records(pool, path, [record for _, record in readable])):
+        parts.setdefault(shard, []).append((index, record))
+
+    requests = [
+        (shard, path, json.dumps([record for _, record in part]).encode("utf-8"))
+        for shard, part in parts.items()
+    ]
+    responses = pool.fan_out("POST", requests, "application/json")
+
+    result = {"status": "success", "accepted": 0, "rejected": len(errors), "duplicates": 0, "errors": errors}
+    for (shard, _, _), response in zip(requests, responses):
+        if response.status >= 400:
+            return _proxy(response)
+        body = json.loads(response.body)
+        for key in ("accepted", "rejected", "duplicates"):
+            result[key] += body[key]
+        for error in body["errors"]:
+            errors.append({"index": parts[shard][error["index"]][0], "message": error["message"]})
+    errors.sort(key=lambda error: error["index"])
+    return jsonify(result)
+
+
+def _record_order(body, position, item):
+    return int(body["keys"][position].split(":")[0])
+
+
+def _record_cursor(body, position, item, cursor):
+    return body["keys"][position]
+
+
+def route_records(pool, path):
+    """
+    Function to merge retrieved records from the shards in datetime order,
+    as one page of JSON or streamed as NDJSON.
+    """
+    params = request.args.to_dict()
+    limit = _limit(params)
+
+    if params.pop("format", None) != "ndjson":
+        taken, next_cursor, _ = fan_out_page(pool, path, params, limit, _record_order, _record_cursor)
+        return jsonify({"status": "success", "data": [record for _, record in taken], "next_cursor": next_cursor})
+
+    # Stream one merged chunk at a time; the first one is read now, so errors get their status
+    def chunk(params, sent):
+        chunk_size = STREAM_CHUNK_SIZE if limit is None else min(STREAM_CHUNK_SIZE, limit - sent)
+        taken, next_cursor, _ = fan_out_page(pool, path, dict(params), chunk_size, _record_order, _record_cursor)
+        return [record for _, record in taken], next_cursor
+
+    def stream(records, next_cursor):
+        sent = 0
+        while True:
+            yield "".join(encode_record(record) for record in records).encode("utf-8")
+            sent += len(records)
+            if next_cursor is None or (limit is not None and sent >= limit):
+                break
+            records, next_cursor = chunk(dict(params, cursor=next_cursor), sent)
+
+    return Response(stream(*chunk(params, 0)), mimetype="application/x-ndjson")
+
+
+def _seen_since(pool, path, shards, start, end=None):
+    """
+    Function to check whether any of the shards has a record of the user's own
+    sender from start on (and up to end), using the retrieval route path.
+    """
+    if not shards:
+        return False
+    params = {"sender": SELF_SENDER, "start": start, "limit": 1}
+    if end is not None:
+        params["end"] = end
+    bodies = pool.get_json([(shard, path, params) for shard in shards])
+    return any(body["data"] for body in bodies)
+
+
+def route_insights(pool, path):
+    """
+    Function to concatenate the staleness insights of every shard.
+    """
+    bodies = pool.get_json([(shard, path, dict(request.args.to_dict(), keys="1")) for shard in range(len(pool))])
+    insights = [
+        insight for body in bodies
+        for sender, insight in zip(body["senders"], body["insights"]) if sender != SELF_SENDER
+    ]
+
+    # The user's own sender is stale only if no other shard has a record of it since the cutoff
+    reporting = [shard for shard, body in enumerate(bodies) if SELF_SENDER in body["senders"]]
+    if reporting:
+        body = bodies[reporting[0]]
+        others = [shard for shard in range(len(pool)) if shard not in reporting]
+        if not _seen_since(pool, RECORD_ROUTES[path], others, body["cutoff"]):
+            insights.append(body["insights"][body["senders"].index(SELF_SENDER)])
+
+    return jsonify({"status": "success", "insights": insights})
+
+
+def route_search(pool, path):
+    """
+    Function to merge search results from the shards, best match first.
+    """
+    params = request.args.to_dict()
+    limit = _limit(params, DEFAULT_SEARCH_LIMIT)
+    taken, next_cursor, bodies = fan_out_page(
+        pool, path, params, limit,
+        order=lambda body, position, item: item["score"],
+        item_cursor=lambda body, position, item, cursor: str(int(cursor or 0) + 1),
+        reverse=True
+    )
+    return jsonify({
+        "status": "success",
+        "data": [hit for _, hit in taken],
+        "total": sum(body["total"] for body in bodies.values()),
+        "next_cursor": next_cursor
+    })
+
+
+def route_threads(pool, path):
+    """
+    Function to get one thread from its shard, or merge thread summaries from
+    the shards, newest first. Every shard lists its threads by descending
+    thread_id, so the pages are merged by global thread_id, the order a single
+    process lists them in.
+    """
+    params = request.args.to_dict()
+    shards = len(pool)
+
+    if "thread" in params:
+        try:
+            thread_id = int(params["thread"])
+        except ValueError:
+            raise QueryError("Invalid thread. Must be a thread_id")
+        if thread_id < 0:
+            raise QueryError(f"Unknown thread '{params['thread']}'")
+        shard, local_id = thread_id % shards, thread_id // shards
+        try:
+            body, = pool.get_json([(shard, path, dict(params, thread=local_id))])
+        except ShardError as e:
+            if e.response.status == 400:
+                raise QueryError(f"Unknown thread '{params['thread']}'")
+            raise
+        body["thread"]["thread_id"] = thread_id
+        return jsonify(body)
+
+    # Ties between shards are broken by shard, so (thread_id, shard) sorts like the global thread_id
+    limit = _limit(params, DEFAULT_THREAD_LIMIT)
+    taken, next_cursor, _ = fan_out_page(
+        pool, path, params, limit,
+        order=lambda body, position, item: item["thread_id"],
+        item_cursor=lambda body, position, item, cursor: str(item["thread_id"]),
+        reverse=True
+    )
+    data = [dict(summary, thread_id=_global_thread_id(summary["thread_id"], shard, shards)) for shard, summary in taken]
+    return jsonify({"status": "success", "data": data, "next_cursor": next_cursor})
+
+
+def route_unanswered(pool, path):
+    """
+    Function to merge messages waiting for a reply from the shards, oldest first.
+    Every shard lists them by (time, record number), the key of their cursors.
+    """
+    params = request.args.to_dict()
+    limit = _limit(params, DEFAULT_THREAD_LIMIT)
+    taken, next_cursor, _ = fan_out_page(pool, path, params, limit, _record_order, _record_cursor)
+    data = [
+        dict(entry, thread_id=_global_thread_id(entry["thread_id"], shard, len(pool)))
+        for shard, entry in taken
+    ]
+    return jsonify({"status": "success", "data": data, "next_cursor": next_cursor})
+
+
+def route_reply_times(pool, path):
+    """
+    Function to merge the reply latency statistics of the shards' contacts.
+    """
+    params = request.args.to_dict()
+    bodies = pool.get_json([(shard, path, params) for shard in _targets(pool, params)])
+    contacts = {}
+    for body in bodies:
+        contacts.update(body["contacts"])
+    return jsonify({"status": "success", "contacts": contacts})
+
+
+def route_contacts(pool, path):
+    """
+    Function to concatenate the contacts of every shard.
+    """
+    bodies = pool.get_json([(shard, path, request.args.to_dict()) for shard in range(len(pool))])
+    return jsonify({"status": "success", "data": [contact for body in bodies for contact in body["data"]]})
+
+
+def route_stale_contacts(pool, path):
+    """
+    Function to merge the stale contacts of every shard, least recently contacted first.
+    """
+    bodies = pool.get_json([(shard, path, request.args.to_dict()) for shard in range(len(pool))])
+    stale = sorted(
+        (pair for body in bodies for pair in zip(body["insights"], body["contacts"])),
+        key=lambda pair: pair[1]["last_contact"]
+    )
+    return jsonify({
+        "status": "success",
+        "insights": [insight for insight, _ in stale],
+        "contacts": [contact for _, contact in stale]
+    })
+
+
+def _slot_order(item):
+    return item.get("bucket", ""), WEEKDAYS.index(item["weekday"]) if "weekday" in item else -1, item.get("hour", -1)
+
+
+def route_analytics(pool, path):
+    """
+    Function to add up the analytics buckets of the shards.
+    """
+    params = request.args.to_dict()
+    bodies = pool.get_json([(shard, path, params) for shard in _targets(pool, params)])
+
+    # {slot: [counts by source and type, [replies, total latency, max latency]]}
+    slots = {}
+    for body in bodies:
+        for item in body["data"]:
+            slot = tuple((key, item[key]) for key in ("bucket", "weekday", "hour") if key in item)
+            entry = slots.setdefault(slot, [{}, None])
+            for source, counts in item["counts"].items():
+                source_counts = entry[0].setdefault(source, {})
+                for record_type, count in counts.items():
+                    source_counts[record_type] = source_counts.get(record_type, 0) + count
+            latency = item.get("latency")
+            if latency is not None:
+                if entry[1] is None:
+                    entry[1] = [0, 0, 0]
+                entry[1][0] += latency["replies"]
+                entry[1][1] += latency["mean_seconds"] * latency["replies"]
+                entry[1][2] = max(entry[1][2], latency["max_seconds"])
+
+    data = []
+    for slot, (counts, latency) in slots.items():
+        item = dict(slot)
+        item["counts"] = counts
+        item["total"] = sum(sum(source_counts.values()) for source_counts in counts.values())
+        if latency is not None:
+            item["latency"] = {"replies": latency[0], "mean_seconds": latency[1] / latency[0], "max_seconds": latency[2]}
+        data.append(item)
+    data.sort(key=_slot_order)
+
+    response = dict(bodies[0], data=data)
+    if "busiest" in response:
+        response["busiest"] = max(data, key=lambda item: item["total"], default=None)
+    return jsonify(response)
+
+
+def _alert_cursors(pool, after):
+    # A plain 0 (or nothing) starts every shard from its first alert
+    return decode_cursors(None if after in (None, "", "0") else after, len(pool))
+
+
+def poll_shards(pool, path, cursors):
+    """
+    Function to get the alerts fired on every shard after its cursor, without waiting.
+    Each alert's id becomes the cursor after it. Returns the alerts and the new cursors.
+    """
+    try:
+        after = [int(cursor or 0) for cursor in cursors]
+    except ValueError:
+        raise QueryError("Invalid after or timeout. Must be numbers")
+    bodies = pool.get_json([(shard, path, {"after": after[shard]}) for shard in range(len(pool))])
+
+    # Merge by the time senders went stale, keeping each shard's own order
+    alerts = []
+    merged = heapq.merge(*(
+        [(alert["stale_since"], shard, alert) for alert in body["alerts"]]
+        for shard, body in enumerate(bodies)
+    ), key=lambda entry: entry[:2])
+    for _, shard, alert in merged:
+        after[shard] = alert["id"]
+
+        # The user's own sender did not go stale if another shard has a record of it in the meantime
+        if alert["sender"] == SELF_SENDER:
+            others = [other for other in range(len(pool)) if other != shard]
+            newer = format_timestamp(parse_timestamp(alert["last_seen"]) + 1)
+            if _seen_since(pool, RECORD_ROUTES[path], others, newer, alert["stale_since"]):
+                continue
+        alerts.append(dict(alert, id=encode_cursors(after)))
+    return alerts, [body["last_id"] for body in bodies]
+
+
+def route_alerts(pool, path):
+    """
+    Function to long-poll the staleness alerts of every shard.
+    """
+    cursors = _alert_cursors(pool, request.args.get("after"))
+    try:
+        timeout = min(float(request.args.get("timeout", 0)), MAX_POLL_TIMEOUT)
+    except ValueError:
+        raise QueryError("Invalid after or timeout. Must be numbers")
+    if timeout < 0:
+        raise QueryError("Invalid after or timeout. Must be numbers")
+
+    deadline = time.monotonic() + timeout
+    while True:
+        alerts, cursors = poll_shards(pool, path, cursors)
+        remaining = deadline - time.monotonic()
+        if alerts or remaining <= 0:
+            break
+        time.sleep(min(ALERT_POLL_INTERVAL, remaining))
+    return jsonify({"status": "success", "alerts": alerts, "last_id": encode_cursors(cursors)})
+
+
+def route_alert_stream(pool, path):
+    """
+    Function to stream the staleness alerts of every shard as server-sent events.
+    """
+    poll_path = path[:-len("/stream")]
+    cursors = _alert_cursors(pool, request.headers.get("Last-Event-ID") or request.args.get("after"))
+
+    def events(cursors):
+        idle = 0.0
+        while True:
+            alerts, cursors = poll_shards(pool, poll_path, cursors)
+            for alert in alerts:
+                yield f"id: {alert['id']}\nevent: stale\ndata: {json.dumps(alert)}\n\n"
+            idle = 0.0 if alerts else idle + ALERT_POLL_INTERVAL
+            if idle >= KEEPALIVE_INTERVAL:
+                yield ": keep-alive\n\n"
+                idle = 0.0
+            time.sleep(ALERT_POLL_INTERVAL)
+
+    return Response(events(cursors), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+HANDLERS = {
+    "collect": route_collect,
+    "batch": route_batch,
+    "records": route_records,
+    "insights": route_insights,
+    "search": route_search,
+    "threads": route_threads,
+    "unanswered": route_unanswered,
+    "reply_times": route_reply_times,
+    "alerts": route_alerts,
+    "alert_stream": route_alert_stream,
+    "contacts": route_contacts,
+    "stale_contacts": route_stale_contacts,
+    "analytics": route_analytics
+}
+
+
+def create_router(pool):
+    """
+    Function to build the router app, serving every route of the collectors from the shards.
+    """
+    app = Flask(__name__)
+
+    def view(handler, path):
+        def handle():
+            try:
+                return handler(pool, path)
+            except QueryError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+            except ShardError as e:
+                return _proxy(e.response)
+            except Exception as e:
+                return jsonify({"status": "error", "message": str(e)}), 500
+        return handle
+
+    for path, kind in ROUTES.items():
+        methods = ["POST"] if kind in ("collect", "batch") else ["GET"]
+        app.add_url_rule(path, path, view(HANDLERS[kind], path), methods=methods)
+
+    # Request timers of the router itself; every shard has its own /metrics
+    instrument(app, [])
+    return app
+
+
+def split_data(paths, data_dir, shards):
+    """
+    Function to copy the records of data files into the stores of the shards they belong to.
+    Files with threads are threaded first, so every reply goes to the shard of
+    the contact it answers. The shard stores are replaced, so splitting again
+    starts over, and closed, so the shard workers can write them.
+    """
+    from storage import open_store
+
+    for path in paths:
+        source = open_store(path, compact_every=0)
+
+        # Contact of the thread of every record, where it has one
+        contacts = {}
+        name = os.path.basename(path)
+        if name in THREADED_FILES:
+            threads = ThreadIndex("type", subject_field=THREADED_FILES[name])
+            threads.rebuild(source)
+            thread_id = 0
+            found = threads.thread(thread_id)
+            while found is not None:
+                summary, seqs = found
+                if summary["conversation"] is not None:
+                    contacts.update(dict.fromkeys(seqs, summary["conversation"]))
+                thread_id += 1
+                found = threads.thread(thread_id)
+
+        for shard in range(shards):
+            target = open_store(os.path.join(shard_dir(data_dir, shard), name))
+            target.replace(
+                record for seq, record in enumerate(source)
+                if shard_of(contacts.get(seq, _sender(record)), shards) == shard
+            )
+            print(f"Shard {shard}: {len(target)} of {len(source)} records from {source.path}")
+
+            # Let the shard worker write the store
+            target.close()
+        source.close()
+
+
+def shard_dir(data_dir, shard):
+    return os.path.join(data_dir, f"shard-{shard}")
+
+
+def check_layout(data_dir, shards):
+    """
+    Function to create the shard directories, or check that they were created for the same number of shards.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, SHARDS_FILE)
+    if os.path.exists(path):
+        with open(path) as file:
+            existing = json.load(file)["shards"]
+        if existing != shards:
+            sys.exit(f"{data_dir} holds {existing} shards, not {shards}; split the data again into a new directory")
+    for shard in range(shards):
+        os.makedirs(shard_dir(data_dir, shard), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump({"shards": shards}, file)
+
+
+def wait_for_port(port, process, timeout=STARTUP_TIMEOUT):
+    """
+    Function to wait until a shard worker accepts connections.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Shard worker on port {port} exited with status {process.returncode}")
+        try:
+            socket.create_connection((SHARD_HOST, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Shard worker on port {port} did not start within {timeout} seconds")
+
+
+def serve_socket(app, sock, server=config.SERVER, threads=config.THREADS):
+    """
+    Function to serve an app on a listening socket shared with other processes.
+    """
+    server = config.resolve_server(server)
+    if server == "waitress":
+        from waitress import serve as waitress_serve
+
+        waitress_serve(app, sockets=[sock], threads=threads)
+    elif server == "asgi":
+        from asgiref.wsgi import WsgiToAsgi
+        import uvicorn
+
+        uvicorn.run(WsgiToAsgi(app), fd=sock.fileno(), log_level="warning")
+    elif server == "threaded":
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        host, port = sock.getsockname()[:2]
+        make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+    else:
+        raise ValueError(f"Unknown server '{server}'")
+
+
+def start(args):
+    """
+    Function to start the shard workers and the routers. Returns their processes.
+    """
+    processes = []
+    ports = [args.shard_port + shard for shard in range(args.shards)]
+    for shard, port in enumerate(ports):
+        command = [
+            sys.executable, os.path.join(REPO_DIR, "server.py"), "--server", args.server,
+            "--host", SHARD_HOST, "--port", str(port), "--threads", str(args.threads), "--shard"
+        ]
+        processes.append(subprocess.Popen(command, cwd=shard_dir(args.data_dir, shard)))
+    for port, process in zip(ports, processes):
+        wait_for_port(port, process)
+
+    # Every router accepts connections from the same socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(1024)
+    for _ in range(args.routers):
+        command = [
+            sys.executable, os.path.abspath(__file__), "--router-fd", str(sock.fileno()),
+            "--shard-ports", ",".join(map(str, ports)), "--server", args.server, "--threads", str(args.threads)
+        ]
+        processes.append(subprocess.Popen(command, pass_fds=[sock.fileno()]))
+    sock.close()
+    return processes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the collector services from sender-sharded worker processes.")
+    parser.add_argument("--shards", type=int, default=config.SHARDS)
+    parser.add_argument("--routers", type=int, default=config.ROUTERS)
+    parser.add_argument("--server", choices=["waitress", "asgi", "threaded"], default=config.SERVER)
+    parser.add_argument("--host", default=config.HOST)
+    parser.add_argument("--port", type=int, default=config.PORT)
+    parser.add_argument("--shard-port", type=int, help="port of the first shard worker (defaults to --port + 1)")
+    parser.add_argument("--threads", type=int, default=config.THREADS, help="request threads per process (waitress only)")
+    parser.add_argument("--data-dir", default="shards", help="directory holding a directory per shard")
+    parser.add_argument("--split", nargs="+", metavar="PATH", help="split these data files across the shards first")
+    parser.add_argument("--router-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--shard-ports", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # Router process started by the launcher below
+    if args.router_fd is not None:
+        pool = ShardPool([int(port) for port in args.shard_ports.split(",")])
+        serve_socket(create_router(pool), socket.socket(fileno=args.router_fd), args.server, args.threads)
+        return
+
+    if args.shards < 1 or args.routers < 1:
+        parser.error("--shards and --routers must be at least 1")
+    if args.shard_port is None:
+        args.shard_port = args.port + 1
+    check_layout(args.data_dir, args.shards)
+    if args.split:
+        split_data(args.split, args.data_dir, args.shards)
+
+    processes = start(args)
+    print(f"Serving {args.shards} shards through {args.routers} routers on {args.host}:{args.port}")
+    try:
+        # Stop everything once any process exits
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
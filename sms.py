@@ -1,114 +1,142 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify
+from werkzeug.serving import is_running_from_reloader
 from datetime import datetime, timedelta
-import json
-import os
 import random
 
+from alerts import StalenessMonitor, poll_alerts, stream_alerts
+from archive import SegmentArchive
+from cache import cached
+from config import DEBUG
+from dedup import DEDUP_FIELDS, DedupIndex
+from index import SenderIndex, TimeIndex, format_timestamp, parse_timestamp, to_epoch
+from ingest import PayloadError, collect_batch, read_batch
+from metrics import instrument, phase
+from pools import NAMES, RECEIVED_CONTENT, SENT_CONTENT
+from query import QueryError, get_records, parse_days, staleness_expiry
+from rollups import RollupIndex
+from search import SearchIndex, search_records
+from storage import open_store
+from threads import ThreadIndex, get_reply_parents, get_reply_times, get_threads, get_unanswered
+
 app = Flask(__name__)
 
+# Endpoints used only by the shard router, registered on shard workers (see server.py)
+shard_api = Blueprint("sms_shard", __name__)
+
+# Days without contact before a sender is reported as stale
+STALE_AFTER_DAYS = 7
+
+# Insight reported for a stale sender
+STALE_INSIGHT = "{sender} hasn't texted in a while. Check on them!"
+
 # File to store collected SMS data
 SMS_FILE = "sms_data.json"
 
-# Ensure the data file exists
-if not os.path.exists(SMS_FILE):
-    with open(SMS_FILE, "w", encoding="utf-8") as f:
-        json.dump([], f, ensure_ascii=False)
-
-# List of 150 unique names
-NAMES = [
-    "John Doe", "Jane Smith", "Alice Johnson", "Bob Brown", "Charlie Davis", "Eve Wilson", "Frank Moore", "Grace Taylor",
-    "Hank Anderson", "Ivy Thomas", "Jack White", "Karen Harris", "Leo Martin", "Mia Thompson", "Nina Garcia", "Oscar Martinez",
-    "Paul Robinson", "Quinn Clark", "Rachel Rodriguez", "Steve Lewis", "Tina Lee", "Uma Walker", "Victor Hall", "Wendy Allen",
-    "Xander Young", "Yara Hernandez", "Zack King", "Aaron Wright", "Bella Lopez", "Caleb Hill", "Daisy Scott", "Eli Green",
-    "Fiona Adams", "Gabe Baker", "Hazel Gonzalez", "Ian Nelson", "Jade Carter", "Kai Mitchell", "Luna Perez", "Mason Roberts",
-    "Nora Turner", "Owen Phillips", "Penny Campbell", "Quincy Parker", "Riley Evans", "Sofia Edwards", "Theo Collins",
-    "Ursula Stewart", "Violet Sanchez", "Wyatt Morris", "Xena Rogers", "Yvonne Reed", "Zane Cook", "Ava Morgan", "Blake Bell",
-    "Cora Murphy", "Dexter Bailey", "Eva Rivera", "Felix Cooper", "Gwen Richardson", "Hugo Cox", "Isla Howard", "Jake Ward",
-    "Kira Torres", "Liam Peterson", "Maya Gray", "Nolan Ramirez", "Olive James", "Peyton Watson", "Quinn Brooks",
-    "Rory Kelly", "Sadie Sanders", "Tobias Price", "Uma Bennett", "Vera Wood", "Wade Barnes", "Xyla Ross", "Yara Henderson",
-    "Zeke Coleman", "Aria Jenkins", "Brett Perry", "Clara Powell", "Dante Long", "Eliza Patterson", "Finn Hughes",
-    "Gia Flores", "Hank Washington", "Ivy Butler", "Jett Simmons", "Kara Foster", "Luca Gonzales", "Mila Bryant",
-    "Nash Alexander", "Ophelia Russell", "Parker Griffin", "Quinn Diaz", "Remy Hayes", "Sienna Myers", "Tucker Ford",
-    "Uma Chavez", "Violet Murray", "Wes Ortiz", "Xander Vargas", "Yara Simpson", "Zeke Crawford", "Avery Black",
-    "Brielle Holmes", "Cruz Stone", "Dahlia Meyer", "Emmett Boyd", "Freya Mills", "Gunner Warren", "Harlow Fox",
-    "Ira Rose", "Jax Lane", "Kira Rice", "Luca Moreno", "Maren Schmidt", "Nash Patel", "Olive Ferguson", "Peyton Nichols",
-    "Quinn Herrera", "Rory Medina", "Sadie Ryan", "Tobias Fernandez", "Uma Weber", "Vera Castillo", "Wade Harvey",
-    "Xyla Hoffman", "Yara Elliott", "Zeke Cunningham", "Aria Knight", "Brett Bradley", "Clara Carroll", "Dante Hudson",
-    "Eliza Duncan", "Finn Armstrong", "Gia Berry", "Hank Andrews", "Ivy Johnston", "Jett Ray", "Kara Lane"
-]
-
-# Example SMS content for received messages
-RECEIVED_CONTENT = [
-    "Hey, I just wanted to check in and see how you're doing. It's been a while since we last talked.",
-    "I was thinking about our project deadline. Do you think we can meet it? Let's discuss tomorrow.",
-    "Remember that meeting we had last week? I think we should follow up on the action items.",
-    "I saw this interesting article and thought you might find it useful. Here's the link: [link]",
-    "Can you send me the report by EOD? I need to review it before the meeting tomorrow.",
-    "I'm planning a trip next month. Do you have any recommendations for places to visit?",
-    "I just finished reading that book you recommended. It was fantastic! Thanks for the suggestion.",
-    "I'm having some issues with the new software. Can you help me troubleshoot it?",
-    "Let's catch up this weekend. How about we grab a coffee on Saturday?",
-    "I just got a notification that your package has been delivered. Did you receive it?"
-]
-
-# Example SMS content for sent messages (replies)
-SENT_CONTENT = [
-    "Hey! I'm doing well, thanks for checking in. How about you?",
-    "Yes, I think we can meet the deadline. Let's discuss the details tomorrow.",
-    "I agree. I'll send a follow-up email to the team today.",
-    "Thanks for sharing! I'll check it out later.",
-    "Sure, I'll send the report by EOD.",
-    "How about visiting the mountains? I heard it's beautiful this time of year.",
-    "I'm glad you liked it! Let me know if you want more recommendations.",
-    "Sure, I can help. What issues are you facing?",
-    "Sounds great! Let's meet at 10 AM on Saturday.",
-    "Yes, I received it. Thanks for letting me know!"
-]
-
-def generate_sms_data():
+# Append-only store for SMS records (migrated from SMS_FILE on first use)
+sms_store = open_store(SMS_FILE)
+
+# Day or week segments holding the SMS records older than the active window
+sms_archive = SegmentArchive(sms_store, "type")
+
+# Request timers and store gauges, exposed on /metrics
+instrument(app, [sms_store])
+
+# Per-sender last-seen times and type counts, kept up to date on every collect
+sms_index = sms_store.subscribe(SenderIndex("type", sms_archive))
+
+# Time-ordered index used to filter and paginate retrieval
+sms_times = sms_store.subscribe(TimeIndex("type"))
+
+# Staleness alerts pushed to subscribers as senders go quiet
+sms_alerts = sms_store.subscribe(StalenessMonitor("sms", sms_index, STALE_AFTER_DAYS, STALE_INSIGHT, sms_store))
+
+# Full-text index of SMS content, kept on disk next to the store
+sms_search = sms_store.subscribe(SearchIndex(sms_store, ["content"]))
+
+# Conversation threads, pairing received messages with their replies
+sms_threads = sms_store.subscribe(ThreadIndex("type"))
+
+# Hourly and daily SMS counts and reply latencies per sender, for the analytics endpoint
+sms_rollups = sms_store.subscribe(RollupIndex("type", sms_threads))
+
+# Hashes of the stored and archived SMS, so that retried syncs are not stored twice
+sms_dedup = sms_store.subscribe(DedupIndex(sms_store, DEDUP_FIELDS[SMS_FILE], sms_archive))
+
+def generate_sms_conversation(current_time):
+    """
+    Function to generate one two-way SMS conversation: a received message and its reply.
+    """
+    records = []
+
+    # Randomly select a sender
+    sender = random.choice(NAMES)
+
+    # Generate a random datetime within the last 7 days for the first message
+    first_message_time = current_time - timedelta(
+        days=random.randint(0, 7),
+        hours=random.randint(0, 23),
+        minutes=random.randint(0, 59),
+        seconds=random.randint(0, 59)
+    )
+
+    # Create the first message (received)
+    records.append({
+        "datetime": first_message_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "sender": sender,
+        "type": "received",
+        "content": random.choice(RECEIVED_CONTENT)
+    })
+
+    # Generate a reply (sent) within a few minutes to an hour
+    reply_time = first_message_time + timedelta(
+        minutes=random.randint(1, 60),
+        seconds=random.randint(0, 59)
+    )
+
+    # Create the reply message (sent)
+    records.append({
+        "datetime": reply_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "sender": "Me",  # The user is the sender of the reply
+        "type": "sent",
+        "content": random.choice(SENT_CONTENT)
+    })
+
+    return records
+
+def generate_sms_data(conversations=250):
     """
     Function to generate pre-defined SMS data with two-way conversations and save it to the file.
     """
     sms_data = []
     current_time = datetime.now()
 
-    for _ in range(250):  # Generate 250 conversations (500 messages in total)
-        # Randomly select a sender
-        sender = random.choice(NAMES)
-
-        # Generate a random datetime within the last 7 days for the first message
-        first_message_time = current_time - timedelta(
-            days=random.randint(0, 7),
-            hours=random.randint(0, 23),
-            minutes=random.randint(0, 59),
-            seconds=random.randint(0, 59)
-        )
-
-        # Create the first message (received)
-        sms_data.append({
-            "datetime": first_message_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "sender": sender,
-            "type": "received",
-            "content": random.choice(RECEIVED_CONTENT)
-        })
-
-        # Generate a reply (sent) within a few minutes to an hour
-        reply_time = first_message_time + timedelta(
-            minutes=random.randint(1, 60),
-            seconds=random.randint(0, 59)
-        )
-
-        # Create the reply message (sent)
-        sms_data.append({
-            "datetime": reply_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "sender": "Me",  # The user is the sender of the reply
-            "type": "sent",
-            "content": random.choice(SENT_CONTENT)
-        })
+    for _ in range(conversations):  # Generate 250 conversations by default (500 messages in total)
+        sms_data.extend(generate_sms_conversation(current_time))
 
     # Save the generated data
-    with open(SMS_FILE, "w", encoding="utf-8") as f:
-        json.dump(sms_data, f, indent=4, ensure_ascii=False)
+    sms_store.replace(sms_data)
+
+def validate_sms(data):
+    """
+    Function to validate an SMS record.
+    Returns an error message, or None if the record is valid.
+    """
+    # Validate required fields
+    if not isinstance(data, dict) or not all(key in data for key in ["datetime", "sender", "type", "content"]):
+        return "Missing required fields"
+
+    # Validate field types
+    for key in ["sender", "content"]:
+        if not isinstance(data[key], str):
+            return f"Invalid {key}. Must be a string"
+
+    # Parse datetime
+    try:
+        parse_timestamp(data["datetime"])
+    except (TypeError, ValueError):
+        return "Invalid datetime format. Use 'YYYY-MM-DD HH:MM:SS'"
+
+    return None
 
 @app.route('/collect_sms', methods=['POST'])
 def collect_sms():
@@ -126,83 +154,212 @@ def collect_sms():
         # Get JSON data from the request
         data = request.json
 
-        # Validate required fields
-        if not all(key in data for key in ["datetime", "sender", "type", "content"]):
-            return jsonify({"status": "error", "message": "Missing required fields"}), 400
-
-        # Parse datetime
-        try:
-            datetime.strptime(data["datetime"], "%Y-%m-%d %H:%M:%S")
-        except ValueError:
-            return jsonify({"status": "error", "message": "Invalid datetime format. Use 'YYYY-MM-DD HH:MM:SS'"}), 400
+        # Validate the record
+        with phase("validate"):
+            error = validate_sms(data)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
 
-        # Load existing data
-        with open(SMS_FILE, "r", encoding="utf-8") as f:
-            sms_data = json.load(f)
+        # Append new SMS data, unless it was already collected (e.g. by a retried sync)
+        if sms_dedup.extend([data]):
+            return jsonify({"status": "success", "message": "SMS data already collected", "duplicate": True}), 200
 
-        # Append new SMS data
-        sms_data.append(data)
+        return jsonify({"status": "success", "message": "SMS data collected successfully"}), 200
 
-        # Save updated data
-        with open(SMS_FILE, "w", encoding="utf-8") as f:
-            json.dump(sms_data, f, indent=4, ensure_ascii=False)
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        return jsonify({"status": "success", "message": "SMS data collected successfully"}), 200
+@app.route('/collect_sms_batch', methods=['POST'])
+def collect_sms_batch():
+    """
+    Endpoint to collect many SMS records at once.
+    Accepts a JSON array of SMS records, or NDJSON (one record per line)
+    with Content-Type: application/x-ndjson. Each record is validated like
+    /collect_sms, and the accepted records are stored in one write. Records
+    already stored are counted as duplicates and not written again.
+    """
+    try:
+        entries = read_batch(request)
+    except PayloadError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
 
+    try:
+        return jsonify(collect_batch(sms_store, entries, validate_sms, sms_dedup)), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/get_sms_data', methods=['GET'])
+@cached([sms_store])
 def get_sms_data():
     """
-    Endpoint to retrieve all collected SMS data.
+    Endpoint to retrieve collected SMS data.
+    Optional query parameters:
+        sender=Sender Name
+        type=received/sent
+        start=YYYY-MM-DD HH:MM:SS, end=YYYY-MM-DD HH:MM:SS (inclusive range)
+        limit=N and cursor=<next_cursor from the previous page>
+        format=ndjson to stream the records as NDJSON
     """
     try:
-        with open(SMS_FILE, "r", encoding="utf-8") as f:
-            sms_data = json.load(f)
-        return jsonify({"status": "success", "data": sms_data}), 200
+        return get_records(sms_store, sms_times, request.args, "type", sms_archive), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/analyze_sms', methods=['GET'])
+@cached([sms_store], expires=staleness_expiry(sms_index, STALE_AFTER_DAYS))
 def analyze_sms():
     """
     Endpoint to analyze SMS data and provide insights.
+    Optional query parameter: days=N, the number of days without an SMS before
+    a sender is reported (defaults to STALE_AFTER_DAYS). With keys=1, the
+    sender of every insight and the cutoff time are included too.
     """
     try:
-        with open(SMS_FILE, "r", encoding="utf-8") as f:
-            sms_data = json.load(f)
+        days = parse_days(request.args, STALE_AFTER_DAYS)
 
         # Get the current time
         current_time = datetime.now()
 
-        # Dictionary to store the last SMS time for each sender
-        last_sms_times = {}
+        # Generate insights for senders with no SMS in the last N days
+        cutoff = to_epoch(current_time - timedelta(days=days))
+        senders = sms_index.stale_senders(cutoff)
+        insights = []
+        for sender in senders:
+            insights.append(STALE_INSIGHT.format(sender=sender))
 
-        # Analyze SMS data
-        for sms in sms_data:
-            sender = sms["sender"]
-            sms_time = datetime.strptime(sms["datetime"], "%Y-%m-%d %H:%M:%S")
+        # Name the sender of every insight for the shard router, which merges them
+        response = {"status": "success", "insights": insights}
+        if request.args.get("keys") == "1":
+            response.update({"senders": senders, "cutoff": format_timestamp(cutoff)})
+        return jsonify(response), 200
 
-            # Update the last SMS time for the sender
-            if sender not in last_sms_times or sms_time > last_sms_times[sender]:
-                last_sms_times[sender] = sms_time
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        # Generate insights
-        insights = []
-        for sender, last_sms in last_sms_times.items():
-            time_since_last_sms = current_time - last_sms
-            if time_since_last_sms > timedelta(days=7):  # If no SMS in the last 7 days
-                insights.append(f"{sender} hasn't texted in a while. Check on them!")
+@app.route('/search_sms', methods=['GET'])
+@cached([sms_store])
+def search_sms():
+    """
+    Endpoint to search SMS content, best match first.
+    Query parameters:
+        q=words to find: word, prefix* or "exact phrase" (all must match)
+    Optional query parameters:
+        sender=Sender Name
+        start=YYYY-MM-DD HH:MM:SS, end=YYYY-MM-DD HH:MM:SS (inclusive range)
+        limit=N and cursor=<next_cursor from the previous page>
+    """
+    try:
+        return search_records(sms_search, request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        return jsonify({"status": "success", "insights": insights}), 200
+@app.route('/sms_threads', methods=['GET'])
+@cached([sms_store])
+def get_sms_threads():
+    """
+    Endpoint to list SMS conversation threads, newest first.
+    Optional query parameters:
+        thread=<thread_id> to get one thread and its records
+        sender=Sender Name
+        limit=N (default 100) and cursor=<next_cursor from the previous page>
+    """
+    try:
+        return get_threads(sms_store, sms_threads, request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/sms_reply_times', methods=['GET'])
+@cached([sms_store])
+def get_sms_reply_times():
+    """
+    Endpoint to get reply latency statistics per contact, in seconds.
+    Optional query parameter: sender=Sender Name
+    """
+    try:
+        return get_reply_times(sms_threads, request.args), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@shard_api.route('/sms_reply_parents', methods=['POST'])
+def get_sms_reply_parents():
+    """
+    Endpoint to find the threads sent SMS records would reply to, without storing them.
+    Used by the shard router to store replies with the thread they answer.
+    Expects a JSON array of sent SMS records, and returns whether each is stored
+    already, and the threads waiting for a reply, most recently waiting first.
+    """
+    try:
+        records = request.get_json(silent=True)
+        stored = sms_dedup.contains(records) if isinstance(records, list) else []
+        return get_reply_parents(sms_threads, records, stored), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/sms_unanswered', methods=['GET'])
+@cached([sms_store])
+def get_sms_unanswered():
+    """
+    Endpoint to list received SMS still waiting for a reply, oldest first.
+    Optional query parameters:
+        sender=Sender Name
+        limit=N (default 100) and cursor=<next_cursor from the previous page>
+    """
+    try:
+        return get_unanswered(sms_store, sms_threads, request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/sms_alerts', methods=['GET'])
+def get_sms_alerts():
+    """
+    Endpoint to long-poll staleness alerts, fired as SMS senders go quiet.
+    Optional query parameters:
+        after=<last_id from the previous response>
+        timeout=N seconds to wait for a new alert (up to 60)
+    """
+    try:
+        return poll_alerts("sms", request.args), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/sms_alerts/stream', methods=['GET'])
+def stream_sms_alerts():
+    """
+    Endpoint to subscribe to SMS staleness alerts as server-sent events.
+    Optional query parameter: after=<id of the last alert received>; reconnecting
+    clients resume from their Last-Event-ID header.
+    """
+    try:
+        return stream_alerts("sms", request.args, request.headers.get("Last-Event-ID")), 200
+    except QueryError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 if __name__ == '__main__':
-    # Generate the SMS data once at the start
-    generate_sms_data()
+    if DEBUG and not is_running_from_reloader():
+        # The reloader's child process serves the app, so it writes the store
+        sms_store.close()
+    else:
+        # Generate the SMS data once at the start
+        generate_sms_data()
+
+        # Move records older than the active window into segments, now and periodically
+        sms_archive.start_maintenance()
 
     # Run the Flask app
-    app.run(debug=True)
+    app.run(debug=DEBUG)
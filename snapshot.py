@@ -0,0 +1,332 @@
+"""
+Columnar snapshot format for record stores.
+
+A snapshot holds every record of a store up to its last compaction in a
+single memory-mapped file: datetimes as an int64 array of epoch seconds, and
+every other field dictionary-encoded as an array of small integer codes into
+a table of distinct values (senders, types, subjects, bodies, ...). Loading
+a snapshot only maps the file, so stores open almost instantly, and indexes
+can be rebuilt from the columns with NumPy instead of per-record dicts.
+
+Layout (see write_arrays): MAGIC, an 8-byte little-endian header length, a
+JSON header (record count, fields, array offsets and the part of the log
+already folded in), then the 64-byte aligned arrays. Each dictionary is kept
+out of the header as two arrays, its values' UTF-8 bytes end to end and
+their offsets, so a high-cardinality field such as a message body costs no
+more than storing it raw and is only decoded for the records read.
+
+Compact existing stores from the command line:
+    python snapshot.py call_log_data.json sms_data.json email_data.json
+"""
+from array import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from index import MISSING_TIME, format_timestamp, parse_timestamp
+
+MAGIC = b"CSNAP003"
+
+# Earlier format, with the dictionaries in the JSON header; still read
+LEGACY_MAGIC = b"CSNAP002"
+
+# Dictionaries up to this many values are decoded whole on first use
+DECODE_ALL_LIMIT = 65536
+
+# Byte alignment of column arrays in the file
+ALIGNMENT = 64
+
+
+def available():
+    """
+    Function to check whether snapshots can be used (they need NumPy).
+    """
+    return np is not None
+
+
+def file_digest(path, length):
+    """
+    Function to hash the first length bytes of a file.
+    """
+    digest = hashlib.sha1()
+    remaining = length
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def _value_key(value):
+    """
+    Function to get a hashable key for interning a field value.
+    """
+    if isinstance(value, str):
+        return value
+    return "\0json:" + json.dumps(value, sort_keys=True)
+
+
+def _key_value(key):
+    """
+    Function to get the field value back from its _value_key.
+    """
+    if key.startswith("\0json:"):
+        return json.loads(key[6:])
+    return key
+
+
+def _encode_keys(keys):
+    """
+    Function to pack dictionary keys into a byte array and an array of offsets into it.
+    """
+    encoded = [key.encode("utf-8") for key in keys]
+    offsets = np.zeros(len(encoded) + 1, np.int64)
+    if encoded:
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), np.uint8), offsets
+
+
+class Dictionary:
+    """
+    Distinct values of a column, read from the mapped file.
+    Small dictionaries are decoded whole on first use, larger ones one value at a time.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self._values = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def key(self, code):
+        """
+        Function to get the _value_key of a value without decoding it further.
+        """
+        return self.data[int(self.offsets[code]):int(self.offsets[code + 1])].tobytes().decode("utf-8")
+
+    def keys(self):
+        return (self.key(code) for code in range(len(self)))
+
+    def __getitem__(self, code):
+        if self._values is None and len(self) <= DECODE_ALL_LIMIT:
+            self._values = [_key_value(key) for key in self.keys()]
+        if self._values is not None:
+            return self._values[code]
+        return _key_value(self.key(code))
+
+    def __iter__(self):
+        for code in range(len(self)):
+            yield self[code]
+
+
+def _code_dtype(size):
+    """
+    Function to pick the smallest signed integer type for a dictionary size (-1 means absent).
+    """
+    if size < 2 ** 7:
+        return np.int8
+    if size < 2 ** 15:
+        return np.int16
+    return np.int32
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_arrays(path, magic, header, arrays):
+    """
+    Function to write a JSON header and named NumPy arrays as one memory-mappable file.
+    The file is fsync'd before returning.
+    """
+    specs = {}
+    offset = 0
+    for name, data in arrays.items():
+        specs[name] = {"dtype": data.dtype.str, "offset": offset, "length": len(data)}
+        offset = _align(offset + data.nbytes)
+
+    header = json.dumps(dict(header, arrays=specs), ensure_ascii=False).encode("utf-8")
+    header_start = len(magic) + 8
+    data_start = _align(header_start + len(header))
+
+    with open(path, "wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, data in arrays.items():
+            f.seek(data_start + specs[name]["offset"])
+            f.write(data.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def map_arrays(path, magic):
+    """
+    Function to map a file written by write_arrays.
+    Returns the header and the arrays, which are backed directly by the mapped file.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapped[:len(magic)] != magic:
+        raise ValueError(f"{path} is not a {magic.decode()} file")
+    header_start = len(magic) + 8
+    (header_length,) = struct.unpack("<Q", mapped[len(magic):header_start])
+    header = json.loads(mapped[header_start:header_start + header_length])
+    data_start = _align(header_start + header_length)
+
+    arrays = {}
+    for name, spec in header.pop("arrays").items():
+        if spec["length"]:
+            arrays[name] = np.frombuffer(mapped, dtype=spec["dtype"], count=spec["length"], offset=data_start + spec["offset"])
+        else:
+            arrays[name] = np.empty(0, spec["dtype"])
+    return header, arrays
+
+
+class Snapshot:
+    """
+    Read-only view of a snapshot file.
+    Columns are NumPy arrays backed directly by the memory-mapped file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            legacy = f.read(len(LEGACY_MAGIC)) == LEGACY_MAGIC
+        header, arrays = map_arrays(path, LEGACY_MAGIC if legacy else MAGIC)
+        self.count = header["count"]
+        self.fields = header["fields"]
+        if legacy:
+            self.dictionaries = header["dictionaries"]
+        else:
+            self.dictionaries = {
+                field: Dictionary(arrays[f"dictionaries/{field}/data"], arrays[f"dictionaries/{field}/offsets"])
+                for field in self.fields
+            }
+        self.log_offset = header["log_offset"]
+        self.log_digest = header["log_digest"]
+        self.timestamps = arrays["timestamps"]
+        self.columns = {field: arrays["columns/" + field] for field in self.fields}
+
+    def __len__(self):
+        return self.count
+
+    def record(self, seq):
+        """
+        Function to decode one record.
+        """
+        record = {}
+        timestamp = int(self.timestamps[seq])
+        for field in self.fields:
+            if field == "datetime" and timestamp != MISSING_TIME:
+                record["datetime"] = format_timestamp(timestamp)
+                continue
+            code = int(self.columns[field][seq])
+            if code >= 0:
+                record[field] = self.dictionaries[field][code]
+        return record
+
+    def __iter__(self):
+        for seq in range(self.count):
+            yield self.record(seq)
+
+
+def write_snapshot(path, records, base=None, log_offset=0, log_digest=None):
+    """
+    Function to write a snapshot of base (an existing Snapshot, or None) followed by records.
+    Dictionaries only grow, so the base columns are copied without re-encoding.
+    The file is fsync'd before returning.
+    """
+    fields = list(base.fields) if base is not None else ["datetime"]
+    if base is None:
+        keys = {"datetime": []}
+    elif isinstance(base.dictionaries[fields[0]], Dictionary):
+        keys = {field: list(base.dictionaries[field].keys()) for field in fields}
+    else:
+        keys = {field: [_value_key(value) for value in base.dictionaries[field]] for field in fields}
+    lookup = {field: {key: code for code, key in enumerate(values)} for field, values in keys.items()}
+    base_count = len(base) if base is not None else 0
+
+    # Encode the new records
+    timestamps = array("q")
+    codes = {field: array("i") for field in fields}
+    count = 0
+    for record in records:
+        # Keep the datetime as epoch seconds when it round-trips exactly
+        value = record.get("datetime")
+        timestamp = MISSING_TIME
+        if isinstance(value, str):
+            try:
+                parsed = parse_timestamp(value)
+                if format_timestamp(parsed) == value:
+                    timestamp = parsed
+            except ValueError:
+                pass
+        timestamps.append(timestamp)
+
+        # Add columns for fields not seen before
+        for field in record:
+            if field not in codes:
+                fields.append(field)
+                keys[field] = []
+                lookup[field] = {}
+                codes[field] = array("i", [-1]) * count
+
+        for field in fields:
+            if field not in record or (field == "datetime" and timestamp != MISSING_TIME):
+                codes[field].append(-1)
+                continue
+            key = _value_key(record[field])
+            code = lookup[field].get(key)
+            if code is None:
+                code = lookup[field][key] = len(keys[field])
+                keys[field].append(key)
+            codes[field].append(code)
+        count += 1
+
+    # Join the base columns and the new ones
+    arrays = {"timestamps": np.frombuffer(timestamps, dtype=np.int64) if count else np.empty(0, np.int64)}
+    if base is not None:
+        arrays["timestamps"] = np.concatenate([base.timestamps, arrays["timestamps"]])
+    for field in fields:
+        dtype = _code_dtype(len(keys[field]))
+        new = np.frombuffer(codes[field], dtype=np.int32) if count else np.empty(0, np.int32)
+        if base is None:
+            old = np.empty(0, np.int32)
+        elif field in base.columns:
+            old = base.columns[field]
+        else:
+            old = np.full(base_count, -1, np.int32)
+        arrays["columns/" + field] = np.concatenate([old.astype(dtype), new.astype(dtype)])
+        arrays[f"dictionaries/{field}/data"], arrays[f"dictionaries/{field}/offsets"] = _encode_keys(keys[field])
+
+    header = {
+        "count": base_count + count,
+        "fields": fields,
+        "log_offset": log_offset,
+        "log_digest": log_digest
+    }
+    write_arrays(path, MAGIC, header, arrays)
+
+
+if __name__ == '__main__':
+    from storage import open_store
+
+    for legacy_path in sys.argv[1:]:
+        store = open_store(legacy_path)
+        store.compact()
+        print(f"Compacted {len(store)} records into {store.snapshot_path}")
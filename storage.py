@@ -0,0 +1,754 @@
+from array import array
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from metrics import count_records, phase, timed_lock
+from snapshot import Snapshot, available as snapshots_available, file_digest, write_snapshot
+
+# Number of appends between automatic compactions of the log
+COMPACT_EVERY = 10000
+
+# Time the writer waits for more records before committing a batch (seconds)
+COMMIT_DELAY = 0.002
+
+# Stores opened in this process, keyed by log path
+_stores = {}
+_stores_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def encode_record(record):
+    """
+    Function to serialize a record as a single compact JSON line.
+    """
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def temp_path(path):
+    """
+    Function to get a temporary file name for writing path, unique to the
+    calling process and thread, so concurrent writers never share one.
+    """
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def lock_owner(path):
+    """
+    Function to take an exclusive lock on path, held until the process exits,
+    so that only one process writes the files it guards. Returns the open lock
+    file, or None if another process holds the lock.
+    """
+    f = open(path, "a+b")
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class StoreLockedError(RuntimeError):
+    """
+    Raised when writing to a store whose log is written by another process.
+    """
+
+
+def open_store(legacy_path, **kwargs):
+    """
+    Function to get the shared store for a data file.
+    Every thread in the process submits records to the same writer.
+    """
+    path = os.path.abspath(legacy_path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = RecordStore(legacy_path, **kwargs)
+        return _stores[path]
+
+
+def _file_id(path):
+    """
+    Function to identify the current version of a file, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class _Commit:
+    """
+    Records submitted by one caller, waiting to be made durable.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.lines = [encode_record(record).encode("utf-8") for record in records]
+        self.count = len(records)
+        self.submitted = time.monotonic()
+        self.done = threading.Event()
+        self.error = None
+
+
+class RecordStore:
+    """
+    Append-only store for collected records.
+
+    Records are kept one per line (JSON Lines) next to the legacy JSON file,
+    e.g. "sms_data.json" is stored as "sms_data.jsonl". Appending a record
+    writes a single line instead of rewriting the whole file. The legacy JSON
+    array is migrated into the log the first time the store is opened.
+
+    All appends go through a single writer thread. Records submitted within
+    COMMIT_DELAY of each other are written and fsync'd together (group commit),
+    and callers return once their records are on disk. Whole-file rewrites
+    (migration, replace, compaction) go through a temporary file and a rename,
+    and a partially written last line left by a crash is dropped on open.
+
+    In-memory indexes can subscribe to the store; they are rebuilt from the
+    log once and then updated with every committed batch. A batch counts as
+    committed once it is on disk: an index that fails to take it is logged and
+    rebuilt, without failing the callers or holding back the other indexes.
+    Records are numbered
+    in log order, and the byte offset of each one is kept so that indexes can
+    fetch individual records with read_records() instead of loading the log.
+
+    When NumPy is available, compaction folds the log into a columnar
+    snapshot ("sms_data.snapshot", see snapshot.py) and starts an empty log.
+    Records are then numbered snapshot first, log second. The snapshot notes
+    how much of the log it already holds, so a crash between writing it and
+    emptying the log does not duplicate records. Indexes that provide
+    rebuild_snapshot(snapshot) are built from its columns directly.
+
+    The store's generation ("sms_data.generation") changes whenever records
+    are replaced rather than appended, so indexes saved on disk can tell
+    whether the records they cover are still the same.
+
+    Only one process writes a log: the first to open it takes "sms_data.lock"
+    until it exits or calls close(). A store opened by any other process (e.g.
+    contacts.py next to the collectors) is read-only: it follows the log with
+    refresh(), and writing to it raises StoreLockedError.
+    """
+
+    def __init__(self, legacy_path, compact_every=COMPACT_EVERY, commit_delay=COMMIT_DELAY, snapshots=True):
+        self.legacy_path = legacy_path
+        self.path = os.path.splitext(legacy_path)[0] + ".jsonl"
+        self.snapshot_path = os.path.splitext(legacy_path)[0] + ".snapshot"
+        self.generation_path = os.path.splitext(legacy_path)[0] + ".generation"
+        self.lock_path = os.path.splitext(legacy_path)[0] + ".lock"
+        self.name = os.path.basename(self.path)
+        self.compact_every = compact_every
+        self.commit_delay = commit_delay
+        self.use_snapshots = snapshots and snapshots_available()
+
+        # Number of appends since the log was last compacted
+        self.appends_since_compact = 0
+
+        # Bumped whenever the stored records change; the token tells store instances apart
+        self._token = uuid.uuid4().hex[:12]
+        self._version = 0
+
+        # Guards the log file against concurrent writes and rewrites; re-entrant
+        # so that listeners can read records while they are being updated
+        self._lock = threading.RLock()
+
+        # Indexes kept up to date with committed records, and those to rebuild after failing an update
+        self._listeners = []
+        self._failed_listeners = []
+
+        # Snapshot of the compacted records, if any, and where the log continues from
+        self.snapshot = None
+        self._snapshot_id = None
+        self._base = 0
+        self._log_start = 0
+
+        # Byte offset of every record in the log, and the log size
+        self._offsets = array("q")
+        self._size = 0
+
+        # Commits waiting for the writer thread
+        self._pending = []
+        self._pending_cond = threading.Condition()
+
+        # Writer counters
+        self._started = time.monotonic()
+        self._records_committed = 0
+        self._commits = 0
+        self._batches = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._last_error = None
+
+        # Take the log if no other process writes it; otherwise only read it
+        self._owner = lock_owner(self.lock_path)
+        self.read_only = self._owner is None
+        self._file = None
+
+        # Migrate the legacy JSON array on first use
+        self.generation = None
+        if self.read_only:
+            self._read_generation()
+        elif not os.path.exists(self.path):
+            self._new_generation()
+            if self.use_snapshots and os.path.exists(self.snapshot_path):
+                self._rewrite([])
+            else:
+                self._migrate()
+        else:
+            self._recover()
+            self._read_generation()
+        self._load()
+        if self.read_only:
+            return
+
+        self._file = open(self.path, "ab")
+
+        # Start the writer thread
+        self._writer = threading.Thread(target=self._run_writer, name=f"writer:{self.path}")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _check_writable(self):
+        """
+        Function to fail fast when another process writes the log.
+        """
+        if self.read_only:
+            raise StoreLockedError(f"{self.path} is written by another process; it can only be read here")
+
+    def _migrate(self):
+        """
+        Function to convert the legacy JSON array file into the log format.
+        """
+        records = []
+        if os.path.exists(self.legacy_path):
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        self._rewrite(records)
+
+    def _new_generation(self):
+        """
+        Function to start a new generation, before the records are replaced.
+        """
+        self.generation = uuid.uuid4().hex
+        tmp_path = temp_path(self.generation_path)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.generation_path)
+
+    def _read_generation(self):
+        """
+        Function to read the current generation, starting one if there is none.
+        """
+        try:
+            with open(self.generation_path, "r", encoding="utf-8") as f:
+                self.generation = f.read().strip()
+        except FileNotFoundError:
+            self.generation = None
+        if not self.generation and not self.read_only:
+            self._new_generation()
+
+    def _load(self):
+        """
+        Function to open the snapshot, if any, and index the log records after it.
+        """
+        self.snapshot = None
+        self._snapshot_id = None
+        self._log_start = 0
+        if self.use_snapshots and os.path.exists(self.snapshot_path):
+            self.snapshot = Snapshot(self.snapshot_path)
+            self._snapshot_id = _file_id(self.snapshot_path)
+
+            # Skip the part of the log already folded into the snapshot
+            covered = self.snapshot.log_offset
+            if covered and os.path.getsize(self.path) >= covered \
+                    and file_digest(self.path, covered) == self.snapshot.log_digest:
+                self._log_start = covered
+
+        self._base = len(self.snapshot) if self.snapshot is not None else 0
+        self._offsets = array("q")
+        self._size = self._log_start
+        self._log_inode = os.stat(self.path).st_ino if os.path.exists(self.path) else None
+        self._catch_up(collect=False)
+
+    def _recover(self):
+        """
+        Function to drop a partially written last line left by a crash.
+        """
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+
+            # Scan backwards for the end of the last complete line
+            end = size
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                chunk = f.read(end - start)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    f.truncate(start + newline + 1)
+                    return
+                end = start
+            f.truncate(0)
+
+    def _read_lines(self, start=0):
+        """
+        Function to read (offset, line) pairs for the complete lines of the log.
+        """
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            # A read-only store opened before the writer created the log
+            return
+        with f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                # Stop at a line that is still being written
+                if not line.endswith(b"\n"):
+                    return
+                yield offset, line
+                offset += len(line)
+
+    def _scan(self, start=0):
+        """
+        Function to read (offset, record) pairs from the log.
+        """
+        for offset, line in self._read_lines(start):
+            if not line.strip():
+                continue
+            try:
+                yield offset, json.loads(line)
+            except ValueError:
+                # Skip partially written lines
+                continue
+
+    def _catch_up(self, collect=True):
+        """
+        Function to index the records past the known end of the log.
+        Returns the new records when collect is set.
+        """
+        records = []
+        for offset, line in self._read_lines(self._size):
+            self._size = offset + len(line)
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self._offsets.append(offset)
+            if collect:
+                records.append(record)
+        return records
+
+    def _rewrite(self, records):
+        """
+        Function to replace the log contents with the given records.
+        The new log is written to a temporary file and renamed into place.
+        """
+        tmp_path = self.path + ".tmp"
+        offsets = array("q")
+        size = 0
+        with open(tmp_path, "wb") as f:
+            for record in records:
+                line = encode_record(record).encode("utf-8")
+                f.write(line)
+                offsets.append(size)
+                size += len(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._offsets = offsets
+        self._size = size
+
+        # Make the rename itself durable
+        if hasattr(os, "O_DIRECTORY"):
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _write_snapshot(self, records, base):
+        """
+        Function to write base (a snapshot, or None) and records as the new snapshot and empty the log.
+        """
+        tmp_path = self.snapshot_path + ".tmp"
+        write_snapshot(tmp_path, records, base, self._size, file_digest(self.path, self._size))
+        os.replace(tmp_path, self.snapshot_path)
+
+        # The snapshot now holds every record, so start a new log
+        self._file.close()
+        try:
+            self._rewrite([])
+        finally:
+            self._file = open(self.path, "ab")
+        self._load()
+
+    def _rebuild_listener(self, listener):
+        """
+        Function to rebuild an index from the snapshot columns and the log, or from every record.
+        """
+        if self.snapshot is not None and hasattr(listener, "rebuild_snapshot"):
+            listener.rebuild_snapshot(self.snapshot)
+            listener.add([record for _, record in self._scan(self._log_start)])
+        else:
+            listener.rebuild(self)
+
+    def _notify(self, records):
+        """
+        Function to update every index with newly stored records.
+        An index that fails is logged and marked for rebuild; the others are still updated.
+        """
+        for listener in self._listeners:
+            try:
+                listener.add(records)
+            except Exception as e:
+                logger.exception("%s failed to index new records of %s; rebuilding it", type(listener).__name__, self.name)
+                self._last_error = f"{type(listener).__name__}: {e}"
+                if listener not in self._failed_listeners:
+                    self._failed_listeners.append(listener)
+
+    def _rebuild_failed(self):
+        """
+        Function to rebuild the indexes that failed an update. Those that fail
+        again stay marked, and are retried after the next commit.
+        """
+        with self._lock:
+            failed, self._failed_listeners = self._failed_listeners, []
+            for listener in failed:
+                try:
+                    self._rebuild_listener(listener)
+                except Exception:
+                    logger.exception("%s failed to rebuild from %s", type(listener).__name__, self.name)
+                    self._failed_listeners.append(listener)
+            if failed:
+                self._version += 1
+
+    def _run_writer(self):
+        """
+        Function run by the writer thread to commit pending records in batches.
+        """
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+
+            # Give concurrent callers a moment to join this batch
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+
+            with self._pending_cond:
+                batch, self._pending = self._pending, []
+            self._commit(batch)
+
+    def _commit(self, batch):
+        """
+        Function to write a batch of commits with a single write and fsync.
+        The commits succeed once the fsync is done, whatever the indexes do.
+        """
+        count = sum(commit.count for commit in batch)
+        error = None
+        with timed_lock(self._lock, self.name, "commit"):
+            try:
+                lines = [line for commit in batch for line in commit.lines]
+                self._file.write(b"".join(lines))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self.appends_since_compact += count
+
+                # Record where each new line starts
+                for line in lines:
+                    self._offsets.append(self._size)
+                    self._size += len(line)
+            except Exception as e:
+                error = e
+                self._last_error = str(e)
+
+            # Update indexes before callers see their commit succeed, rebuilding any that fail
+            if error is None:
+                self._notify([record for commit in batch for record in commit.records])
+                self._version += 1
+                if self._failed_listeners:
+                    self._rebuild_failed()
+
+        # Update counters and release the waiting callers
+        now = time.monotonic()
+        for commit in batch:
+            latency = now - commit.submitted
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+            commit.error = error
+            commit.done.set()
+        self._batches += 1
+        self._commits += len(batch)
+        if error is None:
+            self._records_committed += count
+
+        # Compact the log periodically
+        if self.compact_every and self.appends_since_compact >= self.compact_every:
+            try:
+                self.compact()
+            except Exception as e:
+                self._last_error = str(e)
+
+    def subscribe(self, listener):
+        """
+        Function to keep an index up to date with the stored records.
+        The listener must provide rebuild(records) and add(records).
+        """
+        with self._lock:
+            self._rebuild_listener(listener)
+            self._listeners.append(listener)
+        return listener
+
+    def append(self, record):
+        """
+        Function to append a single record to the log.
+        """
+        self.extend([record])
+
+    def extend(self, records):
+        """
+        Function to append several records to the log.
+        Blocks until the records have been committed to disk.
+        """
+        self._check_writable()
+        with phase("storage_write"):
+            commit = _Commit(records)
+            with self._pending_cond:
+                self._pending.append(commit)
+                self._pending_cond.notify()
+            commit.done.wait()
+        count_records("write", commit.count)
+        if commit.error is not None:
+            raise commit.error
+
+    def __iter__(self):
+        snapshot, start = self.snapshot, self._log_start
+        if snapshot is not None:
+            yield from snapshot
+        for _, record in self._scan(start):
+            yield record
+
+    def __len__(self):
+        return self._base + len(self._offsets)
+
+    def _locate(self, seqs):
+        """
+        Function to open the log and find the given records in the snapshot or the log.
+        Returns the log file, the snapshot and (record number, log offset) pairs, with
+        None as the offset of snapshot records.
+        """
+        with timed_lock(self._lock, self.name, "read"):
+            f = open(self.path, "rb")
+            base = self._base
+            locations = [(seq, self._offsets[seq - base] if seq >= base else None) for seq in seqs]
+            return f, self.snapshot, locations
+
+    def read_lines(self, seqs):
+        """
+        Function to read the raw JSON lines of the given record numbers.
+        """
+        f, snapshot, locations = self._locate(seqs)
+        with f:
+            for seq, offset in locations:
+                if offset is None:
+                    yield encode_record(snapshot.record(seq)).encode("utf-8")
+                else:
+                    f.seek(offset)
+                    yield f.readline()
+
+    def read_records(self, seqs):
+        """
+        Function to load the records with the given record numbers.
+        """
+        with phase("storage_read"):
+            f, snapshot, locations = self._locate(seqs)
+            records = []
+            with f:
+                for seq, offset in locations:
+                    if offset is None:
+                        records.append(snapshot.record(seq))
+                    else:
+                        f.seek(offset)
+                        records.append(json.loads(f.readline()))
+        count_records("read", len(records))
+        return records
+
+    def read_all(self):
+        """
+        Function to load every record in the log.
+        """
+        return list(self)
+
+    def replace(self, records):
+        """
+        Function to replace all stored records, e.g. with freshly generated data.
+        records can be any iterable, so large datasets can be streamed in.
+        """
+        self._check_writable()
+        with self._lock:
+            self._new_generation()
+            if self.use_snapshots:
+                self._write_snapshot(records, None)
+            else:
+                self._file.close()
+                try:
+                    self._rewrite(records)
+                finally:
+                    self._file = open(self.path, "ab")
+            self.appends_since_compact = 0
+
+            # Rebuild indexes from the new contents
+            self._failed_listeners = []
+            for listener in self._listeners:
+                self._rebuild_listener(listener)
+            self._version += 1
+
+    def evict(self, predicate, sink):
+        """
+        Function to move the records matching predicate out of the store.
+        sink(records) receives them first (e.g. to archive them), then the store
+        keeps only the other records. The lock is held throughout, so no commit
+        is lost in between. Returns the number of records moved.
+        """
+        self._check_writable()
+        with self._lock:
+            moved = [record for record in self if predicate(record)]
+            if not moved:
+                return 0
+            sink(moved)
+            kept = (record for record in self if not predicate(record))
+
+            # Without a snapshot the log is rewritten in place, so read it all first
+            self.replace(kept if self.use_snapshots else list(kept))
+            return len(moved)
+
+    def reindex(self):
+        """
+        Function to rebuild every index, e.g. after data they combine with the records changed.
+        """
+        with self._lock:
+            self._failed_listeners = []
+            for listener in self._listeners:
+                self._rebuild_listener(listener)
+            self._version += 1
+
+    def compact(self):
+        """
+        Function to fold the log into the snapshot, or to rewrite the log
+        without blank and partially written lines when snapshots are off.
+        Record numbers do not change, so indexes stay valid.
+        """
+        self._check_writable()
+        with self._lock:
+            if self.use_snapshots:
+                records = [record for _, record in self._scan(self._log_start)]
+                self._write_snapshot(records, self.snapshot)
+            else:
+                records = self.read_all()
+                self._file.close()
+                try:
+                    self._rewrite(records)
+                finally:
+                    self._file = open(self.path, "ab")
+            self.appends_since_compact = 0
+
+    def refresh(self):
+        """
+        Function to pick up records written to the log by another process.
+        Only the new part of the log is read, unless the log was rewritten.
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            inode = os.fstat(self._file.fileno()).st_ino if self._file is not None else self._log_inode
+            if stat.st_ino != inode or stat.st_size < self._size \
+                    or (self.use_snapshots and _file_id(self.snapshot_path) != self._snapshot_id):
+                # The log was replaced or compacted: load it again
+                if self._file is not None:
+                    self._file.close()
+                self._read_generation()
+                self._load()
+                if not self.read_only:
+                    self._file = open(self.path, "ab")
+                self._failed_listeners = []
+                for listener in self._listeners:
+                    self._rebuild_listener(listener)
+                self._version += 1
+            elif stat.st_size > self._size:
+                records = self._catch_up()
+                if records:
+                    self._notify(records)
+                    self._version += 1
+            if self._failed_listeners:
+                self._rebuild_failed()
+
+    def close(self):
+        """
+        Function to stop writing the log, once no records are being stored, so
+        that another process can take it. The store stays readable, and listeners
+        holding files of their own are closed too.
+        """
+        with self._lock:
+            if self._owner is not None:
+                self._file.close()
+                self._file = None
+                self._owner.close()
+                self._owner = None
+            self.read_only = True
+            for listener in self._listeners:
+                if hasattr(listener, "close"):
+                    listener.close()
+        with _stores_lock:
+            path = os.path.abspath(self.legacy_path)
+            if _stores.get(path) is self:
+                del _stores[path]
+
+    @property
+    def version(self):
+        """
+        Identifier of the current contents of the store, changed by every commit.
+        """
+        return f"{self._token}.{self._version}"
+
+    def stats(self):
+        """
+        Function to report writer throughput and latency counters.
+        """
+        elapsed = time.monotonic() - self._started
+        return {
+            "records_committed": self._records_committed,
+            "commits": self._commits,
+            "batches": self._batches,
+            "pending": len(self._pending),
+            "snapshot_records": self._base,
+            "avg_batch_size": self._commits / self._batches if self._batches else 0.0,
+            "records_per_second": self._records_committed / elapsed if elapsed else 0.0,
+            "avg_commit_latency_ms": 1000 * self._latency_total / self._commits if self._commits else 0.0,
+            "max_commit_latency_ms": 1000 * self._latency_max,
+            "last_error": self._last_error,
+        }
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+
+import pytest
+
+# The services are flat modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def collectors(tmp_path_factory):
+    """
+    The collector modules, with their stores opened in a temporary directory
+    that stays the working directory until the session ends.
+    """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("collectors"))
+    try:
+        import call
+        import email_log
+        import sms
+
+        yield {"call": call, "sms": sms, "email": email_log}
+    finally:
+        os.chdir(cwd)
+
+
+class RecordFactory:
+    """
+    Builder of test records. Record i is received from "Contact {i % senders}"
+    with content "message {i}"; the options vary what the tests look at:
+
+    times       "calendar": 2024-01-{1 + i % 28} at hour i % 24
+                "daily": one a day, going back from now
+                "spread": distinct random hours within count * 30 hours before now
+                "recent": random minutes within 20 days before now
+                "clustered": five days of four hours, so times repeat
+    senders     a count, or names to pick from at random
+    types       the record type, or types to pick from at random
+    replies     answer about 70% of the records from "Me" minutes to hours later
+    subjects    give records a "Topic {i % 4}" subject, and replies a "Re: " one
+    """
+
+    # Time the generated records lead up to
+    now = datetime(2024, 6, 1)
+
+    def __call__(self, count, start=0, times="calendar", senders=7, types="received", type_field="type",
+                 content="message {i}", replies=False, subjects=False):
+        rng = random.Random(0)
+        hours = rng.sample(range(count * 30), count) if times == "spread" else None
+        records = []
+        for i in range(start, start + count):
+            if times == "calendar":
+                when = datetime(2024, 1, 1 + i % 28, i % 24)
+            elif times == "daily":
+                when = self.now - timedelta(days=i, hours=12)
+            elif times == "spread":
+                when = self.now - timedelta(hours=hours[i - start])
+            elif times == "recent":
+                when = self.now - timedelta(hours=rng.randint(0, 24 * 20), minutes=rng.randint(0, 59))
+            else:
+                when = datetime(2024, 1, rng.randint(1, 5), rng.randint(0, 3))
+
+            record = {
+                "sender": f"Contact {i % senders}" if isinstance(senders, int) else rng.choice(senders),
+                "datetime": f"{when:%Y-%m-%d %H:%M:%S}",
+                type_field: types if isinstance(types, str) else rng.choice(types),
+                "content": content.format(i=i)
+            }
+            if subjects:
+                record["subject"] = f"Topic {i % 4}"
+            records.append(record)
+
+            if replies and rng.random() < 0.7:
+                reply = when + timedelta(minutes=rng.randint(1, 300))
+                records.append({"sender": "Me", "datetime": f"{reply:%Y-%m-%d %H:%M:%S}", type_field: "sent",
+                                "content": "ok"})
+                if subjects:
+                    records[-1]["subject"] = f"Re: Topic {i % 4}"
+        return records
+
+
+@pytest.fixture
+def make_records():
+    """
+    Function building test records, see RecordFactory.
+    """
+    return RecordFactory()
@@ -0,0 +1,40 @@
+from datetime import datetime
+import time
+
+from alerts import AlertEngine
+from index import to_epoch
+
+MESSAGE = "{sender} hasn't texted in a while. Check on them!"
+
+
+def start_engine(state_path, last_seen):
+    engine = AlertEngine()
+    engine.register("sms", 60, MESSAGE, str(state_path))
+    engine.update("sms", last_seen, reset=True)
+    return engine
+
+
+def test_alerts_fire_once_across_restarts(tmp_path):
+    state_path = tmp_path / "sms_data.alerts"
+    now = to_epoch(datetime.now())
+    engine = start_engine(state_path, {"Ada": now - 120, "Bob": now})
+
+    alerts = engine.wait(0, 5)
+    assert [alert["sender"] for alert in alerts] == ["Ada"]
+    assert state_path.exists()
+
+    # A restarted engine hands out higher ids, does not fire Ada again, and
+    # fires Cy, who went stale while it was down
+    time.sleep(2)
+    restarted = start_engine(state_path, {"Ada": now - 120, "Bob": now, "Cy": now - 59})
+    assert restarted.last_id > alerts[-1]["id"]
+    fired = restarted.wait(alerts[-1]["id"], 5)
+    assert [alert["sender"] for alert in fired] == ["Cy"]
+    assert restarted.wait(fired[-1]["id"], 0.5) == []
+
+
+def test_unknown_ids_replay_the_history(tmp_path):
+    now = to_epoch(datetime.now())
+    engine = start_engine(tmp_path / "sms_data.alerts", {"Ada": now - 120})
+    alerts = engine.wait(0, 5)
+    assert engine.wait(engine.last_id + 1000, 0) == alerts
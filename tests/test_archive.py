@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from archive import SegmentArchive
+from index import SenderIndex, TimeIndex
+from ingest import collect_batch
+from query import query_archive
+from storage import RecordStore
+
+
+def open_collector(tmp_path, dedup=False, **archive_args):
+    store = RecordStore(str(tmp_path / "call_log_data.json"), snapshots=False)
+    archive = SegmentArchive(store, "log_type", **archive_args)
+    senders = store.subscribe(SenderIndex("log_type", archive))
+    times = store.subscribe(TimeIndex("log_type"))
+    indexes = {"store": store, "archive": archive, "senders": senders, "times": times}
+    if dedup:
+        pytest.importorskip("numpy")
+        from dedup import DEDUP_FIELDS, DedupIndex
+
+        indexes["dedup"] = store.subscribe(DedupIndex(store, DEDUP_FIELDS["call_log_data.json"], archive))
+    return indexes
+
+
+def snapshot(collector):
+    # What the archive keeps answering the same way: every record, and every sender's summary
+    filters = {"sender": None, "record_type": None, "start": None, "end": None, "after": None}
+    _, records = query_archive(collector["store"], collector["times"], collector["archive"], filters, None)
+    return records, collector["senders"].last_seen_times(), dict(collector["senders"].counts)
+
+
+def test_archiving_is_off_by_default(tmp_path, make_records):
+    collector = open_collector(tmp_path)
+    collector["store"].extend(make_records(200, times="daily", senders=4, types="incoming", type_field="log_type"))
+    assert collector["archive"].maintain(make_records.now) == 0
+    assert len(collector["store"]) == 200 and not collector["archive"].has_segments()
+
+
+def test_results_match_before_and_after_maintain(tmp_path, make_records):
+    collector = open_collector(tmp_path, dedup=True, active_days=30)
+    records = make_records(120, times="daily", senders=4, types="incoming", type_field="log_type")
+    collector["store"].extend(records)
+    before = snapshot(collector)
+
+    moved = collector["archive"].maintain(make_records.now)
+    assert moved > 0 and len(collector["store"]) == 120 - moved
+    assert snapshot(collector) == before
+
+    # Retrying an archived record is a duplicate, and it is not returned twice
+    result = collect_batch(collector["store"], [(records[-1], None)], lambda record: None, collector["dedup"])
+    assert (result["accepted"], result["duplicates"]) == (0, 1)
+    assert snapshot(collector) == before
+
+
+class Crash(Exception):
+    pass
+
+
+def crash(*args, **kwargs):
+    raise Crash()
+
+
+@pytest.mark.parametrize("step", ["manifest", "trim"])
+def test_interrupted_pass_never_shows_a_record_twice(tmp_path, make_records, step):
+    collector = open_collector(tmp_path, active_days=30)
+    collector["store"].extend(make_records(120, times="daily", senders=4, types="incoming", type_field="log_type"))
+    before = snapshot(collector)
+
+    # The process dies with the segments written, but before the manifest or before the store is trimmed
+    if step == "manifest":
+        collector["archive"]._write_manifest = crash
+    else:
+        collector["store"].replace = crash
+    with pytest.raises(Crash):
+        collector["archive"].maintain(make_records.now)
+    collector["store"].close()
+
+    # Reopened, every record is there once, from either the store or the archive
+    collector = open_collector(tmp_path, active_days=30)
+    assert len(collector["store"]) == 120
+    assert collector["archive"].has_segments() == (step == "trim")
+    assert snapshot(collector) == before
+
+    # The next pass finishes the trim and leaves only the segments the manifest lists
+    moved = collector["archive"].maintain(make_records.now)
+    assert moved > 0 and len(collector["store"]) == 120 - moved
+    assert collector["archive"].pending_cutoff() is None
+    assert snapshot(collector) == before
+    files = {entry["file"] for entry in collector["archive"]._segments.values()}
+    assert set(os.listdir(collector["archive"].directory)) == files | {"manifest.json"}
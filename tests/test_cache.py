@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta
+import hashlib
+
+from flask import Flask, jsonify, request
+import pytest
+
+from cache import ResponseCache, cached
+import query
+from storage import RecordStore
+
+
+@pytest.fixture
+def service(tmp_path):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    cache = ResponseCache()
+    calls = []
+    app = Flask(__name__)
+
+    @app.route("/get_sms")
+    @cached([store], cache=cache)
+    def get_sms():
+        calls.append(dict(request.args))
+        if request.args.get("limit") == "0":
+            return jsonify({"status": "error", "message": "Invalid limit"}), 400
+        return jsonify({"status": "success", "count": len(store)}), 200
+
+    return store, cache, calls, app.test_client()
+
+
+def test_etag_identifies_path_arguments_and_store_version(service):
+    store, _, _, client = service
+    response = client.get("/get_sms?b=2&a=1&a=0")
+    key = repr(("/get_sms", [("a", "0"), ("a", "1"), ("b", "2")], [store.version], None))
+    assert response.headers["ETag"] == '"%s"' % hashlib.sha1(key.encode("utf-8")).hexdigest()
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    # Argument order does not matter, their values do
+    assert client.get("/get_sms?a=1&b=2&a=0").headers["ETag"] == response.headers["ETag"]
+    assert client.get("/get_sms?b=3&a=1&a=0").headers["ETag"] != response.headers["ETag"]
+
+
+def test_unchanged_data_is_not_recomputed(service):
+    _, cache, calls, client = service
+    etag = client.get("/get_sms").headers["ETag"]
+
+    # A client holding the current version gets a 304 without a body
+    response = client.get("/get_sms", headers={"If-None-Match": etag})
+    assert (response.status_code, response.data, response.headers["ETag"]) == (304, b"", etag)
+
+    # Other clients are served from the cache
+    response = client.get("/get_sms", headers={"If-None-Match": '"other"'})
+    assert (response.status_code, response.get_json()["count"]) == (200, 0)
+    assert len(calls) == 1 and cache.hits == 1
+
+
+def test_commits_invalidate_etags(service):
+    store, _, calls, client = service
+    etag = client.get("/get_sms").headers["ETag"]
+    store.extend([{"datetime": "2024-01-01 10:00:00", "sender": "Ann"}])
+
+    response = client.get("/get_sms", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert response.get_json()["count"] == 1 and len(calls) == 2
+
+
+def test_errors_are_not_cached(service):
+    _, cache, calls, client = service
+    for _ in range(2):
+        response = client.get("/get_sms?limit=0")
+        assert response.status_code == 400 and "ETag" not in response.headers
+    assert len(calls) == 2 and cache.size == 0
+
+
+def test_cache_is_bounded_by_bytes_in_lru_order():
+    cache = ResponseCache(max_bytes=100)
+    cache.put("a", b"a" * 40, "application/json")
+    cache.put("b", b"b" * 40, "application/json")
+    assert cache.get("a") is not None
+
+    # b is now the least recently used, so it makes room for c
+    cache.put("c", b"c" * 40, "application/json")
+    assert cache.get("b") is None and cache.get("a") and cache.get("c")
+    assert cache.size == 80
+
+    # Replacing an entry counts its new size only; bodies over the bound are never kept
+    cache.put("a", b"a" * 10, "application/json")
+    assert cache.size == 50
+    cache.put("d", b"d" * 101, "application/json")
+    assert cache.get("d") is None and cache.size == 50
+    cache.put("e", b"e" * 60, "application/json")
+    assert cache.get("c") is None and cache.size == 70
+
+
+class Clock(datetime):
+    current = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+def test_analyze_etag_changes_when_a_sender_goes_stale(collectors, monkeypatch):
+    sms = collectors["sms"]
+    monkeypatch.setattr(query, "datetime", Clock)
+    monkeypatch.setattr(sms, "datetime", Clock)
+    client = sms.app.test_client()
+
+    # The sender goes stale an hour after the first request
+    start = datetime(2030, 1, 1, 12, 0, 0)
+    last_seen = start - timedelta(days=sms.STALE_AFTER_DAYS, hours=-1)
+    record = {"datetime": last_seen.strftime("%Y-%m-%d %H:%M:%S"), "sender": "Cache Tester", "type": "received",
+              "content": "Hi"}
+    assert client.post("/collect_sms", json=record).status_code == 200
+    insight = sms.STALE_INSIGHT.format(sender="Cache Tester")
+
+    Clock.current = start
+    response = client.get("/analyze_sms")
+    etag = response.headers["ETag"]
+    assert insight not in response.get_json()["insights"]
+
+    # Until then, nothing the result depends on has changed
+    Clock.current = start + timedelta(minutes=30)
+    assert client.get("/analyze_sms", headers={"If-None-Match": etag}).status_code == 304
+
+    Clock.current = start + timedelta(hours=2)
+    response = client.get("/analyze_sms", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert insight in response.get_json()["insights"]
+
+    # The days parameter moves the cutoff, so it is part of the ETag too
+    assert client.get("/analyze_sms?days=30").headers["ETag"] != response.headers["ETag"]
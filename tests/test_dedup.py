@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from dedup import DEDUP_FIELDS, DedupIndex
+from ingest import collect_batch
+from storage import RecordStore
+
+FIELDS = DEDUP_FIELDS["sms_data.json"]
+
+
+def validate(record):
+    return None if isinstance(record, dict) and record.get("datetime") else "Missing datetime"
+
+
+def test_batches_report_stored_records_and_duplicates(tmp_path, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    dedup = store.subscribe(DedupIndex(store, FIELDS))
+    records = make_records(10)
+
+    entries = [(record, None) for record in records] + [({"sender": "Nobody"}, None)]
+    result = collect_batch(store, entries, validate, dedup)
+    assert (result["accepted"], result["duplicates"], result["rejected"]) == (10, 0, 1)
+
+    # A retried sync with two new records stores only those
+    entries = [(record, None) for record in records + make_records(2, 10)]
+    result = collect_batch(store, entries, validate, dedup)
+    assert (result["accepted"], result["duplicates"], result["rejected"]) == (2, 10, 0)
+    assert len(store) == 12
+
+
+def test_rebuild_matches_incremental_index(tmp_path, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    live = store.subscribe(DedupIndex(store, FIELDS, merge_every=7))
+    records = make_records(40)
+    for start in range(0, 40, 5):
+        store.extend(records[start:start + 5])
+
+    # Rebuilding from the hashes file and the records after it gives the same answers
+    probe = records + make_records(20, 40)
+    expected = [True] * 40 + [False] * 20
+    assert live.contains(probe) == expected
+    live.rebuild(store)
+    assert live.contains(probe) == expected
+
+    # Replacing the records invalidates the hashes file, even with the same first and last records
+    store.replace([records[0]] + make_records(38, 100) + [records[-1]])
+    assert live.contains(records) == [True] + [False] * 38 + [True]
+
+
+def test_only_the_lock_owner_writes(tmp_path, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    owner = store.subscribe(DedupIndex(store, FIELDS, merge_every=7))
+    store.extend(make_records(20))
+
+    # A second index on the same file, as in another process, keeps its hashes in memory
+    reader = store.subscribe(DedupIndex(store, FIELDS, merge_every=7))
+    assert owner.writable and not reader.writable
+    os.remove(owner.path)
+    store.extend(make_records(5, 20))
+    reader.rebuild(store)
+    assert reader.contains(make_records(26)) == [True] * 25 + [False]
+    assert not os.path.exists(owner.path)
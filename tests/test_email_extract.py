@@ -0,0 +1,117 @@
+import base64
+import os
+
+from email_extract import Manifest, _init_worker, _parse_data, ingest
+
+MESSAGE = """From: Ada Lovelace <ada@example.com>
+To: me@example.com
+Subject: {subject}
+{date}Content-Type: text/plain; charset=utf-8
+
+Hello
+"""
+
+
+ATTACHED = """From: Ada Lovelace <ada@example.com>\r
+To: me@example.com\r
+Subject: Report\r
+Date: Mon, 01 Jan 2024 12:00:00 +0000\r
+Content-Type: multipart/mixed; boundary="sep"\r
+\r
+--sep\r
+Content-Type: text/plain; charset=utf-8\r
+\r
+See attached\r
+--sep\r
+Content-Type: application/octet-stream\r
+Content-Disposition: attachment; filename="report.bin"\r
+Content-Transfer-Encoding: base64\r
+\r
+{payload}\r
+--sep--\r
+"""
+
+
+class TrackedMessage:
+    """
+    Message bytes recording every range copied out of them. Like a memory map,
+    they can be searched in place, but hashing them whole raises TypeError.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.copied = []
+
+    def __len__(self):
+        return len(self.data)
+
+    def find(self, *args):
+        return self.data.find(*args)
+
+    def __getitem__(self, index):
+        self.copied.append((index.start, index.stop))
+        return self.data[index]
+
+
+def write_message(folder, name, subject, dated=True):
+    date = "Date: Mon, 01 Jan 2024 12:00:00 +0000\n" if dated else ""
+    path = folder / name
+    path.write_text(MESSAGE.format(subject=subject, date=date), encoding="utf-8")
+    return path
+
+
+def recording_sink(stored):
+    def sink(records):
+        errors = [{"index": i, "message": "Missing datetime"} for i, record in enumerate(records) if not record["datetime"]]
+        failed = {error["index"] for error in errors}
+        stored.extend(record for i, record in enumerate(records) if i not in failed)
+        return {"accepted": len(records) - len(errors), "errors": errors}
+    return sink
+
+
+def test_rejected_messages_are_retried(tmp_path):
+    mail = tmp_path / "mail"
+    mail.mkdir()
+    write_message(mail, "good.eml", "Dated")
+    undated = write_message(mail, "bad.eml", "Undated", dated=False)
+    manifest_path = str(tmp_path / "manifest.jsonl")
+
+    stored = []
+    stats = ingest([str(mail)], recording_sink(stored), backend="thread", manifest_path=manifest_path)
+    assert (stats["stored"], stats["rejected"]) == (1, 1)
+    assert [record["subject"] for record in stored] == ["Dated"]
+
+    # Only the stored message is in the manifest
+    manifest = Manifest(manifest_path)
+    assert len(manifest.hashes) == 1
+    assert not manifest.is_current(str(undated), undated.stat().st_mtime)
+
+    # Once fixed, the rejected message is ingested on the next run; the stored one is skipped
+    write_message(mail, "bad.eml", "Undated")
+    stats = ingest([str(mail)], recording_sink(stored), backend="thread", manifest_path=manifest_path)
+    assert (stats["stored"], stats["rejected"], stats["parsed"]) == (1, 0, 1)
+    assert [record["subject"] for record in stored] == ["Dated", "Undated"]
+
+
+def test_lazy_parsing_leaves_attachment_payloads_unread():
+    encoded = base64.b64encode(os.urandom(30000)).decode("ascii")
+    payload = "\r\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+    raw = ATTACHED.format(payload=payload).encode("ascii")
+    start = raw.index(payload.encode("ascii"))
+    end = start + len(payload)
+
+    _init_worker(frozenset(), frozenset(), "inbox", lazy=True)
+    try:
+        data = TrackedMessage(raw)
+        _, _, digest, record, error = _parse_data("report.eml", 1.0, data)
+        assert error is None
+        assert _parse_data("report.eml", 1.0, TrackedMessage(raw))[2] == digest
+    finally:
+        _init_worker(frozenset(), frozenset(), "inbox")
+
+    assert (record["subject"], record["body"].strip(), record["attachments"]) == ("Report", "See attached", ["report.bin"])
+    assert abs(record["attachment_sizes"][0] - 30000) < 1000
+
+    # Neither the hash nor the parser copied any of the payload
+    assert data.copied
+    assert all(stop <= start or copy_start >= end for copy_start, stop in data.copied)
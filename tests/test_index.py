@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+import json
+import random
+
+import pytest
+
+from alerts import AlertEngine, StalenessMonitor
+from index import DATETIME_FORMAT, SenderIndex, TimeIndex, format_timestamp, parse_timestamp, to_epoch
+from rollups import RollupIndex
+from storage import RecordStore
+from threads import ThreadIndex
+
+
+def subscribe_indexes(store):
+    senders = store.subscribe(SenderIndex("type"))
+    return {
+        "senders": senders,
+        "times": store.subscribe(TimeIndex("type")),
+        "threads": store.subscribe(ThreadIndex("type")),
+        "rollups": store.subscribe(RollupIndex("type")),
+        "alerts": store.subscribe(StalenessMonitor("sms", senders, 7, "{sender}", engine=AlertEngine()))
+    }
+
+
+GOOD = {"datetime": "2024-01-01 10:00:00", "sender": "Ann", "type": "received", "content": "Hi"}
+
+BAD = [
+    dict(GOOD, sender=["x"]),
+    dict(GOOD, sender={"name": "x"}),
+    dict(GOOD, type=["received"])
+]
+
+
+@pytest.mark.parametrize("snapshots", [False, True], ids=["log", "snapshot"])
+def test_indexes_skip_unhashable_senders_and_types(tmp_path, snapshots):
+    if snapshots:
+        pytest.importorskip("numpy")
+
+    # Records that got into the log before validation checked types
+    path = tmp_path / "sms_data.jsonl"
+    path.write_text("".join(json.dumps(record) + "\n" for record in [GOOD] + BAD), encoding="utf-8")
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=snapshots)
+    if snapshots:
+        store.compact()
+
+    # The store opens and every index is built, leaving the bad records out
+    indexes = subscribe_indexes(store)
+    store.extend(BAD + [dict(GOOD, sender="Bo")])
+    assert sorted(indexes["senders"].last_seen) == ["Ann", "Bo"]
+    assert [seq for _, seq in indexes["times"].query()] == [0, 7]
+    assert [summary["conversation"] for summary in indexes["threads"].threads()] == ["Bo", "Ann"]
+    assert store.stats()["last_error"] is None
+
+
+def strptime_epoch(value):
+    # Reference parser; ValueError stands for a rejected value
+    try:
+        return to_epoch(datetime.strptime(value, DATETIME_FORMAT))
+    except ValueError:
+        return ValueError
+
+
+def fast_epoch(value):
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        return ValueError
+
+
+MALFORMED = [
+    "", "2024-01-01", "2024-01-01 10:00", "2024-01-01T10:00:00", "2024/01/01 10:00:00", "2024-01-01 10-00-00",
+    "2024-00-10 10:00:00", "2024-13-01 10:00:00", "2024-04-31 10:00:00", "2024-01-00 10:00:00",
+    "2024-01-01 24:00:00", "2024-01-01 10:60:00", "2024-01-01 10:00:60", "2024-01-01 10:00:0 ",
+    " 2024-01-01 10:00:00", "2024-01-01 10:00:00 ", "0000-01-01 10:00:00", "+024-01-01 10:00:00",
+    "2024-1-1 1:2:3", "２０２４-01-01 10:00:00", "2024-01-01 1０:00:00", "abcd-ef-gh ij:kl:mn"
+]
+
+LEAP_DAYS = [
+    "2024-02-29 00:00:00", "2000-02-29 23:59:59", "1972-02-29 12:00:00", "1968-02-29 06:30:15",
+    "2023-02-29 00:00:00", "1900-02-29 00:00:00", "2100-02-29 00:00:00", "2024-02-30 00:00:00",
+    "2024-02-28 23:59:59", "2024-03-01 00:00:00", "2023-03-01 00:00:00", "1999-12-31 23:59:59"
+]
+
+
+@pytest.mark.parametrize("value", MALFORMED + LEAP_DAYS)
+def test_parse_timestamp_matches_strptime(value):
+    # Twice, so the cached day is used the second time
+    assert fast_epoch(value) == strptime_epoch(value)
+    assert fast_epoch(value) == strptime_epoch(value)
+
+
+def test_timestamps_round_trip_like_datetime():
+    rng = random.Random(0)
+    start = to_epoch(datetime(1000, 1, 1))
+    end = to_epoch(datetime(9999, 12, 31, 23, 59, 59))
+    for seconds in [rng.randint(start, end) for _ in range(5000)] + [0, -1, 86399, 86400, start, end]:
+        text = (datetime(1970, 1, 1) + timedelta(seconds=seconds)).strftime(DATETIME_FORMAT)
+        assert format_timestamp(seconds) == text
+        assert parse_timestamp(text) == strptime_epoch(text) == seconds
+
+
+def test_parse_timestamp_rejects_non_strings():
+    for value in (None, 1704103200, b"2024-01-01 10:00:00"):
+        with pytest.raises((TypeError, ValueError)):
+            parse_timestamp(value)
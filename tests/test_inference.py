@@ -0,0 +1,125 @@
+import threading
+
+import pytest
+
+import inference
+from inference import SYSTEM_PROMPTS, InferenceWorker, TransformersBackend
+
+
+class FakeBackend:
+    """
+    Backend answering with the prompt's length, recording every batch it is given.
+    """
+
+    model_name = "fake"
+
+    def __init__(self):
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def generate(self, prefix, prompts):
+        with self._lock:
+            self.batches.append((prefix, list(prompts)))
+        return [f"<think>reasoning</think>{len(prompt)}" for prompt in prompts]
+
+
+def make_worker(tmp_path, backend, **kwargs):
+    return InferenceWorker(backend, cache_file=str(tmp_path / "inference_cache.json"), **kwargs)
+
+
+def test_concurrent_requests_are_batched_per_task(tmp_path):
+    backend = FakeBackend()
+    worker = make_worker(tmp_path, backend, max_batch_size=3, batch_wait=0.3)
+
+    # Queued within the batch wait, so they are generated together, one task at a time
+    futures = [worker.submit("summarize", f"message {i}") for i in range(5)]
+    futures += [worker.submit("classify", "meeting at noon")]
+    results = [future.result(10) for future in futures]
+
+    assert results == [str(len(f"message {i}" + inference.ANSWER_SUFFIX)) for i in range(5)] + ["24"]
+    assert [(prefix, len(prompts)) for prefix, prompts in backend.batches] == [
+        (SYSTEM_PROMPTS["summarize"], 3), (SYSTEM_PROMPTS["summarize"], 2), (SYSTEM_PROMPTS["classify"], 1)
+    ]
+    assert worker.stats()["batches"] == 3 and worker.stats()["avg_batch_size"] == 2
+
+
+def test_results_are_memoized(tmp_path):
+    backend = FakeBackend()
+    worker = make_worker(tmp_path, backend, batch_wait=0.1)
+
+    # Identical requests in flight share one generation
+    assert worker.run("summarize", ["hello", "hello", "bye"], timeout=10) == ["14", "14", "12"]
+    assert [prompts for _, prompts in backend.batches] == [["hello\n\nAnswer:", "bye\n\nAnswer:"]]
+
+    # Later requests are served from the cache, also by a worker started again on the same file
+    restarted = FakeBackend()
+    for current in (worker, make_worker(tmp_path, restarted)):
+        assert current.run("summarize", ["bye", "hello"], timeout=10) == ["12", "14"]
+    assert len(backend.batches) == 1 and restarted.batches == []
+
+    # The cache is kept per task
+    assert worker.run("classify", ["hello"], timeout=10) == ["14"]
+    assert len(backend.batches) == 2
+    assert worker.stats()["cache_hits"] == 3
+
+
+def test_routes_report_a_missing_model(tmp_path, monkeypatch):
+    def unavailable():
+        raise ImportError("No module named 'torch'")
+
+    monkeypatch.setattr(inference, "worker", None)
+    monkeypatch.setattr(inference, "TransformersBackend", unavailable)
+    client = inference.app.test_client()
+
+    # Imported without start_worker(), the model is loaded on the first request
+    assert client.get("/inference_stats").status_code == 503
+    response = client.post("/analyze_messages", json={"task": "summarize", "texts": ["hello"]})
+    assert response.status_code == 503
+    assert "torch" in response.get_json()["message"]
+
+    inference.start_worker(FakeBackend(), cache_file=str(tmp_path / "inference_cache.json"))
+    response = client.post("/analyze_messages", json={"task": "summarize", "texts": ["hello"]})
+    assert (response.status_code, response.get_json()["results"]) == (200, ["14"])
+    assert client.get("/inference_stats").get_json()["stats"]["generated"] == 1
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tmp_path_factory):
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    tokenizers = pytest.importorskip("tokenizers")
+
+    # Character-level tokenizer and a small random GPT-2, saved like a downloaded model
+    characters = sorted(set("".join(SYSTEM_PROMPTS.values()) + "abcdefghijklmnopqrstuvwxyz0123456789 .,:!?\n"))
+    vocab = {"<pad>": 0, "<eos>": 1}
+    vocab.update({character: i + 2 for i, character in enumerate(characters)})
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token="<pad>"))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Split("", "isolated")
+
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=len(vocab), n_positions=512, n_embd=32, n_layer=2, n_head=2,
+                                     bos_token_id=1, eos_token_id=1, pad_token_id=0)
+    path = str(tmp_path_factory.mktemp("tiny_model"))
+    transformers.GPT2LMHeadModel(config).save_pretrained(path)
+    transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>", pad_token="<pad>").save_pretrained(path)
+    return TransformersBackend(path, "cpu", max_new_tokens=6)
+
+
+def test_prefix_cache_matches_full_prompts(tiny_model):
+    torch = tiny_model.torch
+    prefix = SYSTEM_PROMPTS["classify"]
+    prompts = ["lunch at noon?" + inference.ANSWER_SUFFIX, "hi" + inference.ANSWER_SUFFIX]
+
+    # The prefix is run through the model once and reused by later batches
+    batched = tiny_model.generate(prefix, prompts)
+    cached = tiny_model._prefix_cache[prefix]
+    assert [tiny_model.generate(prefix, [prompt])[0] for prompt in prompts] == batched
+    assert tiny_model._prefix_cache[prefix] is cached and len(tiny_model._prefix_cache) == 1
+
+    # Same completions as generating each whole prompt without the cache
+    for prompt, completion in zip(prompts, batched):
+        ids = tiny_model.tokenizer(prefix + prompt, return_tensors="pt").input_ids
+        with torch.no_grad():
+            output = tiny_model.model.generate(input_ids=ids, attention_mask=torch.ones_like(ids), max_new_tokens=6,
+                                               do_sample=False, pad_token_id=0)
+        assert tiny_model.tokenizer.decode(output[0, ids.shape[1]:], skip_special_tokens=True) == completion
@@ -0,0 +1,95 @@
+import json
+
+from flask import Flask, request
+import pytest
+
+from ingest import PayloadError, collect_batch, read_batch
+from storage import RecordStore
+
+
+def validate(record):
+    return None if isinstance(record, dict) and isinstance(record.get("sender"), str) else "Invalid sender"
+
+
+def read(data, content_type):
+    app = Flask(__name__)
+    with app.test_request_context(method="POST", data=data, content_type=content_type):
+        return read_batch(request)
+
+
+def test_errors_are_reported_by_position_in_the_batch(tmp_path):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    lines = [json.dumps({"sender": "Ann"}), "{not json", json.dumps({"sender": ["Ann"]}), "", json.dumps({"sender": "Bo"})]
+    entries = read("\n".join(lines), "application/x-ndjson")
+
+    # The blank line is skipped, so the last record is at index 3
+    result = collect_batch(store, entries, validate)
+    assert (result["accepted"], result["rejected"]) == (2, 2)
+    assert [error["index"] for error in result["errors"]] == [1, 2]
+    assert result["errors"][0]["message"].startswith("Invalid JSON")
+    assert list(store) == [{"sender": "Ann"}, {"sender": "Bo"}]
+
+
+def test_batch_must_be_an_array():
+    assert read(json.dumps([{"sender": "Ann"}]), "application/json") == [({"sender": "Ann"}, None)]
+    with pytest.raises(PayloadError):
+        read(json.dumps({"sender": "Ann"}), "application/json")
+
+
+VALID = {
+    "call": {"datetime": "2024-01-01 10:00:00", "sender": "Ann", "log_type": "incoming"},
+    "sms": {"datetime": "2024-01-01 10:00:00", "sender": "Ann", "type": "received", "content": "Hi"},
+    "email": {"datetime": "2024-01-01 10:00:00", "sender": "Ann", "type": "received", "subject": "Hi",
+              "body": "Hello", "attachments": []}
+}
+
+INVALID = [
+    ("call", "sender", ["x"]),
+    ("sms", "sender", {"name": "x"}),
+    ("sms", "content", 5),
+    ("email", "sender", ["x"]),
+    ("email", "subject", None),
+    ("email", "body", {"text": "x"}),
+    ("email", "attachments", "file.txt")
+]
+
+ROUTES = {
+    "call": ("/collect_call_log", "/collect_call_log_batch", "call_log_store"),
+    "sms": ("/collect_sms", "/collect_sms_batch", "sms_store"),
+    "email": ("/collect_email", "/collect_email_batch", "email_store")
+}
+
+
+@pytest.mark.parametrize("source, field, value", INVALID)
+def test_collectors_reject_wrong_field_types(collectors, source, field, value):
+    module = collectors[source]
+    collect, batch, store_name = ROUTES[source]
+    store = getattr(module, store_name)
+    client = module.app.test_client()
+    record = dict(VALID[source], **{field: value})
+    count = len(store)
+
+    response = client.post(collect, json=record)
+    assert response.status_code == 400
+    assert response.get_json()["message"].startswith(f"Invalid {field}")
+
+    # In a batch, only the bad record is rejected, by its index
+    good = dict(VALID[source], datetime=f"2024-01-02 10:00:{count % 60:02d}")
+    response = client.post(batch, json=[good, record])
+    body = response.get_json()
+    assert (body["accepted"], body["rejected"]) == (1, 1)
+    assert body["errors"][0]["index"] == 1
+    assert len(store) == count + 1
+
+
+def test_collectors_keep_writing_with_contacts_mounted(collectors):
+    # server.py serves contacts in the collectors' process, so importing it must not give up their stores
+    import contacts
+
+    for source, (collect, _, store_name) in ROUTES.items():
+        store = getattr(collectors[source], store_name)
+        count = len(store)
+        response = collectors[source].app.test_client().post(collect, json=dict(VALID[source], sender="Mounted"))
+        assert response.status_code == 200
+        assert not store.read_only and len(store) == count + 1
+    assert contacts.app.test_client().get("/get_contacts").status_code == 200
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import config
+
+
+def scrape(client):
+    # Samples by name and labels, e.g. ('collector_store_records', '{store="sms_data.jsonl"}')
+    response = client.get("/metrics")
+    assert response.status_code == 200 and response.mimetype == "text/plain"
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            name, _, labels = series.partition("{")
+            samples[name, "{" + labels if labels else ""] = float(value)
+    return samples
+
+
+def delta(before, after, name, labels=""):
+    return after.get((name, labels), 0) - before.get((name, labels), 0)
+
+
+@pytest.fixture
+def sms(collectors):
+    if not config.METRICS:
+        pytest.skip("metrics are turned off")
+    return collectors["sms"]
+
+
+def test_one_collect_is_counted_and_timed(sms):
+    client = sms.app.test_client()
+    store = sms.sms_store.name
+    record = {"datetime": "2024-03-01 10:00:00", "sender": "Metrics Tester", "type": "received", "content": "Hi"}
+    body = json.dumps(record)
+
+    before = scrape(client)
+    response = client.post("/collect_sms", data=body, content_type="application/json")
+    assert response.status_code == 200
+    after = scrape(client)
+
+    route = 'route="/collect_sms"'
+    assert delta(before, after, "collector_request_duration_seconds_count",
+                 '{%s,method="POST",status="200"}' % route) == 1
+    assert delta(before, after, "collector_request_duration_seconds_sum",
+                 '{%s,method="POST",status="200"}' % route) > 0
+
+    # Every phase of the collect was timed once
+    for phase in ("parse", "validate", "storage_write", "serialize"):
+        labels = '{%s,phase="%s"}' % (route, phase)
+        assert delta(before, after, "collector_request_phase_seconds_count", labels) == 1
+        assert delta(before, after, "collector_request_phase_seconds_sum", labels) > 0
+        assert delta(before, after, "collector_request_phase_seconds_bucket", labels[:-1] + ',le="+Inf"}') == 1
+
+    # Sizes, records written and the store's gauges
+    assert delta(before, after, "collector_request_size_bytes_sum", "{%s}" % route) == len(body)
+    assert delta(before, after, "collector_response_size_bytes_count", "{%s}" % route) == 1
+    assert delta(before, after, "collector_request_records_sum", '{%s,operation="write"}' % route) == 1
+    assert delta(before, after, "collector_store_records", '{store="%s"}' % store) == 1
+    assert delta(before, after, "collector_store_records_committed", '{store="%s"}' % store) == 1
+    assert delta(before, after, "collector_store_lock_wait_seconds_count",
+                 '{store="%s",operation="commit"}' % store) >= 1
+
+
+def test_reads_are_timed(sms):
+    client = sms.app.test_client()
+    before = scrape(client)
+    response = client.get("/get_sms_data?sender=Metrics Tester&limit=5")
+    assert response.status_code == 200
+    after = scrape(client)
+
+    route = 'route="/get_sms_data"'
+    for phase in ("storage_read", "serialize"):
+        assert delta(before, after, "collector_request_phase_seconds_count", '{%s,phase="%s"}' % (route, phase)) == 1
+    assert delta(before, after, "collector_request_records_count", '{%s,operation="read"}' % route) == 1
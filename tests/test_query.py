@@ -0,0 +1,108 @@
+import json
+
+from flask import Flask
+import pytest
+
+from index import TimeIndex, parse_timestamp
+import query
+from query import QueryError, get_records, parse_time
+from storage import RecordStore
+
+SENDERS = ["Ann", "Bo", "Cy"]
+
+
+@pytest.fixture(params=[False, True], ids=["log", "snapshot"])
+def collector(request, tmp_path, make_records):
+    if request.param:
+        pytest.importorskip("numpy")
+    store = RecordStore(str(tmp_path / "sms_data.json"), compact_every=0, snapshots=request.param)
+    times = store.subscribe(TimeIndex("type"))
+    records = make_records(300, times="clustered", senders=SENDERS, types=["received", "sent"])
+
+    # With snapshots, part of the records are folded into one and the rest are in the log
+    store.extend(records[:200])
+    store.compact()
+    store.extend(records[200:])
+    return store, times, records
+
+
+def expected(records, sender=None, record_type=None, start=None, end=None):
+    # Brute-force scan in (datetime, record number) order, with inclusive bounds
+    keys = [(parse_timestamp(record["datetime"]), seq) for seq, record in enumerate(records)]
+    return [
+        records[seq] for time, seq in sorted(keys)
+        if (sender is None or records[seq]["sender"] == sender)
+        and (record_type is None or records[seq]["type"] == record_type)
+        and (start is None or time >= parse_time(start)) and (end is None or time <= parse_time(end))
+    ]
+
+
+def get(store, times, args):
+    app = Flask(__name__)
+    with app.test_request_context():
+        return get_records(store, times, args, "type")
+
+
+def read_pages(store, times, args, limit):
+    data, cursor = [], None
+    while True:
+        page_args = dict(args, limit=str(limit))
+        if cursor is not None:
+            page_args["cursor"] = cursor
+        body = get(store, times, page_args).get_json()
+        data.extend(body["data"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return data
+
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {"sender": "Bo"},
+    {"type": "sent"},
+    {"start": "2024-01-02 01:00:00", "end": "2024-01-04 02:00:00"},
+    {"sender": "Cy", "start": "2024-01-03"},
+    {"type": "received", "end": "2024-01-02 00:00:00"}
+])
+def test_cursor_pages_match_a_full_scan(collector, filters):
+    store, times, records = collector
+    scan = expected(records, filters.get("sender"), filters.get("type"), filters.get("start"), filters.get("end"))
+    assert get(store, times, filters).get_json()["data"] == scan
+    for limit in (1, 7, 50):
+        assert read_pages(store, times, filters, limit) == scan
+
+
+def test_start_and_end_are_inclusive(collector):
+    store, times, records = collector
+    moment = records[0]["datetime"]
+    data = get(store, times, {"start": moment, "end": moment}).get_json()["data"]
+    assert data and all(record["datetime"] == moment for record in data)
+    assert data == expected(records, start=moment, end=moment)
+
+
+@pytest.mark.parametrize("args", [
+    {"limit": "0"},
+    {"limit": "ten"},
+    {"cursor": "abc"},
+    {"cursor": "12"},
+    {"start": "yesterday"},
+    {"end": "2024-13-01"}
+])
+def test_invalid_parameters_raise_query_errors(collector, args):
+    store, times, _ = collector
+    with pytest.raises(QueryError):
+        get(store, times, args)
+
+
+def test_ndjson_streams_every_match_in_chunks(collector, monkeypatch):
+    store, times, records = collector
+    monkeypatch.setattr(query, "STREAM_CHUNK_SIZE", 16)
+
+    for args, scan in [
+        ({"format": "ndjson"}, expected(records)),
+        ({"format": "ndjson", "sender": "Ann", "limit": "40"}, expected(records, sender="Ann")[:40])
+    ]:
+        response = get(store, times, args)
+        assert response.mimetype == "application/x-ndjson"
+        lines = b"".join(response.response).decode("utf-8").splitlines()
+        assert [json.loads(line) for line in lines] == scan
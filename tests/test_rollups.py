@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from index import to_epoch
+from rollups import RollupIndex
+from storage import RecordStore
+from threads import ThreadIndex
+
+SENDERS = [f"Contact {i}" for i in range(6)]
+
+
+def rollup_state(rollups, now):
+    start, end = to_epoch(now - timedelta(days=30)), to_epoch(now + timedelta(days=1))
+    return [
+        rollups.series(granularity, start, end, sender)
+        for granularity in ("hour", "day")
+        for sender in [None] + SENDERS
+    ]
+
+
+def test_rebuild_matches_incremental_rollups(tmp_path, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    live = store.subscribe(RollupIndex("type", store.subscribe(ThreadIndex("type"))))
+
+    # Stored one by one and in batches, as collects and batch collects do
+    records = make_records(300, times="recent", senders=SENDERS, replies=True)
+    for record in records[:100]:
+        store.append(record)
+    for start in range(100, len(records), 64):
+        store.extend(records[start:start + 64])
+
+    threads = ThreadIndex("type")
+    rollups = RollupIndex("type", threads)
+    threads.rebuild(store)
+    rollups.rebuild(store)
+    assert rollup_state(live, make_records.now) == rollup_state(rollups, make_records.now)
+    assert any(entry is not None for _, _, entry in rollup_state(rollups, make_records.now)[0])
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from search import SearchIndex, parse_search
+from storage import RecordStore
+
+
+def matches(index, query):
+    seqs, _ = index.rank(parse_search(query))
+    return sorted(int(seq) for seq, _ in seqs)
+
+
+def index_files(index):
+    return {name: os.path.getmtime(os.path.join(index.directory, name)) for name in os.listdir(index.directory)}
+
+
+def test_replace_with_same_ends_reindexes(tmp_path, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    index = store.subscribe(SearchIndex(store, ["content"], flush_every=10))
+    records = make_records(25, content="message {i} about apples")
+    store.extend(records)
+    assert len(matches(index, "apples")) == 25
+
+    # Same first and last records, different ones in between
+    replaced = [records[0]] + make_records(25, content="message {i} about pears")[1:-1] + [records[-1]]
+    store.replace(replaced)
+    assert matches(index, "apples") == [0, 24]
+    assert len(matches(index, "pears")) == 23
+
+
+def test_only_the_lock_owner_writes(tmp_path, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    owner = store.subscribe(SearchIndex(store, ["content"], flush_every=10))
+    store.extend(make_records(25, content="message {i} about apples"))
+
+    # A second index on the same directory, as in another process, only reads
+    reader = store.subscribe(SearchIndex(store, ["content"], flush_every=10))
+    assert owner.writable and not reader.writable
+    files = index_files(owner)
+    store.extend(make_records(30, content="message {i} about pears"))
+    assert matches(reader, "pears") == matches(owner, "pears")
+    assert matches(reader, "apples") == matches(owner, "apples")
+
+    # The reader left the owner's files alone, and rebuilding it does not touch them either
+    files_after = index_files(owner)
+    store.reindex()
+    assert index_files(owner) == files_after != files
+    assert matches(reader, "message") == list(range(55))
@@ -0,0 +1,89 @@
+from flask import Flask
+
+from index import format_timestamp, parse_timestamp
+from shards import route_threads, route_unanswered, shard_of
+from storage import RecordStore
+from threads import ThreadIndex, get_threads, get_unanswered
+
+SHARDS = 3
+
+
+class FakePool:
+    """
+    Shards served in process: a store and thread index per shard.
+    """
+
+    def __init__(self, tmp_path, records):
+        self.app = Flask(__name__)
+        self.shards = []
+        for shard in range(SHARDS):
+            store = RecordStore(str(tmp_path / f"sms-{shard}.json"), snapshots=False)
+            threads = store.subscribe(ThreadIndex("type"))
+            store.extend([record for record in records if shard_of(record["sender"], SHARDS) == shard])
+            self.shards.append((store, threads))
+
+    def __len__(self):
+        return len(self.shards)
+
+    def owner(self, sender):
+        return shard_of(sender, SHARDS)
+
+    def get_json(self, requests):
+        bodies = []
+        for shard, path, params in requests:
+            store, threads = self.shards[shard]
+            handler = get_threads if path == "/sms_threads" else get_unanswered
+            with self.app.test_request_context():
+                bodies.append(handler(store, threads, params).get_json())
+        return bodies
+
+
+def read_pages(pool, route, path, limit):
+    app = Flask(__name__)
+    data, cursor = [], None
+    while True:
+        args = {"limit": limit} if cursor is None else {"limit": limit, "cursor": cursor}
+        with app.test_request_context(path, query_string=args):
+            body = route(pool, path).get_json()
+        data.extend(body["data"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return data
+
+
+def test_unanswered_pages_merge_oldest_first(tmp_path, make_records):
+    records = make_records(200, times="spread")
+    pool = FakePool(tmp_path, records)
+
+    data = read_pages(pool, route_unanswered, "/sms_unanswered", 15)
+    times = [entry["record"]["datetime"] for entry in data]
+    assert times == sorted(record["datetime"] for record in records)
+
+
+def test_unanswered_stay_in_time_order_as_replies_arrive(tmp_path, make_records):
+    store = RecordStore(str(tmp_path / "sms.json"), snapshots=False)
+    threads = store.subscribe(ThreadIndex("type"))
+    records = make_records(50, times="spread")
+    store.extend(records)
+
+    # A reply answers the thread of the last message stored
+    answered = parse_timestamp(records[-1]["datetime"])
+    store.extend([{"sender": "Me", "datetime": format_timestamp(answered + 60), "type": "sent", "content": "ok"}])
+
+    entries = threads.unanswered(limit=100)
+    times = [key[0] for key, _ in entries]
+    assert times == sorted(times) and len(entries) < len(records)
+    assert answered not in times
+
+
+def test_thread_pages_merge_by_global_thread_id(tmp_path, make_records):
+    pool = FakePool(tmp_path, make_records(200, times="spread"))
+
+    data = read_pages(pool, route_threads, "/sms_threads", 15)
+    ids = [summary["thread_id"] for summary in data]
+    expected = [
+        thread_id * SHARDS + shard
+        for shard, (_, threads) in enumerate(pool.shards)
+        for thread_id in range(len(threads.threads(limit=1000)))
+    ]
+    assert ids == sorted(expected, reverse=True)
@@ -0,0 +1,80 @@
+import struct
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import snapshot
+from snapshot import LEGACY_MAGIC, MAGIC, Snapshot, write_arrays, write_snapshot
+
+
+def varied_records(count, start=0):
+    # Unique bodies, repeated senders, and values a dictionary must keep apart
+    records = []
+    for i in range(start, start + count):
+        record = {"datetime": f"2024-02-{1 + i % 29:02d} {i % 24:02d}:{i % 60:02d}:00", "sender": f"Contact {i % 5}",
+                  "type": ["received", "sent"][i % 2], "body": f"message {i} – ünïcödé " * (1 + i % 3)}
+        if i % 4 == 0:
+            record["attachments"] = [f"file{i}.pdf"] if i % 8 else []
+        if i % 6 == 0:
+            record["priority"] = i % 3
+        if i % 9 == 0:
+            record["datetime"] = "yesterday" if i % 2 else None
+        records.append(record)
+    return records
+
+
+def header_length(path):
+    with open(path, "rb") as f:
+        return struct.unpack("<Q", f.read(len(MAGIC) + 8)[len(MAGIC):])[0]
+
+
+@pytest.mark.parametrize("decode_all_limit", [snapshot.DECODE_ALL_LIMIT, 0], ids=["decoded", "on-demand"])
+def test_records_round_trip(tmp_path, monkeypatch, decode_all_limit):
+    monkeypatch.setattr(snapshot, "DECODE_ALL_LIMIT", decode_all_limit)
+    records = varied_records(300)
+    path = str(tmp_path / "sms_data.snapshot")
+    write_snapshot(path, records[:200], log_offset=10, log_digest="abc")
+
+    first = Snapshot(path)
+    assert (len(first), first.log_offset, first.log_digest) == (200, 10, "abc")
+    assert [first.record(i) for i in range(200)] == records[:200]
+
+    # Extending a snapshot keeps the base codes and adds the new values
+    write_snapshot(str(tmp_path / "next.snapshot"), records[200:] + [{"datetime": "2024-03-01 00:00:00", "late": True}],
+                   base=first)
+    extended = Snapshot(str(tmp_path / "next.snapshot"))
+    assert list(extended) == records + [{"datetime": "2024-03-01 00:00:00", "late": True}]
+    assert list(extended.dictionaries["sender"]) == [f"Contact {i}" for i in range(5)]
+
+
+def test_dictionaries_stay_out_of_the_header(tmp_path):
+    # Every body is distinct, so its dictionary grows with the data but the header does not
+    lengths = []
+    for count in (100, 5000):
+        path = str(tmp_path / f"{count}.snapshot")
+        write_snapshot(path, varied_records(count))
+        lengths.append(header_length(path))
+        assert Snapshot(path).record(count - 1) == varied_records(1, count - 1)[0]
+    assert max(lengths) < 2000 and lengths[1] - lengths[0] < 100
+
+
+def test_legacy_snapshots_are_read(tmp_path):
+    # Earlier files kept the dictionaries in the JSON header
+    records = [{"datetime": "2024-01-01 10:00:00", "sender": "Ann"}, {"sender": "Bo", "tags": ["a"]}]
+    header = {"count": 2, "fields": ["datetime", "sender", "tags"], "log_offset": 0, "log_digest": None,
+              "dictionaries": {"datetime": [], "sender": ["Ann", "Bo"], "tags": [["a"]]}}
+    arrays = {"timestamps": np.array([1704103200, snapshot.MISSING_TIME], np.int64),
+              "columns/datetime": np.array([-1, -1], np.int8), "columns/sender": np.array([0, 1], np.int8),
+              "columns/tags": np.array([-1, 0], np.int8)}
+    path = str(tmp_path / "old.snapshot")
+    write_arrays(path, LEGACY_MAGIC, header, arrays)
+
+    legacy = Snapshot(path)
+    assert list(legacy) == records
+
+    # Compacting on top of it writes the current format
+    write_snapshot(str(tmp_path / "new.snapshot"), [{"sender": "Cy"}], base=legacy)
+    with open(tmp_path / "new.snapshot", "rb") as f:
+        assert f.read(len(MAGIC)) == MAGIC
+    assert list(Snapshot(str(tmp_path / "new.snapshot"))) == records + [{"sender": "Cy"}]
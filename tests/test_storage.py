@@ -0,0 +1,172 @@
+import json
+
+import pytest
+
+from storage import RecordStore, StoreLockedError
+
+
+class RecordingListener:
+    """
+    Listener keeping a copy of the records it was rebuilt and updated with.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.rebuilds = 0
+
+    def rebuild(self, records):
+        self.records = list(records)
+        self.rebuilds += 1
+
+    def add(self, records):
+        self.records.extend(records)
+
+
+@pytest.fixture(params=[False, True], ids=["log", "snapshot"])
+def snapshots(request):
+    if request.param:
+        pytest.importorskip("numpy")
+    return request.param
+
+
+def read_log(store):
+    with open(store.path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_extend_is_on_disk_when_it_returns(tmp_path, snapshots, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=snapshots)
+    records = make_records(50)
+    store.extend(records[:20])
+    for record in records[20:]:
+        store.append(record)
+
+    # Every record is in the log file, and a new store instance reads them back
+    assert read_log(store) == records
+    assert list(RecordStore(str(tmp_path / "sms_data.json"), snapshots=snapshots)) == records
+
+
+def test_legacy_json_is_migrated(tmp_path, make_records):
+    records = make_records(5)
+    (tmp_path / "sms_data.json").write_text(json.dumps(records), encoding="utf-8")
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    assert read_log(store) == records
+    assert store.read_records([4, 0]) == [records[4], records[0]]
+
+
+def test_torn_last_line_is_dropped(tmp_path, make_records):
+    records = make_records(3)
+    log = tmp_path / "sms_data.jsonl"
+    complete = "".join(json.dumps(record) + "\n" for record in records)
+    log.write_text(complete + '{"sender": "Half', encoding="utf-8")
+
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    assert list(store) == records
+    assert log.read_text(encoding="utf-8") == complete
+
+    # Appends continue on a clean line
+    store.append(make_records(1, 3)[0])
+    assert read_log(store) == records + make_records(1, 3)
+
+
+def test_compaction_keeps_records_and_numbers(tmp_path, snapshots, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), compact_every=0, snapshots=snapshots)
+    records = make_records(30)
+    store.extend(records[:20])
+    store.compact()
+    store.extend(records[20:])
+    assert list(store) == records
+    assert store.read_records([0, 19, 20, 29]) == [records[0], records[19], records[20], records[29]]
+
+
+def test_listeners_follow_commits_replace_and_evict(tmp_path, snapshots, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=snapshots)
+    listener = store.subscribe(RecordingListener())
+    records = make_records(40)
+    store.extend(records)
+    assert listener.records == records
+
+    # replace() rebuilds the listener from the new contents
+    version = store.version
+    store.replace(records[:10])
+    assert listener.records == records[:10]
+    assert store.version != version
+
+    # evict() hands the moved records to the sink and rebuilds from the rest
+    archived = []
+    moved = store.evict(lambda record: record["sender"] == "Contact 0", archived.extend)
+    kept = [record for record in records[:10] if record["sender"] != "Contact 0"]
+    assert moved == len(archived) == 2
+    assert listener.records == kept
+    assert list(store) == kept
+    assert listener.rebuilds == 3
+
+
+class FailingListener(RecordingListener):
+    """
+    Listener that fails to take the next update.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.failures = 1
+
+    def add(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("index failure")
+        super().add(records)
+
+
+def test_failing_listener_does_not_fail_the_commit(tmp_path, snapshots, make_records):
+    store = RecordStore(str(tmp_path / "sms_data.json"), snapshots=snapshots)
+    failing = store.subscribe(FailingListener())
+    listener = store.subscribe(RecordingListener())
+    records = make_records(10)
+    version = store.version
+
+    # The records are durable, so the caller gets no error
+    store.extend(records)
+    assert read_log(store) == records
+    assert store.version != version
+
+    # Later indexes are still updated, and the failing one is rebuilt from the store
+    assert listener.records == records
+    assert failing.records == records and failing.rebuilds == 2
+    assert "index failure" in store.stats()["last_error"]
+
+    store.extend(make_records(2, 10))
+    assert failing.records == listener.records == make_records(12)
+
+
+def test_failing_listener_on_refresh_is_rebuilt(tmp_path, make_records):
+    writer = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    reader = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    failing = reader.subscribe(FailingListener())
+    listener = reader.subscribe(RecordingListener())
+
+    writer.extend(make_records(5))
+    reader.refresh()
+    assert failing.records == listener.records == make_records(5)
+
+
+def test_second_writer_is_read_only(tmp_path, make_records):
+    writer = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    reader = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    assert not writer.read_only and reader.read_only
+
+    # The reader follows the writer's log, but cannot write it
+    writer.extend(make_records(3))
+    reader.refresh()
+    assert list(reader) == make_records(3)
+    for write in (lambda: reader.extend(make_records(1, 3)), lambda: reader.replace([]), reader.compact):
+        with pytest.raises(StoreLockedError):
+            write()
+    assert read_log(writer) == make_records(3)
+
+    # Once the writer closes the store, the next store opened takes it
+    writer.close()
+    successor = RecordStore(str(tmp_path / "sms_data.json"), snapshots=False)
+    successor.extend(make_records(1, 3))
+    reader.refresh()
+    assert list(reader) == make_records(4)
@@ -0,0 +1,34 @@
+from storage import RecordStore
+from threads import ThreadIndex
+
+SENDERS = [f"Contact {i}" for i in range(6)]
+
+
+def store_incrementally(store, records):
+    # Stored one by one and in batches, as collects and batch collects do
+    for record in records[:100]:
+        store.append(record)
+    for start in range(100, len(records), 64):
+        store.extend(records[start:start + 64])
+
+
+def thread_state(threads):
+    summaries = threads.threads(limit=100000)
+    return (
+        summaries,
+        [threads.thread(summary["thread_id"]) for summary in summaries],
+        threads.unanswered(limit=100000),
+        threads.reply_times(),
+        threads.replies()
+    )
+
+
+def test_rebuild_matches_incremental_index(tmp_path, make_records):
+    store = RecordStore(str(tmp_path / "email_data.json"), snapshots=False)
+    live = store.subscribe(ThreadIndex("type", subject_field="subject"))
+    store_incrementally(store, make_records(300, times="recent", senders=SENDERS, replies=True, subjects=True))
+
+    threads = ThreadIndex("type", subject_field="subject")
+    threads.rebuild(store)
+    assert thread_state(live) == thread_state(threads)
+    assert thread_state(threads)[4] and thread_state(threads)[2]
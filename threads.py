@@ -0,0 +1,409 @@
+"""
+Conversation threading for the SMS and email stores.
+
+ThreadIndex is a store listener that assigns every record to a thread as
+it is stored. A message from a contact joins that contact's latest thread
+with the same normalized subject (no "Re:"/"Fwd:" prefixes, case and
+spacing ignored) if it is within THREAD_GAP of it, and starts a new thread
+otherwise. A sent record ("Me") carries no recipient, so it is taken as the
+reply to the thread most recently waiting for one, within REPLY_WINDOW of
+the reply, preferring a thread with the same subject. A reply answers every
+message of its thread that is still waiting, and its latency is counted
+from the oldest of them.
+
+The conversation of a thread is the contact it is with. Threads, reply
+latency statistics per contact and unanswered messages are kept up to
+date, so the endpoints built here only touch the results they return.
+"""
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+import re
+import threading
+
+from flask import jsonify
+
+from index import format_timestamp, parse_timestamp
+from query import QueryError, decode_cursor, encode_cursor
+
+# Longest gap between messages of the same thread (seconds)
+THREAD_GAP = 24 * 3600
+
+# Longest wait for a reply to still count as one (seconds)
+REPLY_WINDOW = 7 * 24 * 3600
+
+# Waiting threads considered when matching a reply, most recent first
+MAX_REPLY_CANDIDATES = 1000
+
+DEFAULT_THREAD_LIMIT = 100
+
+SUBJECT_PREFIX_RE = re.compile(r"^\s*((re|fwd?|aw|sv)\s*(\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+
+
+def normalize_subject(subject):
+    """
+    Function to reduce a subject to the form shared by every message of its thread.
+    """
+    if not isinstance(subject, str):
+        return None
+    return " ".join(SUBJECT_PREFIX_RE.sub("", subject).lower().split())
+
+
+class _Thread:
+    """
+    Messages of one thread, and those still waiting for a reply.
+    """
+    __slots__ = ("id", "contact", "subject", "key", "started", "last", "seqs", "waiting", "replies")
+
+    def __init__(self, thread_id, contact, subject, key, record_time):
+        self.id = thread_id
+        self.contact = contact
+        self.subject = subject
+        self.key = key
+        self.started = record_time
+        self.last = record_time
+        self.seqs = []
+        self.waiting = []
+        self.replies = 0
+
+
+class ThreadIndex:
+    """
+    In-memory index of the threads of a record store.
+    Record numbers are positions in the store, as used by RecordStore.read_records().
+    """
+
+    def __init__(self, type_field, sent_type="sent", subject_field=None):
+        # Record field holding the direction, and its value on the user's own messages
+        self.type_field = type_field
+        self.sent_type = sent_type
+
+        # Record field holding the subject, or None for messages without one
+        self.subject_field = subject_field
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self._threads = []
+        self._latest = {}
+        self._by_contact = {}
+        self._waiting_threads = {}
+        self._unanswered = []
+        self._unanswered_by_contact = {}
+        self._unanswered_threads = {}
+        self._latencies = {}
+        self._replies = []
+
+    def rebuild(self, records):
+        """
+        Function to rebuild the index from scratch.
+        """
+        with self._lock:
+            self._reset()
+            self._add(records)
+
+    def add(self, records):
+        """
+        Function to update the index with newly stored records.
+        """
+        with self._lock:
+            self._add(records)
+
+    def _add(self, records):
+        for record in records:
+            seq = self.count
+            self.count += 1
+            try:
+                sender = record["sender"]
+                record_time = parse_timestamp(record["datetime"])
+                if not isinstance(sender, str):
+                    continue
+            except (KeyError, TypeError, ValueError):
+                # Skip records the index cannot place
+                continue
+
+            subject = record.get(self.subject_field) if self.subject_field else None
+            if record.get(self.type_field) == self.sent_type:
+                self._add_reply(seq, record_time, subject)
+            else:
+                thread = self._thread_for(sender, subject, record_time)
+                thread.seqs.append(seq)
+                self._wait(thread, seq, record_time)
+
+    def _thread_for(self, contact, subject, record_time):
+        """
+        Function to get the thread a message joins, starting a new one if needed.
+        """
+        key = (contact, normalize_subject(subject))
+        thread = self._latest.get(key)
+        if thread is not None and abs(record_time - thread.last) <= THREAD_GAP:
+            thread.started = min(thread.started, record_time)
+            thread.last = max(thread.last, record_time)
+            return thread
+
+        thread = _Thread(len(self._threads), contact, subject, key, record_time)
+        self._threads.append(thread)
+        self._latest[key] = thread
+        if contact is not None:
+            self._by_contact.setdefault(contact, []).append(thread.id)
+        return thread
+
+    def _wait(self, thread, seq, record_time):
+        """
+        Function to mark a received message as waiting for a reply.
+        """
+        thread.waiting.append((seq, record_time))
+
+        # Kept in (time, record number) order, oldest first; records mostly come in
+        # time order, so this usually appends
+        key = (record_time, seq)
+        insort(self._unanswered, key)
+        insort(self._unanswered_by_contact.setdefault(thread.contact, []), key)
+        self._unanswered_threads[seq] = thread.id
+
+        # Most recently active waiting thread last
+        self._waiting_threads.pop(thread.id, None)
+        self._waiting_threads[thread.id] = thread
+
+    def _add_reply(self, seq, record_time, subject):
+        """
+        Function to match a sent message to the thread it replies to.
+        """
+        key = normalize_subject(subject)
+        parent = None
+        for checked, thread in enumerate(reversed(self._waiting_threads.values())):
+            if checked == MAX_REPLY_CANDIDATES:
+                break
+
+            # The reply must come after a waiting message, and within the window of the latest one
+            if thread.waiting[0][1] > record_time or record_time - thread.waiting[-1][1] > REPLY_WINDOW:
+                continue
+            if thread.key[1] == key:
+                parent = thread
+                break
+            if parent is None:
+                parent = thread
+
+        if parent is None:
+            # Not a reply: a thread the user started
+            thread = self._thread_for(None, subject, record_time)
+            thread.seqs.append(seq)
+            return
+
+        parent.seqs.append(seq)
+        parent.last = max(parent.last, record_time)
+        parent.replies += 1
+
+        # The reply answers every message of the thread sent before it
+        answered = [(waiting_seq, waiting_time) for waiting_seq, waiting_time in parent.waiting if waiting_time <= record_time]
+        parent.waiting = [entry for entry in parent.waiting if entry[1] > record_time]
+        if not parent.waiting:
+            del self._waiting_threads[parent.id]
+        latency = record_time - answered[0][1]
+        insort(self._latencies.setdefault(parent.contact, []), latency)
+        self._replies.append((record_time, parent.contact, latency))
+
+        contact_unanswered = self._unanswered_by_contact[parent.contact]
+        for waiting_seq, waiting_time in answered:
+            key = (waiting_time, waiting_seq)
+            del self._unanswered[bisect_left(self._unanswered, key)]
+            del contact_unanswered[bisect_left(contact_unanswered, key)]
+            del self._unanswered_threads[waiting_seq]
+
+    def _summary(self, thread):
+        summary = {
+            "thread_id": thread.id,
+            "conversation": thread.contact,
+            "started": format_timestamp(thread.started),
+            "last_message": format_timestamp(thread.last),
+            "messages": len(thread.seqs),
+            "replies": thread.replies,
+            "unanswered": len(thread.waiting)
+        }
+        if self.subject_field:
+            summary["subject"] = thread.subject
+        return summary
+
+    def threads(self, contact=None, before=None, limit=DEFAULT_THREAD_LIMIT):
+        """
+        Function to list thread summaries, newest thread first.
+        before is the id of the last thread of the previous page.
+        """
+        with self._lock:
+            if contact is None:
+                end = len(self._threads) if before is None else min(before, len(self._threads))
+                ids = range(end - 1, max(end - limit, 0) - 1, -1)
+            else:
+                contact_ids = self._by_contact.get(contact, [])
+                end = len(contact_ids) if before is None else bisect_left(contact_ids, before)
+                ids = reversed(contact_ids[max(end - limit, 0):end])
+            return [self._summary(self._threads[thread_id]) for thread_id in ids]
+
+    def thread(self, thread_id):
+        """
+        Function to get the summary and record numbers of a thread, or None.
+        """
+        with self._lock:
+            if not 0 <= thread_id < len(self._threads):
+                return None
+            thread = self._threads[thread_id]
+            return self._summary(thread), list(thread.seqs)
+
+    def waiting_threads(self, count, subjects=()):
+        """
+        Function to list the threads waiting for a reply, most recently waiting
+        first: the latest count of them, and the latest one with each of the
+        given subjects among the MAX_REPLY_CANDIDATES latest. Each comes with its
+        normalized subject and the times of its oldest and latest waiting message.
+        """
+        keys = {normalize_subject(subject) for subject in subjects}
+        with self._lock:
+            threads = []
+            for checked, thread in enumerate(islice(reversed(self._waiting_threads.values()), MAX_REPLY_CANDIDATES)):
+                if checked < count or thread.key[1] in keys:
+                    threads.append(thread)
+                    keys.discard(thread.key[1])
+                elif not keys:
+                    break
+            return [
+                {
+                    "thread_id": thread.id,
+                    "conversation": thread.contact,
+                    "subject": thread.key[1],
+                    "first_waiting": format_timestamp(thread.waiting[0][1]),
+                    "last_waiting": format_timestamp(thread.waiting[-1][1])
+                }
+                for thread in threads
+            ]
+
+    def reply_times(self, contact=None):
+        """
+        Function to get reply latency statistics (seconds) per contact.
+        """
+        with self._lock:
+            contacts = self._latencies if contact is None else [contact] if contact in self._latencies else []
+            stats = {}
+            for name in contacts:
+                latencies = self._latencies[name]
+                middle = len(latencies) // 2
+                stats[name] = {
+                    "replies": len(latencies),
+                    "mean_seconds": sum(latencies) / len(latencies),
+                    "median_seconds": latencies[middle] if len(latencies) % 2 else (latencies[middle - 1] + latencies[middle]) / 2,
+                    "min_seconds": latencies[0],
+                    "max_seconds": latencies[-1],
+                    "unanswered": len(self._unanswered_by_contact.get(name, []))
+                }
+            return stats
+
+    def replies(self, start=0):
+        """
+        Function to get the (reply time, contact, latency) of every reply matched
+        since the first start ones, in the order they were stored.
+        """
+        with self._lock:
+            return self._replies[start:]
+
+    def unanswered(self, contact=None, after=None, limit=DEFAULT_THREAD_LIMIT):
+        """
+        Function to list ((time, record number), thread id) pairs of messages waiting
+        for a reply, oldest first. after is the (time, record number) key of the last
+        message of the previous page.
+        """
+        with self._lock:
+            keys = self._unanswered if contact is None else self._unanswered_by_contact.get(contact, [])
+            start = 0 if after is None else bisect_right(keys, after)
+            return [(key, self._unanswered_threads[key[1]]) for key in keys[start:start + limit]]
+
+
+def parse_page(args):
+    """
+    Function to read the limit and cursor parameters of a thread endpoint.
+    """
+    try:
+        limit = int(args.get("limit", DEFAULT_THREAD_LIMIT))
+        cursor = int(args["cursor"]) if "cursor" in args else None
+    except ValueError:
+        raise QueryError("Invalid limit or cursor")
+    if limit <= 0 or (cursor is not None and cursor < 0):
+        raise QueryError("Invalid limit or cursor")
+    return limit, cursor
+
+
+def get_threads(store, index, args):
+    """
+    Function to build the response of a threads endpoint.
+    With thread=<id>, returns that thread and its records; otherwise one page
+    of thread summaries, newest first, optionally for one sender.
+    """
+    if "thread" in args:
+        try:
+            found = index.thread(int(args["thread"]))
+        except ValueError:
+            raise QueryError("Invalid thread. Must be a thread_id")
+        if found is None:
+            raise QueryError(f"Unknown thread '{args['thread']}'")
+        summary, seqs = found
+        return jsonify({"status": "success", "thread": summary, "data": store.read_records(seqs)})
+
+    limit, cursor = parse_page(args)
+    threads = index.threads(args.get("sender"), cursor, limit)
+
+    # Hand out a cursor only when there may be more threads
+    next_cursor = None
+    if len(threads) == limit and threads[-1]["thread_id"] > 0:
+        next_cursor = str(threads[-1]["thread_id"])
+
+    return jsonify({"status": "success", "data": threads, "next_cursor": next_cursor})
+
+
+def get_reply_times(index, args):
+    """
+    Function to build the response of a reply times endpoint.
+    """
+    return jsonify({"status": "success", "contacts": index.reply_times(args.get("sender"))})
+
+
+def get_reply_parents(index, records, stored):
+    """
+    Function to build the response of a reply parents endpoint, for a batch of
+    sent records: whether each is stored already, and the threads waiting for
+    a reply that they could answer, most recently waiting first.
+    """
+    if not isinstance(records, list):
+        raise QueryError("Expected a JSON array of sent records")
+    subjects = []
+    if index.subject_field:
+        subjects = [record.get(index.subject_field) for record in records if isinstance(record, dict)]
+    return jsonify({
+        "status": "success",
+        "stored": stored,
+        "waiting": index.waiting_threads(len(records), subjects)
+    })
+
+
+def get_unanswered(store, index, args):
+    """
+    Function to build the response of an unanswered messages endpoint.
+    Returns one page of messages still waiting for a reply, oldest first.
+    With keys=1, the cursor of every message is included too, so that the
+    shard router can merge the pages of the shards by time.
+    """
+    limit, _ = parse_page({"limit": args.get("limit", DEFAULT_THREAD_LIMIT)})
+    after = decode_cursor(args["cursor"]) if "cursor" in args else None
+    entries = index.unanswered(args.get("sender"), after, limit)
+    records = store.read_records([key[1] for key, _ in entries])
+
+    # Hand out a cursor only when there may be more messages
+    next_cursor = None
+    if len(entries) == limit:
+        next_cursor = encode_cursor(entries[-1][0])
+
+    response = {
+        "status": "success",
+        "data": [{"thread_id": thread_id, "record": record} for (_, thread_id), record in zip(entries, records)],
+        "next_cursor": next_cursor
+    }
+    if args.get("keys") == "1":
+        response["keys"] = [encode_cursor(key) for key, _ in entries]
+    return jsonify(response)